@@ -1,22 +1,77 @@
+import collections
 import contextlib
+import threading
+import time
 import traceback
-from typing import Any, Generator, List, Literal
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import Generator
+from typing import Iterator
+from typing import List
+from typing import Literal
+from typing import Optional
+from typing import Tuple
 
+import clickhouse_connect
+import numpy as np
+import pandas as pd
 from account_metrics import MetricData
 from clickhouse_connect.driver import Client
-import clickhouse_connect
+from clickhouse_connect.driver.insert import InsertContext
 
 from metric_coordinator.configs import type_map
-import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
 
 class ClickhouseClient:
-    def __init__(self, username: str, password: str, host: str, http_port: str, database: str) -> None:
+    TRANSPORTS = ("pandas", "arrow")
+    READ_STRATEGIES = ("final", "argmax", "client")
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        host: str,
+        http_port: str,
+        database: str,
+        pool_size: int = 4,
+        pool_idle_timeout: float = 300,
+        pool_health_check_interval: float = 30,
+        transport: Literal["pandas", "arrow"] = "pandas",
+        read_strategy: Literal["final", "argmax", "client"] = "final",
+    ) -> None:
         self.username = username
         self.password = password
         self.host = host
         self.http_port = http_port
         self.database = database
+        # At most pool_size connections are open at once, callers wait for a free one (0 disables pooling).
+        # Idle connections are closed after pool_idle_timeout seconds and pinged before reuse
+        # when they have been idle for more than pool_health_check_interval seconds.
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.pool_health_check_interval = pool_health_check_interval
+        self._pool_lock = threading.Lock()
+        self._pool_semaphore = threading.BoundedSemaphore(pool_size) if pool_size > 0 else None
+        self._idle_clients: Deque[Tuple[Client, float]] = collections.deque()
+        # "arrow" moves query_df/insert_df data as Arrow record batches: query results are pandas DataFrames
+        # backed by pyarrow dtypes and inserts are converted column by column, no object columns on the way
+        if transport not in self.TRANSPORTS:
+            raise ValueError(f"Unsupported transport {transport}, expected one of {self.TRANSPORTS}")
+        if transport == "arrow" and pa is None:
+            raise ValueError("The arrow transport requires pyarrow to be installed")
+        self.transport = transport
+        # How reads of ReplacingMergeTree tables get one row per key (see query_deduplicated_df):
+        # "final" merges on read with FINAL, "argmax" keeps the columns of the max version with GROUP BY,
+        # "client" reads the raw rows and drops the older versions in pandas
+        if read_strategy not in self.READ_STRATEGIES:
+            raise ValueError(f"Unsupported read strategy {read_strategy}, expected one of {self.READ_STRATEGIES}")
+        self.read_strategy = read_strategy
 
     def __str__(self) -> str:
         dns = f"clickhouse://{self.username}:{self.password}@{self.host}:{self.http_port}/{self.database}"
@@ -24,14 +79,70 @@ class ClickhouseClient:
 
     @contextlib.contextmanager
     def get_ch_client(self) -> Generator[Client, Any, None]:
-        dns = f"clickhouse://{self.username}:{self.password}@{self.host}:{self.http_port}/{self.database}"
-        ch_client: Client = clickhouse_connect.get_client(dsn=dns)
         try:
-            yield ch_client
+            with self.checkout_ch_client() as ch_client:
+                yield ch_client
         except Exception as e:
             print(traceback.format_exc())
+
+    @contextlib.contextmanager
+    def checkout_ch_client(self) -> Generator[Client, Any, None]:
+        """
+        Same as get_ch_client but errors are raised to the caller instead of being logged
+        """
+        if self._pool_semaphore is None:
+            ch_client = self._create_ch_client()
+            try:
+                yield ch_client
+            finally:
+                ch_client.close()
+            return
+
+        self._pool_semaphore.acquire()
+        ch_client = None
+        try:
+            ch_client = self._acquire_ch_client()
+            yield ch_client
+        except Exception:
+            # The connection may be in a broken state, do not give it back to the pool
+            if ch_client is not None:
+                ch_client.close()
+                ch_client = None
+            raise
         finally:
+            if ch_client is not None:
+                with self._pool_lock:
+                    self._idle_clients.append((ch_client, time.monotonic()))
+            self._pool_semaphore.release()
+
+    def close(self) -> None:
+        with self._pool_lock:
+            idle_clients, self._idle_clients = self._idle_clients, collections.deque()
+        for ch_client, _ in idle_clients:
+            ch_client.close()
+
+    def _create_ch_client(self) -> Client:
+        dns = f"clickhouse://{self.username}:{self.password}@{self.host}:{self.http_port}/{self.database}"
+        return clickhouse_connect.get_client(dsn=dns)
+
+    def _acquire_ch_client(self) -> Client:
+        expired_clients = []
+        with self._pool_lock:
+            while self._idle_clients and time.monotonic() - self._idle_clients[0][1] > self.pool_idle_timeout:
+                expired_clients.append(self._idle_clients.popleft()[0])
+        for ch_client in expired_clients:
+            ch_client.close()
+
+        while True:
+            with self._pool_lock:
+                if not self._idle_clients:
+                    break
+                # Most recently used first, so the connections that are not needed anymore expire
+                ch_client, last_used = self._idle_clients.pop()
+            if time.monotonic() - last_used <= self.pool_health_check_interval or ch_client.ping():
+                return ch_client
             ch_client.close()
+        return self._create_ch_client()
 
     def query_dml(self, query: str) -> bool:
         with self.get_ch_client() as client:
@@ -42,15 +153,203 @@ class ClickhouseClient:
         with self.get_ch_client() as client:
             return client.query(query)
 
-    def query_df(self, query: str) -> pd.DataFrame:
-        with self.get_ch_client() as client:
-            return client.query_df(query)
+    def query_df(self, query: str, parameters: Dict[str, Any] = None, raise_errors: bool = False) -> pd.DataFrame:
+        """
+        parameters are bound server-side to the {name:Type} placeholders of query (see query_builder).
+        A failed query returns None, or raises with raise_errors so it cannot be mistaken for a missing row.
+        """
+        if self.transport == "arrow":
+            arrow_table = self.query_arrow(query, parameters, raise_errors)
+            return None if arrow_table is None else arrow_table.to_pandas(types_mapper=pd.ArrowDtype)
+        with self.checkout_ch_client() if raise_errors else self.get_ch_client() as client:
+            return client.query_df(query, parameters=parameters)
 
     def insert_df(self, table: str, df: pd.DataFrame) -> bool:
-        with self.get_ch_client() as client:
+        """
+        Insert errors are raised, so the caller can retry the rows (e.g. WriteBehindBuffer) instead of losing them
+        """
+        if self.transport == "arrow":
+            return self.insert_arrow(table, pa.Table.from_pandas(df, preserve_index=False))
+        with self.checkout_ch_client() as client:
             client.insert_df(table, df)
             return True
 
+    def create_insert_context(
+        self,
+        table: str,
+        column_names: List[str],
+        column_type_names: List[str],
+    ) -> InsertContext:
+        """
+        Reusable insert context of table for column-oriented data,
+        the column types are given so it does not DESCRIBE the table
+        """
+        with self.checkout_ch_client() as client:
+            return client.create_insert_context(
+                table,
+                column_names=column_names,
+                column_type_names=column_type_names,
+                column_oriented=True,
+            )
+
+    def insert_columns(self, context: InsertContext, columns: List[np.ndarray]) -> bool:
+        """
+        Inserts columns (in the context column order) with a context of create_insert_context,
+        the context must not be used by another insert at the same time. Insert errors are raised.
+        """
+        if self.transport == "arrow":
+            return self.insert_arrow(context.table, pa.Table.from_arrays(columns, names=context.column_names))
+        with self.checkout_ch_client() as client:
+            try:
+                client.insert(data=columns, context=context)
+            finally:
+                context.data = None
+            return True
+
+    def query_df_stream(
+        self,
+        query: str,
+        block_size: int = None,
+        parameters: Dict[str, Any] = None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Streams the result of query as DataFrames of at most block_size rows (the server max_block_size),
+        the connection is held until the iterator is exhausted or closed
+        """
+        settings = {"max_block_size": block_size} if block_size else None
+        # A failed stream must not look like a complete result, so errors are raised
+        with self.checkout_ch_client() as client:
+            if self.transport == "arrow":
+                with client.query_arrow_stream(query, parameters=parameters, settings=settings) as stream:
+                    for record_batch in stream:
+                        yield record_batch.to_pandas(types_mapper=pd.ArrowDtype)
+            else:
+                with client.query_df_stream(query, parameters=parameters, settings=settings) as stream:
+                    for df in stream:
+                        yield df
+
+    def get_final_clause(self) -> str:
+        """
+        FINAL for the "final" read strategy. Queries that already keep only the max version per key
+        (ORDER BY version DESC LIMIT 1 [BY keys], max(version)) return the same rows without it.
+        """
+        return "FINAL" if self.read_strategy == "final" else ""
+
+    def query_deduplicated_df(
+        self,
+        table: str,
+        key_columns: List[str],
+        where: str = "",
+        columns: Optional[List[str]] = None,
+        version_column: str = "timestamp_server",
+        order_by: List[str] = None,
+        parameters: Dict[str, Any] = None,
+    ) -> pd.DataFrame:
+        """
+        SELECT columns (all of them by default) FROM table where, with one row per key_columns
+        (the one with the max version_column) using the read strategy. argmax needs the columns,
+        without them (or without key columns) the client (or final) strategy is used.
+        Unlike FINAL, argmax and client apply the where filter before deduplicating, it should only filter on key
+        columns or on columns that do not change between versions.
+        """
+        strategy = self._get_read_strategy(key_columns, columns)
+        df = self.query_df(
+            self._get_read_query(strategy, table, key_columns, where, columns, version_column, order_by),
+            parameters,
+        )
+        if df is None or strategy == "final":
+            return df
+        if strategy == "argmax":
+            df.columns = columns
+        else:
+            df = self._drop_old_versions(df, key_columns, version_column, columns)
+        return df.sort_values(order_by, kind="stable", ignore_index=True) if order_by else df
+
+    def query_deduplicated_df_stream(
+        self,
+        table: str,
+        key_columns: List[str],
+        where: str = "",
+        columns: Optional[List[str]] = None,
+        version_column: str = "timestamp_server",
+        block_size: int = None,
+        parameters: Dict[str, Any] = None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Streaming variant of query_deduplicated_df. With the client strategy the rows are read in key order,
+        so the versions of a key are consecutive and only the last key of a block is carried over to the next one.
+        """
+        strategy = self._get_read_strategy(key_columns, columns)
+        query = self._get_read_query(strategy, table, key_columns, where, columns, version_column, None)
+        if strategy == "client":
+            query = f"{query} ORDER BY {', '.join(key_columns + [version_column])}"
+        carry = None
+        for block in self.query_df_stream(query, block_size=block_size, parameters=parameters):
+            if strategy == "final":
+                yield block
+                continue
+            if strategy == "argmax":
+                block.columns = columns
+                yield block
+                continue
+            if carry is not None:
+                block = pd.concat([carry, block], ignore_index=True)
+            if block.empty:
+                continue
+            last_key = (block[key_columns] == block[key_columns].iloc[-1]).all(axis=1)
+            carry = block[last_key]
+            yield self._drop_old_versions(block[~last_key], key_columns, version_column, columns)
+        if carry is not None and not carry.empty:
+            yield self._drop_old_versions(carry, key_columns, version_column, columns)
+
+    def _get_read_strategy(self, key_columns: List[str], columns: List[str]) -> str:
+        if self.read_strategy == "final" or not key_columns:
+            return "final"
+        if self.read_strategy == "argmax" and not columns:
+            return "client"
+        return self.read_strategy
+
+    def _get_read_query(
+        self,
+        strategy: str,
+        table: str,
+        key_columns: List[str],
+        where: str,
+        columns: List[str],
+        version_column: str,
+        order_by: List[str],
+    ) -> str:
+        if strategy == "final":
+            order_by_clause = f"ORDER BY {', '.join(order_by)}" if order_by else ""
+            return f"SELECT {', '.join(columns) if columns else '*'} FROM {table} FINAL {where} {order_by_clause}"
+        if strategy == "argmax":
+            # Aliases must not shadow the columns used inside argMax, the result columns are renamed back by position
+            latest = {c: f"argMax({c}, {version_column}) AS latest_{c}" for c in columns if c not in key_columns}
+            select = ", ".join(latest.get(c, c) for c in columns)
+            return f"SELECT {select} FROM {table} {where} GROUP BY {', '.join(key_columns)}"
+        if not columns:
+            return f"SELECT * FROM {table} {where}"
+        # The key and version columns are needed to deduplicate, even when they are not projected
+        select = columns + [c for c in key_columns + [version_column] if c not in columns]
+        return f"SELECT {', '.join(select)} FROM {table} {where}"
+
+    def _drop_old_versions(
+        self, df: pd.DataFrame, key_columns: List[str], version_column: str, columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        if version_column in df.columns:
+            df = df.sort_values(version_column, kind="stable")
+        df = df.drop_duplicates(subset=key_columns, keep="last").sort_index()
+        return df[columns] if columns else df
+
+    def query_arrow(self, query: str, parameters: Dict[str, Any] = None, raise_errors: bool = False) -> "pa.Table":
+        with self.checkout_ch_client() if raise_errors else self.get_ch_client() as client:
+            return client.query_arrow(query, parameters=parameters)
+
+    def insert_arrow(self, table: str, arrow_table: "pa.Table") -> bool:
+        with self.checkout_ch_client() as client:
+            client.insert_arrow(table, arrow_table)
+            return True
+
     def truncate_tables(self, tables: List[str]) -> Literal[True]:
         for table in tables:
             if not self.query_dml(f"TRUNCATE TABLE IF EXISTS {table}"):
@@ -63,10 +362,58 @@ class ClickhouseClient:
                 raise ValueError(f"Failed to drop table {table}")
         return True
 
-    def create_metric_if_not_exist(self, table_name: str, metric_fields: List[str], keys: List[str]) -> Literal[True]:
-        query = f"CREATE TABLE IF NOT EXISTS {table_name} ({metric_fields}) ENGINE = ReplacingMergeTree ORDER BY ({keys})"
+    def create_metric_if_not_exist(
+        self,
+        table_name: str,
+        metric_fields: List[str],
+        keys: List[str],
+        partition_by: str = None,
+        version_column: str = None,
+        ttl: str = None,
+    ) -> Literal[True]:
+        engine = f"ReplacingMergeTree({version_column})" if version_column else "ReplacingMergeTree"
+        query = f"CREATE TABLE IF NOT EXISTS {table_name} ({metric_fields}) ENGINE = {engine}"
+        if partition_by:
+            query = f"{query} PARTITION BY {partition_by}"
+        query = f"{query} ORDER BY ({keys})"
+        if ttl:
+            query = f"{query} TTL {ttl}"
 
         # only log if the table doesn't exist
         if not self.query_dml(query):
             return False
         return True
+
+    @staticmethod
+    def get_latest_state_table_name(table_name: str) -> str:
+        return f"{table_name}_latest"
+
+    def create_latest_state_view_if_not_exist(
+        self,
+        table_name: str,
+        metric_fields: str,
+        shard_key_columns: List[str],
+        version_column: str = "timestamp_server",
+    ) -> Literal[True]:
+        """
+        Creates {table_name}_latest, a ReplacingMergeTree keeping the row with the max version_column per shard key,
+        fed by a materialized view on every insert into table_name. A newly created view is backfilled from table_name.
+        """
+        latest_table = self.get_latest_state_table_name(table_name)
+        view = f"{latest_table}_mv"
+        exists = self.query_ddl(f"EXISTS TABLE {view}")
+        if exists is None:
+            return False
+        if exists.first_item.get("result"):
+            return True
+        queries = [
+            f"CREATE TABLE IF NOT EXISTS {latest_table} ({metric_fields}) "
+            f"ENGINE = ReplacingMergeTree({version_column}) ORDER BY ({', '.join(shard_key_columns)})",
+            f"CREATE MATERIALIZED VIEW IF NOT EXISTS {view} TO {latest_table} AS SELECT * FROM {table_name}",
+            # Rows inserted between the view creation and the backfill are deduplicated by the version column
+            f"INSERT INTO {latest_table} SELECT * FROM {table_name}",
+        ]
+        for query in queries:
+            if not self.query_dml(query):
+                return False
+        return True
@@ -0,0 +1,61 @@
+import functools
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Type
+
+import pandas as pd
+from account_metrics import MetricData
+
+from metric_coordinator.configs import type_map
+
+# Conditions use ClickHouse server-side parameter binding ({name:Type} placeholders bound with the parameters argument
+# of the client queries), so a statement is the same string for every lookup of the same columns and is only built once.
+
+
+def get_parameter_types(metric: Type[MetricData], columns: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    e.g. ("Login", "Date") -> ("Int64", "Date32")
+    """
+    return tuple(type_map.get(metric.model_fields[col].annotation.__name__, "String") for col in columns)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_equals_condition(columns: Tuple[str, ...], types: Tuple[str, ...]) -> str:
+    """
+    e.g. ("Login", "Date"), ("Int64", "Date32") -> Login = {Login:Int64} AND Date = {Date:Date32}
+    """
+    return " AND ".join(f"{col} = {{{col}:{col_type}}}" for col, col_type in zip(columns, types, strict=True))
+
+
+@functools.lru_cache(maxsize=1024)
+def get_in_condition(columns: Tuple[str, ...], types: Tuple[str, ...], parameter: str = "keys") -> str:
+    """
+    The key set is sent as a single array parameter instead of inlined literals
+    e.g. ("Login",), ("Int64",) -> Login IN {keys:Array(Int64)}
+         ("Login", "Date"), ("Int64", "Date32") -> (Login, Date) IN {keys:Array(Tuple(Int64, Date32))}
+    """
+    if len(columns) == 1:
+        return f"{columns[0]} IN {{{parameter}:Array({types[0]})}}"
+    return f"({', '.join(columns)}) IN {{{parameter}:Array(Tuple({', '.join(types)}))}}"
+
+
+def get_equals_parameters(values: Dict[str, Any]) -> Dict[str, Any]:
+    return {col: to_parameter(value) for col, value in values.items()}
+
+
+def get_in_parameter(keys: pd.DataFrame) -> List[Any]:
+    """
+    Distinct rows of keys as the value of a get_in_condition parameter,
+    scalars for a single column and tuples otherwise
+    """
+    rows = keys.drop_duplicates().itertuples(index=False, name=None)
+    if len(keys.columns) == 1:
+        return [to_parameter(row[0]) for row in rows]
+    return [tuple(to_parameter(v) for v in row) for row in rows]
+
+
+def to_parameter(value: Any) -> Any:
+    # NumPy scalars (e.g. from DataFrame rows) are bound as their Python value
+    return value.item() if hasattr(value, "item") else value
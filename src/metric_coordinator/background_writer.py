@@ -0,0 +1,200 @@
+import os
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any
+from typing import Optional
+
+import pandas as pd
+
+
+class BackgroundWriter:
+    """
+    Base of the queues writing batches from a background thread in put order (WriteBehindBuffer, EmitQueue).
+    A failed write is retried every RETRY_DELAY seconds. After max_retries failed attempts (or one while closing),
+    the batch is pickled to dead_letter_dir and dropped, so it cannot hold up the batches behind it.
+    Subclasses hold the pending batches and implement the _has_pending, _take_batch, _write_batch
+    and _on_batch_* hooks: _take_batch removes the next batch from the pending ones and _on_batch_failed
+    puts it back. The hooks are called with the lock held, except _load_batch, _write_batch
+    and _on_batch_dropped, which may do I/O.
+    """
+
+    RETRY_DELAY = 1.0
+
+    def __init__(
+        self,
+        name: str,
+        thread_name: str,
+        max_retries: int = 5,
+        dead_letter_dir: str = None,
+        close_timeout: float = 30.0,
+    ) -> None:
+        if max_retries < 1:
+            raise ValueError(f"max_retries ({max_retries}) must be at least 1")
+        self.name = name
+        self.max_retries = max_retries
+        self.dead_letter_dir = dead_letter_dir
+        self.close_timeout = close_timeout
+        self._condition = threading.Condition()
+        # The batch taken by the thread, until it is written or dropped
+        self._writing_batch: Any = None
+        self._flush_requests = 0
+        self._retry_time = 0.0
+        self._failed_attempts = 0
+        self._error: Optional[Exception] = None
+        self._closed = False
+        self._dead_letter_count = 0
+        self._reported_dead_letter_count = 0
+        self._thread = threading.Thread(target=self._run, name=thread_name, daemon=True)
+        self._thread.start()
+
+    def flush(self, timeout: float = None) -> None:
+        """
+        Waits until every batch put so far is written or dead-lettered, for at most timeout seconds.
+        Raises a ValueError when it times out or when batches were dead-lettered since the previous flush.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._flush_requests += 1
+            self._retry_time = 0.0
+            self._condition.notify_all()
+            try:
+                while self._has_pending() or self._writing_batch is not None:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise ValueError(f"Timed out flushing {self.name} after {timeout}s ({self._error})")
+                    self._condition.wait(timeout=remaining)
+            finally:
+                self._flush_requests -= 1
+            dead_letter_count = self._dead_letter_count - self._reported_dead_letter_count
+            self._reported_dead_letter_count = self._dead_letter_count
+            if dead_letter_count > 0:
+                message = f"{dead_letter_count} batches moved to {self.dead_letter_dir} ({self._error})"
+                raise ValueError(f"Failed to flush {self.name}: {message}")
+
+    def close(self, timeout: float = None) -> None:
+        """
+        Drains the queue for at most timeout seconds (close_timeout by default), then stops the thread
+        even if the drain fails. The batches still waiting at that point are dead-lettered, a write still
+        running at the deadline is abandoned to the (daemon) thread. Both are reported with a ValueError.
+        """
+        timeout = self.close_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        try:
+            self.flush(timeout)
+        finally:
+            with self._condition:
+                self._closed = True
+                batches = []
+                while self._has_pending():
+                    batches.append(self._take_batch())
+                self._condition.notify_all()
+            for batch in batches:
+                self._drop_batch(batch, self._load_batch_or_none(batch))
+            with self._condition:
+                self._dead_letter_count += len(batches)
+                self._reported_dead_letter_count = self._dead_letter_count
+                writing = self._writing_batch is not None
+            # An idle thread exits right away, a running write is only waited for until the deadline
+            self._thread.join(max(deadline - time.monotonic(), 0.0) if writing else None)
+            hung = self._thread.is_alive()
+            if batches or hung:
+                raise ValueError(
+                    f"Failed to close {self.name}: {len(batches)} batches moved to {self.dead_letter_dir}"
+                    f"{', a write is still running' if hung else ''} ({self._error})"
+                )
+
+    def _has_pending(self) -> bool:
+        raise NotImplementedError
+
+    def _is_batch_ready(self) -> bool:
+        return self._has_pending() and (self._closed or time.monotonic() >= self._retry_time)
+
+    def _get_wait_time(self) -> Optional[float]:
+        return max(self._retry_time - time.monotonic(), 0.0) if self._has_pending() else None
+
+    def _take_batch(self) -> Any:
+        raise NotImplementedError
+
+    def _load_batch(self, batch: Any) -> Any:
+        return batch
+
+    def _write_batch(self, data: Any) -> None:
+        raise NotImplementedError
+
+    def _on_batch_written(self, batch: Any, data: Any, seconds: float) -> None:
+        raise NotImplementedError
+
+    def _on_batch_failed(self, batch: Any) -> None:
+        raise NotImplementedError
+
+    def _on_batch_dropped(self, batch: Any) -> None:
+        raise NotImplementedError
+
+    def _load_batch_or_none(self, batch: Any) -> Any:
+        try:
+            return self._load_batch(batch)
+        except Exception as e:
+            print(f"Failed to load batch of {self.name}: {e}")
+            return None
+
+    def _drop_batch(self, batch: Any, data: Any) -> None:
+        # Called without the lock, so that pickling the batch does not block put
+        self._dead_letter(data)
+        self._on_batch_dropped(batch)
+
+    def _dead_letter(self, data: Any) -> None:
+        if data is None:
+            print(f"Dropped unreadable batch of {self.name}")
+            return
+        with self._condition:
+            if self.dead_letter_dir is None:
+                self.dead_letter_dir = tempfile.mkdtemp(prefix=f"{self.name}_dead_letter_")
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        path = os.path.join(self.dead_letter_dir, f"{uuid.uuid4().hex}.pkl")
+        try:
+            pd.to_pickle(data, path)
+            print(f"Moved failing batch of {self.name} to {path} ({self._error})")
+        except Exception as e:
+            print(f"Failed to dead-letter batch of {self.name} to {path}: {e}")
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._is_batch_ready():
+                    if self._closed and not self._has_pending():
+                        return
+                    self._condition.wait(timeout=self._get_wait_time())
+                batch = self._take_batch()
+                self._writing_batch = batch
+            start = time.perf_counter()
+            data = None
+            try:
+                data = self._load_batch(batch)
+                self._write_batch(data)
+                error = None
+            except Exception as e:
+                error = e
+            dead_letter = False
+            with self._condition:
+                if error is None:
+                    self._failed_attempts = 0
+                    self._on_batch_written(batch, data, time.perf_counter() - start)
+                else:
+                    self._error = error
+                    self._failed_attempts += 1
+                    if self._closed or data is None or self._failed_attempts >= self.max_retries:
+                        self._failed_attempts = 0
+                        dead_letter = True
+                    else:
+                        attempt = f"{self._failed_attempts}/{self.max_retries}"
+                        print(f"Error writing batch of {self.name} (attempt {attempt}), retrying: {error}")
+                        self._on_batch_failed(batch)
+                        self._retry_time = time.monotonic() + self.RETRY_DELAY
+            if dead_letter:
+                self._drop_batch(batch, data)
+            with self._condition:
+                self._writing_batch = None
+                self._dead_letter_count += dead_letter
+                self._condition.notify_all()
@@ -1,6 +1,10 @@
+from typing import Dict
+from typing import List
+
+import numpy as np
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 from pydantic_settings import SettingsConfigDict
-from pydantic import BaseModel
 
 
 class KafkaConfig(BaseModel):
@@ -8,12 +12,40 @@ class KafkaConfig(BaseModel):
     topic_prefix: str = ""
 
 
+class TableLayout(BaseModel):
+    """
+    Physical layout of a metric table, e.g.
+    {"partition_by": "toYYYYMM(toDateTime(timestamp_server))", "version_column": "timestamp_server",
+     "codecs": {"timestamp_server": "Delta, ZSTD"}, "low_cardinality": ["server"]}
+    order_by reorders the key columns (the deduplication key), background merges only deduplicate within a partition.
+    """
+
+    order_by: List[str] | None = None
+    partition_by: str | None = None
+    version_column: str | None = None
+    codecs: Dict[str, str] = {}
+    low_cardinality: List[str] = []
+    ttl: str | None = None
+
+
 class Settings(BaseSettings):
     CLICKHOUSE_HOST: str = "localhost"
     CLICKHOUSE_HTTP_PORT: str = "8124"
     CLICKHOUSE_USERNAME: str = "default"
     CLICKHOUSE_PASSWORD: str = ""
     CLICKHOUSE_DATABASE: str = "default"
+    CLICKHOUSE_POOL_SIZE: int = 4
+    CLICKHOUSE_POOL_IDLE_TIMEOUT: float = 300
+    CLICKHOUSE_POOL_HEALTH_CHECK_INTERVAL: float = 30
+    CLICKHOUSE_TRANSPORT: str = "pandas"
+    CLICKHOUSE_READ_STRATEGY: str = "final"
+    CLICKHOUSE_LOAD_PARTITIONS: int = 1
+    CLICKHOUSE_LOAD_PARTITION_BY: str = "key"
+    CLICKHOUSE_LATEST_ROWS_STRATEGY: str = "limit_by"
+    CLICKHOUSE_LATEST_STATE_VIEWS: bool = False
+    CLICKHOUSE_EMIT_WORKERS: int = 4
+    # Table layout per metric name, overrides the table_layout declared on the metric Meta
+    CLICKHOUSE_TABLE_LAYOUTS: Dict[str, TableLayout] = {}
 
     MT_SERVER: str = "37.27.126.212:443"
     MT_GROUPS: str = "demo\\duc_dev\\account_metrics"
@@ -30,6 +62,34 @@ class Settings(BaseSettings):
     )
 
     INTERVAL: float = 0.5
+    EMIT_ASYNC: bool = False
+    EMIT_QUEUE_MAX_BATCHES: int = 4
+    EMIT_QUEUE_OVERFLOW: str = "block"
+    EMIT_SPILL_DIR: str | None = None
+    EMIT_MAX_RETRIES: int = 5
+    EMIT_DEAD_LETTER_DIR: str | None = None
+    EMIT_CLOSE_TIMEOUT: float = 30.0
+
+    CACHE_LOAD_MODE: str = "eager"
+    CACHE_INCREMENTAL_REFRESH: bool = True
+    CACHE_FULL_RELOAD_INTERVAL: int | None = 86400
+    CACHE_BACKGROUND_REFRESH: bool = False
+    CACHE_MAX_STALENESS: int | None = 3600
+    CACHE_FALLBACK_MEMO_SIZE: int = 10000
+    CACHE_FALLBACK_MEMO_TTL: int = 300
+    CACHE_WRITE_BEHIND: bool = False
+    CACHE_WRITE_BATCH_ROWS: int = 10000
+    CACHE_WRITE_MAX_DELAY: float = 1.0
+    CACHE_WRITE_MAX_PENDING_ROWS: int = 100000
+    CACHE_WRITE_MAX_RETRIES: int = 5
+    CACHE_WRITE_DEAD_LETTER_DIR: str | None = None
+    CACHE_LOAD_BLOCK_SIZE: int | None = 100000
+    CACHE_LOAD_LATEST_STATE: bool = False
+    CACHE_MAX_ROWS_PER_SHARD: int | None = None
+    CACHE_MAX_TOTAL_ROWS: int | None = None
+    CACHE_MAX_TOTAL_BYTES: int | None = None
+    # Columns read per metric name, e.g. {"MT5DealDaily": ["Balance"]}, overrides the columns declared by the calculators
+    METRIC_COLUMNS: Dict[str, List[str]] = {}
 
     NATS_CONNECTION: str = "nats://localhost:4222"
     TOPIC_PREFIX: str = "test."
@@ -49,7 +109,13 @@ type_map = {
     "float": "Float64",
     "str": "String",
     "date": "Date32",
-    "datetime": "DateTime64",
+    # The precision is explicit so the type can also be parsed by clickhouse_connect (insert plans)
+    "datetime": "DateTime64(3)",
+}
+
+numpy_type_map = {
+    "int": np.int64,
+    "float": np.float64,
 }
 
 MIN_TIME = 31536000
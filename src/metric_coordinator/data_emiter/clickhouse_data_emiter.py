@@ -1,51 +1,213 @@
-import datetime
-from typing import Dict, Literal, List, Type, Annotated
-import pandas as pd
-from pydantic.alias_generators import to_snake
+import concurrent.futures
+import threading
+from typing import Annotated
+from typing import Dict
+from typing import List
+from typing import Literal
+from typing import Type
 
+import numpy as np
+import pandas as pd
 from account_metrics.metric_model import MetricData
+from clickhouse_connect.driver.insert import InsertContext
+from pydantic.alias_generators import to_snake
 
 from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
+from metric_coordinator.configs import MIN_TIME
+from metric_coordinator.configs import TableLayout
+from metric_coordinator.configs import type_map
+from metric_coordinator.datastore.metric_schema import coerce_metric_dataframe
+from metric_coordinator.datastore.metric_schema import get_metric_sharding_columns
 from metric_coordinator.model import BaseDataEmitter
-from metric_coordinator.configs import MIN_TIME, type_map
+
+
+class InsertPlan:
+    """
+    Compiled once per metric: its table, the columns in metric field order with their ClickHouse types
+    and an insert context built from them
+    """
+
+    def __init__(
+        self,
+        table: str,
+        column_names: List[str],
+        column_type_names: List[str],
+        context: InsertContext,
+    ) -> None:
+        self.table = table
+        self.column_names = column_names
+        self.column_type_names = column_type_names
+        self.context = context
+        # The insert context holds the data being inserted, so it is used by one insert at a time
+        self.lock = threading.Lock()
 
 
 class ClickhouseEmitter(BaseDataEmitter):
 
-    def __init__(self, client: ClickhouseClient, server: str = None, metric_table_names: Dict[type[MetricData], str] = {}) -> None:
+    def __init__(
+        self,
+        client: ClickhouseClient,
+        server: str = None,
+        metric_table_names: Dict[type[MetricData], str] = {},
+        latest_state_views: bool = False,
+        table_layouts: Dict[str, TableLayout] = None,
+        insert_workers: int = 4,
+    ) -> None:
         self.client = client
         self.metric_table_names = metric_table_names
-        self.last_retrieve_timestamp = MIN_TIME
         self.server = server
+        # Also maintain a {table}_latest table with the latest row per sharding key of each metric, see ClickhouseDatastore
+        self.latest_state_views = latest_state_views
+        # Table layout per metric name, metrics without one use the table_layout of their Meta (if any)
+        self.table_layouts = table_layouts or {}
+        # The metric tables of a batch are inserted concurrently on up to insert_workers threads (1 inserts them in turn),
+        # the client pool size caps the actual parallelism
+        self.insert_workers = max(insert_workers, 1)
+        self._insert_executor: concurrent.futures.ThreadPoolExecutor = None
+        # Max emitted timestamp_server per metric and login of the server, seeded from the table once by initialize_metric
+        # and then kept up to date with the inserted rows, so get_last_emit_timestamp does not query ClickHouse
+        self._watermarks: Dict[type[MetricData], Dict[int, int]] = {}
+        self._metric_watermarks: Dict[type[MetricData], int] = {}
+        self._watermark_lock = threading.Lock()
+        self._insert_plans: Dict[type[MetricData], InsertPlan] = {}
 
     def emit(self, data: Dict[type[MetricData], pd.DataFrame]) -> Literal[True]:
-        is_emitted = False
-        for metric, calculated_metrics in data.items():
-            metric_name = self.get_metric_name(metric)
-
-            if calculated_metrics.empty:
-                continue
-            self.client.insert_df(metric_name, calculated_metrics)
-            print(f"Inserted {calculated_metrics.shape[0]} rows into {metric_name}")
-            is_emitted = True
-        if is_emitted:
-            # TODO: check if we should use utc time
-            self.last_retrieve_timestamp = int(datetime.datetime.now().timestamp())
-        return is_emitted
+        """
+        Inserts every metric of data into its table, raises a ValueError naming the tables that failed
+        (the other tables are inserted, re-emitting them only adds duplicate versions that are merged away)
+        """
+        inserts = {metric: df for metric, df in data.items() if not df.empty}
+        if not inserts:
+            return False
+        if self.insert_workers == 1 or len(inserts) == 1:
+            errors = {}
+            for metric, calculated_metrics in inserts.items():
+                try:
+                    self._insert(metric, calculated_metrics)
+                except Exception as e:
+                    errors[self.get_metric_name(metric)] = e
+        else:
+            if self._insert_executor is None:
+                self._insert_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.insert_workers)
+            futures = {}
+            for metric, df in inserts.items():
+                futures[self.get_metric_name(metric)] = self._insert_executor.submit(self._insert, metric, df)
+            errors = {name: future.exception() for name, future in futures.items() if future.exception() is not None}
+        if errors:
+            failed = ", ".join(f"{name} ({error})" for name, error in errors.items())
+            raise ValueError(f"Failed to insert into {failed}")
+        return True
+
+    @property
+    def last_retrieve_timestamp(self) -> Annotated[int, "timestamp"]:
+        # Latest timestamp_server emitted for any metric
+        with self._watermark_lock:
+            return max(self._metric_watermarks.values(), default=MIN_TIME)
+
+    def close(self) -> None:
+        if self._insert_executor is not None:
+            self._insert_executor.shutdown(wait=True)
+            self._insert_executor = None
+
+    def _insert(self, metric: type[MetricData], calculated_metrics: pd.DataFrame) -> None:
+        plan = self._insert_plans.get(metric)
+        if plan is None:
+            plan = self._insert_plans[metric] = self._compile_insert_plan(metric)
+        columns = self._get_insert_columns(metric, plan, calculated_metrics)
+        with plan.lock:
+            if not self.client.insert_columns(plan.context, columns):
+                raise ValueError("insert failed")
+        print(f"Inserted {calculated_metrics.shape[0]} rows into {plan.table}")
+        self._update_watermarks(metric, calculated_metrics)
+
+    def _compile_insert_plan(self, metric: type[MetricData]) -> InsertPlan:
+        table = self.get_metric_name(metric)
+        column_types = self._get_column_types(metric, self.get_table_layout(metric))
+        column_names = list(column_types)
+        column_type_names = list(column_types.values())
+        context = self.client.create_insert_context(table, column_names, column_type_names)
+        return InsertPlan(table, column_names, column_type_names, context)
+
+    def _get_insert_columns(
+        self,
+        metric: type[MetricData],
+        plan: InsertPlan,
+        calculated_metrics: pd.DataFrame,
+    ) -> List[np.ndarray]:
+        # Every column is checked and converted to its get_metric_dtypes dtype (e.g. fractional floats are rejected
+        # for int columns instead of truncated), missing columns are filled with the field default
+        arrays = coerce_metric_dataframe(metric, calculated_metrics)
+        return [arrays[col] for col in plan.column_names]
 
     def initialize_metric(self, metric: type[MetricData]) -> Literal[True]:
-        self._create_metric_if_not_exist(metric)
+        if self._create_metric_if_not_exist(metric) and self.latest_state_views:
+            self._create_latest_state_view_if_not_exist(metric)
+        self._insert_plans[metric] = self._compile_insert_plan(metric)
+        try:
+            self._seed_watermarks(metric)
+        except Exception as e:
+            print(f"Failed to seed the emit watermarks of {metric.__name__}, retried by get_last_emit_timestamp: {e}")
 
     def get_last_emit_timestamp(self, metric: type[MetricData], logins: list[int] = []) -> Annotated[int, "timestamp"]:
-        metric_name = self.get_metric_name(metric)
+        if metric not in self._metric_watermarks:
+            self._seed_watermarks(metric)
+        with self._watermark_lock:
+            if not logins:
+                return self._metric_watermarks[metric]
+            watermarks = self._watermarks[metric]
+            return max([watermarks.get(login, MIN_TIME) for login in logins] + [MIN_TIME])
 
-        query = (
-            f"SELECT max(timestamp_server) FROM {metric_name} FINAL WHERE server='{self.get_server()}' AND login IN ({','.join(map(str, logins))})"
-            if logins
-            else f"SELECT max(timestamp_server) FROM {metric_name} FINAL WHERE server='{self.get_server()}'"
-        )
+    def _get_login_column(self, metric: type[MetricData]) -> str | None:
+        for col in ("login", "Login"):
+            if col in metric.model_fields:
+                return col
+        return None
 
-        return max(self.client.query_ddl(query).first_item.get("max(timestamp_server)"), MIN_TIME)
+    def _seed_watermarks(self, metric: type[MetricData]) -> None:
+        """
+        One grouped query per metric, e.g.
+        SELECT login, max(timestamp_server) FROM mt5_deal WHERE server = {server:String} GROUP BY login
+        (the max version is the same with or without deduplication, so it does not need FINAL).
+        Query errors are raised and nothing is stored, so a failed seed is not taken for an empty table.
+        """
+        metric_name = self.get_metric_name(metric)
+        login_column = self._get_login_column(metric)
+        select = f"{login_column} AS login, " if login_column else ""
+        group_by = f" GROUP BY {login_column}" if login_column else ""
+        query = f"""
+        SELECT {select}max(timestamp_server) AS timestamp_server FROM {metric_name}
+        WHERE server = {{server:String}}{group_by}
+        """
+        df = self.client.query_df(query, parameters={"server": self.get_server()}, raise_errors=True)
+        watermarks = {}
+        if login_column and not df.empty:
+            logins = df["login"].astype("int64").tolist()
+            watermarks = dict(zip(logins, df["timestamp_server"].astype("int64").tolist(), strict=True))
+        metric_watermark = MIN_TIME
+        if not df.empty:
+            metric_watermark = max(int(df["timestamp_server"].max()), MIN_TIME)
+        with self._watermark_lock:
+            self._watermarks[metric] = watermarks
+            self._metric_watermarks[metric] = metric_watermark
+
+    def _update_watermarks(self, metric: type[MetricData], calculated_metrics: pd.DataFrame) -> None:
+        if metric not in self._metric_watermarks or "timestamp_server" not in calculated_metrics.columns:
+            return
+        if "server" in calculated_metrics.columns:
+            calculated_metrics = calculated_metrics[calculated_metrics["server"] == self.get_server()]
+        if calculated_metrics.empty:
+            return
+        login_column = self._get_login_column(metric)
+        login_maxes = {}
+        if login_column and login_column in calculated_metrics.columns:
+            login_maxes = calculated_metrics.groupby(login_column)["timestamp_server"].max().to_dict()
+        metric_max = int(calculated_metrics["timestamp_server"].max())
+        with self._watermark_lock:
+            watermarks = self._watermarks[metric]
+            for login, timestamp in login_maxes.items():
+                if login not in watermarks or timestamp > watermarks[login]:
+                    watermarks[int(login)] = int(timestamp)
+            self._metric_watermarks[metric] = max(self._metric_watermarks[metric], metric_max)
 
     def get_server(self) -> str:
         # TODO: update if more than one server are used
@@ -55,28 +217,102 @@ class ClickhouseEmitter(BaseDataEmitter):
         metric_name = to_snake(metric.__name__) if not self.metric_table_names else self.metric_table_names[metric]
         return metric_name
 
+    def get_table_layout(self, metric: type[MetricData]) -> TableLayout:
+        if metric.__name__ in self.table_layouts:
+            return self.table_layouts[metric.__name__]
+        layout = getattr(getattr(metric, "Meta", None), "table_layout", None)
+        if layout is None:
+            return TableLayout()
+        return layout if isinstance(layout, TableLayout) else TableLayout(**layout)
+
+    def _get_column_types(self, metric: type[MetricData], layout: TableLayout) -> Dict[str, str]:
+        """
+        e.g. {"server": "LowCardinality(String)", "timestamp_server": "Int64"} with low_cardinality ["server"]
+        """
+        unknown = [k for k in list(layout.codecs) + layout.low_cardinality if k not in metric.model_fields]
+        if unknown:
+            raise ValueError(f"Unknown columns {', '.join(unknown)} in the table layout of {metric.__name__}")
+        column_types = {}
+        for k, v in metric.model_fields.items():
+            column_type = type_map.get(v.annotation.__name__)
+            column_types[k] = f"LowCardinality({column_type})" if k in layout.low_cardinality else column_type
+        return column_types
+
+    def _get_column_definitions(self, metric: type[MetricData], layout: TableLayout) -> str:
+        """
+        e.g. server String, timestamp_server Int64
+        with low_cardinality ["server"] and codecs {"timestamp_server": "Delta, ZSTD"}
+        -> server LowCardinality(String), timestamp_server Int64 CODEC(Delta, ZSTD)
+        """
+        definitions = []
+        for k, column_type in self._get_column_types(metric, layout).items():
+            if k in layout.codecs:
+                column_type = f"{column_type} CODEC({layout.codecs[k]})"
+            definitions.append(f"{k} {column_type}")
+        return ", ".join(definitions)
+
     def _create_metric_if_not_exist(self, metric: type[MetricData]) -> Literal[True]:
         for k, v in metric.model_fields.items():
             if v.annotation.__name__ not in type_map:
                 raise ValueError(f"Unsupported type {v.annotation.__name__} for field {k}")
 
         metric_name = self.get_metric_name(metric)
-        metric_fields = ", ".join([f"{k} {type_map.get(v.annotation.__name__)}" for k, v in metric.model_fields.items()])
-        keys = ", ".join([k for k, v in metric.model_fields.items() if "key" in v.metadata])
+        layout = self.get_table_layout(metric)
+        metric_fields = self._get_column_definitions(metric, layout)
+        keys = [k for k, v in metric.model_fields.items() if "key" in v.metadata]
+        if layout.order_by:
+            if sorted(layout.order_by) != sorted(keys):
+                raise ValueError(f"order_by of {metric.__name__} must be a permutation of its key columns {keys}")
+            keys = layout.order_by
 
-        if not self.client.create_metric_if_not_exist(metric_name, metric_fields, keys):
+        if not self.client.create_metric_if_not_exist(
+            metric_name,
+            metric_fields,
+            ", ".join(keys),
+            partition_by=layout.partition_by,
+            version_column=layout.version_column,
+            ttl=layout.ttl,
+        ):
             # TODO: do a proper logging
             print(f"Failed to create metric {metric_name}")
             return False
         return True
 
-    def drop_metric(self, metric: type[MetricData]) -> Literal[True]:
+    def _create_latest_state_view_if_not_exist(self, metric: type[MetricData]) -> Literal[True]:
+        sharding_columns = get_metric_sharding_columns(metric)
+        if not sharding_columns:
+            return False
         metric_name = self.get_metric_name(metric)
-        self.client.drop_tables([metric_name])
+        metric_fields = self._get_column_definitions(metric, self.get_table_layout(metric))
+        if not self.client.create_latest_state_view_if_not_exist(metric_name, metric_fields, sharding_columns):
+            print(f"Failed to create latest state view of metric {metric_name}")
+            return False
+        return True
+
+    def drop_metric(self, metric: type[MetricData]) -> Literal[True]:
+        self.client.drop_tables(self._get_metric_tables(metric))
+        self._clear_metric_state([metric])
 
     def drop_metrics(self, metrics: List[MetricData]) -> Literal[True]:
-        metric_names = [self.get_metric_name(metric) for metric in metrics]
+        metric_names = [table for metric in metrics for table in self._get_metric_tables(metric)]
         self.client.drop_tables(metric_names)
+        self._clear_metric_state(metrics)
+
+    def _clear_metric_state(self, metrics: List[MetricData]) -> None:
+        for metric in metrics:
+            self._insert_plans.pop(metric, None)
+        with self._watermark_lock:
+            for metric in metrics:
+                self._watermarks.pop(metric, None)
+                self._metric_watermarks.pop(metric, None)
+
+    def _get_metric_tables(self, metric: type[MetricData]) -> List[str]:
+        metric_name = self.get_metric_name(metric)
+        if not self.latest_state_views:
+            return [metric_name]
+        # The view goes first, so nothing is inserted into the latest state table while it is dropped
+        latest_table = self.client.get_latest_state_table_name(metric_name)
+        return [f"{latest_table}_mv", latest_table, metric_name]
 
     def delete_logins_from_metric(self, logins: list[int], metric: type[MetricData], from_time: int | None = None) -> Literal[True]:
         metric_name = self.get_metric_name(metric)
@@ -84,6 +320,8 @@ class ClickhouseEmitter(BaseDataEmitter):
                 """
         if self.client.query_dml(query):
             print(f"Deleted rows from {metric_name} where timestamp_server >= {from_time}")
+            # The deleted rows may hold the watermarks, they are seeded again from what is left
+            self._seed_watermarks(metric)
 
     def delete_logins_metrics(self, logins: list[int], metrics: List[MetricData], from_time: int | None = None) -> Literal[True]:
         for metric in metrics:
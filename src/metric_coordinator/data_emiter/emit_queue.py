@@ -0,0 +1,174 @@
+import collections
+import os
+import tempfile
+import time
+import uuid
+from typing import Any
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Literal
+from typing import Optional
+from typing import Tuple
+from typing import Type
+
+import pandas as pd
+from account_metrics.metric_model import MetricData
+
+from metric_coordinator.background_writer import BackgroundWriter
+
+# (put time, batch, None) for a batch in memory, (put time, None, file) for a spilled one
+EmitBatch = Tuple[float, Optional[Dict[Type[MetricData], pd.DataFrame]], Optional[str]]
+
+
+class EmitQueue(BackgroundWriter):
+    """
+    Emits the metric results put into it from a background thread, in put order, so the next batch can be computed
+    while the previous one is emitted. A failed emit is retried up to max_retries times before the batch is
+    dead-lettered, and close drains the batches put so far before stopping the thread. When max_batches batches
+    are waiting, put applies the overflow policy:
+    "block" waits for a free slot (backpressure), "drop_oldest" drops the oldest batch not being emitted,
+    "spill" pickles the batch to spill_dir, spilled batches are read back and emitted after the ones in memory.
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop_oldest", "spill")
+
+    def __init__(
+        self,
+        emit: Callable[[Dict[Type[MetricData], pd.DataFrame]], Any],
+        name: str,
+        max_batches: int = 4,
+        overflow_policy: Literal["block", "drop_oldest", "spill"] = "block",
+        spill_dir: str = None,
+        max_retries: int = 5,
+        dead_letter_dir: str = None,
+        close_timeout: float = 30.0,
+    ) -> None:
+        if max_batches < 1:
+            raise ValueError(f"max_batches ({max_batches}) must be at least 1")
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            policies = self.OVERFLOW_POLICIES
+            raise ValueError(f"Unsupported overflow policy {overflow_policy}, expected one of {policies}")
+        self.emit = emit
+        self.max_batches = max_batches
+        self.overflow_policy = overflow_policy
+        self.spill_dir = spill_dir
+        if overflow_policy == "spill" and spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix=f"{name}_emit_spill_")
+        # (put time, batch) in memory, then (put time, file) spilled to disk, the oldest batch is emitted first.
+        # The batch being emitted is taken out of its deque, and put back at the front if the emit fails.
+        self._pending: Deque[Tuple[float, Dict[Type[MetricData], pd.DataFrame]]] = collections.deque()
+        self._spilled: Deque[Tuple[float, str]] = collections.deque()
+        self._put_batch_count = 0
+        self._emitted_batch_count = 0
+        self._emitted_row_count = 0
+        self._emit_seconds = 0.0
+        self._dropped_batch_count = 0
+        self._spilled_batch_count = 0
+        super().__init__(
+            name,
+            f"{name}EmitQueue",
+            max_retries=max_retries,
+            dead_letter_dir=dead_letter_dir,
+            close_timeout=close_timeout,
+        )
+
+    def put(self, data: Dict[Type[MetricData], pd.DataFrame]) -> None:
+        with self._condition:
+            if self._closed:
+                raise ValueError(f"Emit queue {self.name} is closed")
+            self._put_batch_count += 1
+            # Once a batch is spilled the next ones are spilled too, so they are emitted in put order
+            full = self._get_memory_batch_count() >= self.max_batches
+            if self.overflow_policy == "spill" and (self._spilled or full):
+                self._spilled.append((time.monotonic(), self._spill(data)))
+                self._spilled_batch_count += 1
+                self._condition.notify_all()
+                return
+            while self._get_memory_batch_count() >= self.max_batches:
+                if self.overflow_policy == "drop_oldest" and self._drop_oldest():
+                    break
+                self._condition.wait()
+            self._pending.append((time.monotonic(), data))
+            self._condition.notify_all()
+
+    def get_stats(self) -> dict:
+        """
+        lag_seconds is the age of the oldest batch waiting to be emitted,
+        rows_per_second the emitted rows over the time spent emitting them
+        """
+        with self._condition:
+            put_times = [batches[0][0] for batches in (self._pending, self._spilled) if batches]
+            if self._writing_batch is not None:
+                put_times.append(self._writing_batch[0])
+            oldest = min(put_times) if put_times else None
+            return {
+                "pending_batches": len(self._pending) + len(self._spilled) + (self._writing_batch is not None),
+                "put_batches": self._put_batch_count,
+                "emitted_batches": self._emitted_batch_count,
+                "emitted_rows": self._emitted_row_count,
+                "dropped_batches": self._dropped_batch_count,
+                "spilled_batches": self._spilled_batch_count,
+                "dead_letter_batches": self._dead_letter_count,
+                "lag_seconds": time.monotonic() - oldest if oldest is not None else 0.0,
+                "rows_per_second": self._emitted_row_count / self._emit_seconds if self._emit_seconds > 0 else 0.0,
+            }
+
+    def _get_memory_batch_count(self) -> int:
+        # The batch being emitted counts until it is emitted, unless it was read back from a spill file
+        return len(self._pending) + (self._writing_batch is not None and self._writing_batch[2] is None)
+
+    def _drop_oldest(self) -> bool:
+        # The batch being emitted is not in _pending, so it cannot be dropped
+        if not self._pending:
+            return False
+        self._pending.popleft()
+        self._dropped_batch_count += 1
+        print(f"Emit queue {self.name} is full, dropped its oldest batch")
+        return True
+
+    def _spill(self, data: Dict[Type[MetricData], pd.DataFrame]) -> str:
+        path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.pkl")
+        pd.to_pickle(data, path)
+        return path
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending or self._spilled)
+
+    def _take_batch(self) -> EmitBatch:
+        if self._pending:
+            put_time, data = self._pending.popleft()
+            return put_time, data, None
+        put_time, spill_path = self._spilled.popleft()
+        return put_time, None, spill_path
+
+    def _load_batch(self, batch: EmitBatch) -> Dict[Type[MetricData], pd.DataFrame]:
+        _, data, spill_path = batch
+        return pd.read_pickle(spill_path) if data is None else data
+
+    def _write_batch(self, data: Dict[Type[MetricData], pd.DataFrame]) -> None:
+        self.emit(data)
+
+    def _on_batch_written(
+        self,
+        batch: EmitBatch,
+        data: Dict[Type[MetricData], pd.DataFrame],
+        seconds: float,
+    ) -> None:
+        self._on_batch_dropped(batch)
+        self._emitted_batch_count += 1
+        self._emitted_row_count += sum(len(df) for df in data.values() if isinstance(df, pd.DataFrame))
+        self._emit_seconds += seconds
+
+    def _on_batch_failed(self, batch: EmitBatch) -> None:
+        # Back at the front, it is emitted again after the retry delay
+        put_time, data, spill_path = batch
+        if spill_path is None:
+            self._pending.appendleft((put_time, data))
+        else:
+            self._spilled.appendleft((put_time, spill_path))
+
+    def _on_batch_dropped(self, batch: EmitBatch) -> None:
+        _, _, spill_path = batch
+        if spill_path is not None and os.path.exists(spill_path):
+            os.remove(spill_path)
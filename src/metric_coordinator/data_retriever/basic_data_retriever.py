@@ -1,13 +1,15 @@
+import abc
 import datetime
 import time
-from typing import Dict, Any, List
-import pandas as pd
-import abc
+from typing import Any
+from typing import Dict
+from typing import List
 
+import pandas as pd
 from account_metrics.metric_model import MetricData
 
-from metric_coordinator.model import BaseDataRetriever
 from metric_coordinator.metric_runner import MetricRunner
+from metric_coordinator.model import BaseDataRetriever
 
 
 class BasicDataRetriever(BaseDataRetriever, abc.ABC):
@@ -28,18 +30,22 @@ class BasicDataRetriever(BaseDataRetriever, abc.ABC):
         return self.retriever.get_last_retrieve_timestamp()
 
     def run(self, metric_runner: MetricRunner) -> None:
-        while True:
-            from_time = self.retriever.get_last_retrieve_timestamp()
-            to_time = int(datetime.now().timestamp())
-            input_data = self.retrieve_data(from_time, to_time, self.filters)
-            if not input_data["Deal"].empty:
-                number_data_received = {k: v.shape[0] for k, v in input_data.items()}
-                print(
-                    f"Retrieved {number_data_received} deals from: {self.retriever}, with filters: {self.filters},"
-                    f" from time: {from_time}, to time: {to_time}"
-                )
-
-            results = metric_runner.process_metrics(input_data)
-            metric_runner.emit_metrics(results)
-
-            time.sleep(self.interval)
+        try:
+            while True:
+                from_time = self.retriever.get_last_retrieve_timestamp()
+                to_time = int(datetime.now().timestamp())
+                input_data = self.retrieve_data(from_time, to_time, self.filters)
+                if not input_data["Deal"].empty:
+                    number_data_received = {k: v.shape[0] for k, v in input_data.items()}
+                    print(
+                        f"Retrieved {number_data_received} deals from: {self.retriever}, with filters: {self.filters},"
+                        f" from time: {from_time}, to time: {to_time}"
+                    )
+
+                results = metric_runner.process_metrics(input_data)
+                # Emitting runs in the background, the next batch is retrieved and computed meanwhile
+                metric_runner.emit_metrics(results)
+
+                time.sleep(self.interval)
+        finally:
+            metric_runner.close()
@@ -1,24 +1,47 @@
 import sys
 import traceback
-from typing import Annotated, List, Literal, Dict, Any
-from pydantic.alias_generators import to_snake
-import pandas as pd
-from datetime import datetime, time, timezone
+from datetime import datetime
+from datetime import time
+from datetime import timezone
+from typing import Annotated
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Literal
+from typing import Optional
+from typing import Sequence
+from typing import Type
 
-from account_metrics import MT5Deal, MT5DealDaily
+import pandas as pd
+from account_metrics import MT5Deal
+from account_metrics import MT5DealDaily
+from pydantic.alias_generators import to_snake
 
-from metric_coordinator.data_retriever.basic_data_retriever import BasicDataRetriever
 from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
+from metric_coordinator.api_client.query_builder import get_in_condition
 from metric_coordinator.configs import MIN_TIME
-from metric_coordinator.model import MetricData, SourceDatastore
+from metric_coordinator.data_retriever.basic_data_retriever import BasicDataRetriever
+from metric_coordinator.datastore.metric_schema import get_metric_key_columns
+from metric_coordinator.datastore.metric_schema import get_metric_projection
 from metric_coordinator.metric_runner import MetricRunner
+from metric_coordinator.model import MetricData
+from metric_coordinator.model import SourceDatastore
 
 
 class ClickhouseDataRetriever(BasicDataRetriever, SourceDatastore):
-    def __init__(self, filters: Dict[str, Any], client: ClickhouseClient, server: str, table_name: str) -> None:
+    def __init__(
+        self,
+        filters: Dict[str, Any],
+        client: ClickhouseClient,
+        server: str,
+        table_name: str,
+        columns: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
         super().__init__(filters, server)
         self.client = client
         self.table_name = table_name
+        # Column projection per retrieved data, e.g. {"Deal": ["Login", "Time", "Profit"]}, all columns when not set
+        self.columns = columns or {}
 
     def __str__(self) -> str:
         return f"Clickhouse({self.client},{self.get_server()},{self.retriave_table})"
@@ -76,16 +99,18 @@ class ClickhouseDataRetriever(BasicDataRetriever, SourceDatastore):
         if skip_retrieve:
             return pd.DataFrame(columns=["Login", "Time", "PositionID"])
 
+        # Values are bound server-side, the logins as a single array parameter
+        parameters = {"from_time": from_time, "to_time": to_time, "server": self.get_server()}
+        deal_where = "WHERE TimeUTC >= {from_time:Int64} AND TimeUTC <= {to_time:Int64} AND server = {server:String}"
         if "group_by" in filters and filters["group_by"] == "Login":
-            logins = filters["logins"]
-            deal_query = f"SELECT * FROM {table_name} FINAL WHERE TimeUTC >= {from_time} AND TimeUTC <= {to_time} AND server='{self.get_server()}' AND login IN ({','.join(map(str, logins))})"
-        else:
-            deal_query = (
-                f"SELECT * FROM {table_name} FINAL WHERE TimeUTC >= {from_time} AND TimeUTC <= {to_time} AND server='{self.get_server()}'"
-            )
-        df_deal = self.client.query_df(deal_query)
+            parameters["logins"] = [int(login) for login in filters["logins"]]
+            deal_where = f"{deal_where} AND {get_in_condition(('login',), ('Int64',), 'logins')}"
+        columns = self._get_projection("Deal", MT5Deal)
+        df_deal = self.client.query_deduplicated_df(
+            table_name, get_metric_key_columns(MT5Deal), deal_where, columns=columns, parameters=parameters
+        )
         if not isinstance(df_deal, pd.DataFrame) or df_deal.empty:
-            return pd.DataFrame(columns=MT5Deal.model_fields.keys())
+            return pd.DataFrame(columns=columns or MT5Deal.model_fields.keys())
         return df_deal
 
     def _retrieve_history(
@@ -96,20 +121,37 @@ class ClickhouseDataRetriever(BasicDataRetriever, SourceDatastore):
 
         # TODO: consider add timestamp to the history data
         # TODO: fix group_by group
+        parameters = {"from_time": MIN_TIME, "to_time": to_time}
         if "group_by" in filters and filters["group_by"] == "Group":
-            history_query = (
-                f"SELECT * FROM {table_name} FINAL WHERE timestamp_utc >= {MIN_TIME} AND timestamp_utc <= {to_time} ORDER BY timestamp_utc"
-            )
+            history_where = "WHERE timestamp_utc >= {from_time:Int64} AND timestamp_utc <= {to_time:Int64}"
         elif "group_by" in filters and filters["group_by"] == "Login":
-            logins = filters["logins"]
-            history_query = f"SELECT * FROM {table_name} FINAL WHERE timestamp_utc >= {MIN_TIME} AND timestamp_utc <= {to_time} AND login IN ({','.join(map(str, logins))}) ORDER BY timestamp_utc"
+            parameters["logins"] = [int(login) for login in filters["logins"]]
+            history_where = (
+                "WHERE timestamp_utc >= {from_time:Int64} AND timestamp_utc <= {to_time:Int64} "
+                f"AND {get_in_condition(('login',), ('Int64',), 'logins')}"
+            )
 
-        df_history = self.client.query_df(history_query)
+        columns = self._get_projection("History", MT5DealDaily, ["Datetime", "timestamp_utc"])
+        df_history = self.client.query_deduplicated_df(
+            table_name,
+            get_metric_key_columns(MT5DealDaily),
+            history_where,
+            columns=columns,
+            order_by=["timestamp_utc"],
+            parameters=parameters,
+        )
         if not isinstance(df_history, pd.DataFrame) or df_history.empty:
-            return pd.DataFrame(columns=MT5DealDaily.model_fields.keys())
+            return pd.DataFrame(columns=columns or MT5DealDaily.model_fields.keys())
         df_history["Date"] = pd.to_datetime(df_history["Datetime"], unit="s").dt.date
         return df_history
 
+    def _get_projection(
+        self, retrieve_data: str, metric: Type[MetricData], required_columns: Optional[Sequence[str]] = None
+    ) -> Optional[List[str]]:
+        if retrieve_data not in self.columns:
+            return None
+        return get_metric_projection(metric, self.columns[retrieve_data], required_columns)
+
     def get_last_retrieve_timestamp(self) -> Annotated[int, "timestamp"]:
         return self.last_retrieve_timestamp
 
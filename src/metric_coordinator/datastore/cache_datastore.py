@@ -1,83 +1,547 @@
+import collections
 import datetime
-from typing import Dict, Type, Union, Any, List
-from account_metrics import MT5DealDaily
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Literal
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
 import numpy as np
 import pandas as pd
-from pydantic.alias_generators import to_snake
 
-from metric_coordinator.datastore.local_datastore import LocalDatastore
-from metric_coordinator.model import BaseDatastore, MetricData, SourceDatastore
 from metric_coordinator.configs import MIN_TIME
+from metric_coordinator.datastore.local_datastore import LocalDatastore
+from metric_coordinator.datastore.metric_schema import get_metric_dtypes
+from metric_coordinator.datastore.write_behind_buffer import WriteBehindBuffer
+from metric_coordinator.model import BaseDatastore
+from metric_coordinator.model import MetricData
+from metric_coordinator.model import SourceDatastore
 
 
 class CacheDatastore(BaseDatastore):
-    def __init__(self, metric: MetricData, source_datastore: SourceDatastore, load_interval: int = 86400) -> None:
+    # "eager" reloads the whole source table every load_interval,
+    # "lazy" loads each shard the first time it is seen and reloads it every load_interval
+    LOAD_MODES = ("eager", "lazy")
+
+    def __init__(
+        self,
+        metric: MetricData,
+        source_datastore: SourceDatastore,
+        load_interval: int = 86400,
+        max_rows_per_shard: int = None,
+        max_total_rows: int = None,
+        max_total_bytes: int = None,
+        load_mode: Literal["eager", "lazy"] = "eager",
+        incremental_refresh: bool = True,
+        full_reload_interval: int = 86400,
+        background_refresh: bool = False,
+        max_staleness: int = None,
+        fallback_memo_size: int = 10000,
+        fallback_memo_ttl: int = 300,
+        write_behind: bool = False,
+        write_batch_rows: int = 10000,
+        write_max_delay: float = 1.0,
+        write_max_pending_rows: int = 100000,
+        write_max_retries: int = 5,
+        write_dead_letter_dir: str = None,
+        load_block_size: int = None,
+    ) -> None:
         self.metric = metric
         self.source_datastore = source_datastore
         # TODO: Support different sharding columns for source and cache
         self.sharding_columns = self.source_datastore.sharding_columns
+        # The cache keeps the column projection of the source, sources without one return every metric field
+        self.columns = getattr(self.source_datastore, "columns", None)
+        if load_mode not in self.LOAD_MODES:
+            raise ValueError(f"Unsupported load mode {load_mode}, expected one of {self.LOAD_MODES}")
+        if load_mode == "lazy" and not self.sharding_columns:
+            raise ValueError("Lazy load mode requires the source datastore to have sharding columns")
+        # Limits evict and trim whole shards, without sharding columns they would drop the rows of unrelated keys
+        limits = (max_rows_per_shard, max_total_rows, max_total_bytes)
+        if not self.sharding_columns and any(limit is not None for limit in limits):
+            raise ValueError("Cache limits require the source datastore to have sharding columns")
+        self.load_mode = load_mode
         self.reload_interval = load_interval
+        # Refreshes only fetch the rows with timestamp_server >= the latest one already loaded and upsert them
+        self.incremental_refresh = incremental_refresh
+        # Deltas miss the deleted rows and the late rows older than the watermark, so the cache (or a lazy shard)
+        # is still fully reloaded when its last full load is older than full_reload_interval (None never does)
+        self.full_reload_interval = full_reload_interval
+        # Full loads stream the source in blocks of load_block_size rows into the new cache generation
+        self.load_block_size = load_block_size
         self._last_load_time = datetime.datetime.fromtimestamp(MIN_TIME)
-        self.cache = LocalDatastore(metric, self.sharding_columns)
+        self._load_watermark: Optional[int] = None
+        self._last_full_load_time = datetime.datetime.fromtimestamp(MIN_TIME)
+        self._shard_load_times: Dict[tuple, datetime.datetime] = {}
+        self._shard_full_load_times: Dict[tuple, datetime.datetime] = {}
+        self._shard_watermarks: Dict[tuple, Optional[int]] = {}
+        # Eager mode only: once the cache is loaded, reloads run on a background thread and the next generation
+        # is swapped in by the first lookup after it is ready. A lookup only waits for it when the cache is older
+        # than load_interval + max_staleness (never when max_staleness is None).
+        self.background_refresh = background_refresh
+        self.max_staleness = max_staleness
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._refresh_result = None
+        self._refresh_puts: Optional[List[pd.DataFrame]] = None
+        # Results of the source lookups done on local cache misses, including the keys the source has no row for,
+        # kept for fallback_memo_ttl seconds (LRU bounded by fallback_memo_size, 0 disables it). The entries of a shard
+        # are dropped whenever it is loaded or refreshed, and all of them when the whole cache is
+        self.fallback_memo_size = fallback_memo_size
+        self.fallback_memo_ttl = fallback_memo_ttl
+        self._fallback_memo: collections.OrderedDict[tuple, Tuple[datetime.datetime, Optional[pd.Series]]]
+        self._fallback_memo = collections.OrderedDict()
+        self._source_fallback_count = 0
+        self._fallback_memo_hit_count = 0
+        self._shard_load_count = 0
+        self.cache = LocalDatastore(
+            metric,
+            self.sharding_columns,
+            max_rows_per_shard=max_rows_per_shard,
+            max_total_rows=max_total_rows,
+            max_total_bytes=max_total_bytes,
+            columns=self.columns,
+        )
+        # Rows pushed to the source are coalesced into batched inserts instead of one insert per put,
+        # a batch still failing after write_max_retries attempts is pickled to write_dead_letter_dir
+        self._write_buffer = (
+            WriteBehindBuffer(
+                self.source_datastore.put,
+                metric.__name__,
+                max_batch_rows=write_batch_rows,
+                max_delay=write_max_delay,
+                max_pending_rows=write_max_pending_rows,
+                max_retries=write_max_retries,
+                dead_letter_dir=write_dead_letter_dir,
+            )
+            if write_behind
+            else None
+        )
 
     def put(self, value: pd.Series, push_to_source: bool = False) -> None:
-        self.cache.put(value)
-        # TODO: consider batch writing
-        if push_to_source:
+        self._put_local(value)
+        if not push_to_source:
+            return
+        if self._write_buffer is not None:
+            self._write_buffer.put(value)
+        else:
             self.source_datastore.put(value)
 
+    def flush(self) -> None:
+        """
+        Writes to the source every row pushed so far that is still buffered
+        """
+        if self._write_buffer is not None:
+            self._write_buffer.flush()
+
+    def close(self) -> None:
+        """
+        Writes the buffered rows to the source before clearing the cache, the cache is cleared even if that fails
+        """
+        try:
+            if self._write_buffer is not None:
+                self._write_buffer.close()
+        finally:
+            self._write_buffer = None
+            self.cache.close()
+
     def get_metric(self):
         return super().get_metric()
-    
+
     def get_latest_row(self, shard_key: Dict[str, int]) -> pd.Series:
-        if self._need_reload(datetime.datetime.now()):
-            self._eager_load()
+        self._refresh_if_needed(datetime.datetime.now())
+        self._load_shards([shard_key], datetime.datetime.now())
         result = self._get_latest_row_from_local(shard_key)
 
         if result is None:
             # TODO: logging local cache miss
             #  print("Warning: No data found in local cache, loading from clickhouse")
-            result = self.source_datastore.get_latest_row(shard_key)
-            if result:
-                self.cache.put(result)        
+            result = self._get_from_source(
+                self._get_memo_key("latest", shard_key),
+                lambda: self.source_datastore.get_latest_row(shard_key),
+            )
+        if result is None:
+            # Same as LocalDatastore, a key found nowhere gets the default metric row
+            result = self.cache.get_latest_row(shard_key)
         return result
 
     def get_row_by_timestamp(self, shard_key: Dict[str, int], timestamp: datetime.date, timestamp_column: str) -> pd.Series:
-        if self._need_reload(timestamp):
-            self._eager_load()
+        self._refresh_if_needed(timestamp)
+        self._load_shards([shard_key], timestamp)
         result = self._get_row_by_timestamp_from_local(shard_key, timestamp, timestamp_column)
 
         if result is None:
             # TODO: logging local cache miss
             # print("Warning: No data found in local cache, loading from clickhouse")
-            result = self.source_datastore.get_row_by_timestamp(shard_key, timestamp, timestamp_column)
-            if result is not None:
-                # TODO: Fix potential wrong order bugs
-                self.cache.put(result)
+            # LocalDatastore keeps rows sorted by timestamp, so putting back an older row is safe
+            result = self._get_from_source(
+                self._get_memo_key(timestamp_column, {**shard_key, timestamp_column: timestamp}),
+                lambda: self.source_datastore.get_row_by_timestamp(shard_key, timestamp, timestamp_column),
+            )
 
         return result
 
+    def get_latest_rows(self, shard_keys: pd.DataFrame) -> pd.DataFrame:
+        self._refresh_if_needed(datetime.datetime.now())
+        self._load_shards(self._iter_shard_keys(shard_keys), datetime.datetime.now())
+        result = self.cache.get_latest_rows(shard_keys, use_default_value=False)
+        result = self._fill_missing_from_source(shard_keys, result, self.source_datastore.get_latest_rows, "latest")
+
+        # Same as get_latest_row, keys found nowhere get the default metric row
+        missing = result.isna().all(axis=1)
+        if missing.any():
+            result.loc[missing] = self.cache.get_latest_rows(shard_keys[missing], use_default_value=True)
+        return result.astype(get_metric_dtypes(self.metric, self.cache.columns))
+
+    def get_rows_by_timestamp(self, shard_keys: pd.DataFrame, timestamp_column: str) -> pd.DataFrame:
+        if shard_keys.empty:
+            return self.cache.get_rows_by_timestamp(shard_keys, timestamp_column)
+        self._refresh_if_needed(shard_keys[timestamp_column].max())
+        self._load_shards(self._iter_shard_keys(shard_keys), shard_keys[timestamp_column].max())
+        result = self.cache.get_rows_by_timestamp(shard_keys, timestamp_column, use_default_value=False)
+        return self._fill_missing_from_source(
+            shard_keys,
+            result,
+            lambda keys: self.source_datastore.get_rows_by_timestamp(keys, timestamp_column),
+            timestamp_column,
+        )
+
+    def prefetch(self, shard_keys: pd.DataFrame) -> None:
+        """
+        Loads with a single source query every shard of shard_keys that is not cached yet (lazy mode) or was evicted,
+        e.g. all the new logins of an incoming batch of deals
+        """
+        self._load_shards(self._iter_shard_keys(shard_keys), datetime.datetime.now())
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            **self.cache.get_stats(),
+            "shard_loads": self._shard_load_count,
+            "source_fallbacks": self._source_fallback_count,
+            "fallback_memo_hits": self._fallback_memo_hit_count,
+            **({} if self._write_buffer is None else self._write_buffer.get_stats()),
+        }
+
     def get_source_datastore(self) -> BaseDatastore:
         return self.source_datastore
 
+    def _put_local(self, value: Union[pd.Series, pd.DataFrame]) -> None:
+        self.cache.put(value)
+        with self._refresh_lock:
+            # Replayed on the next generation, which is loaded from a source snapshot that may not have these rows
+            if self._refresh_puts is not None:
+                self._refresh_puts.append(value.to_frame().T if isinstance(value, pd.Series) else value)
+
     def _get_row_by_timestamp_from_local(self, shard_key: Dict[str, int], timestamp: datetime.date, timestamp_column: str) -> pd.Series:
         return self.cache.get_row_by_timestamp(shard_key, timestamp, timestamp_column, use_default_value=False)
 
     def _get_latest_row_from_local(self, shard_key: Dict[str, int]) -> pd.Series:
-        return self.cache.get_latest_row(shard_key)
+        return self.cache.get_latest_row(shard_key, use_default_value=False)
+
+    def _get_from_source(
+        self,
+        memo_key: tuple,
+        get_row_from_source: Callable[[], Optional[pd.Series]],
+    ) -> Optional[pd.Series]:
+        memoized, result = self._get_memo(memo_key)
+        if memoized:
+            return result
+        result = get_row_from_source()
+        self._source_fallback_count += 1
+        self._set_memo(memo_key, result)
+        if result is not None:
+            self._put_local(result)
+        return result
+
+    def _fill_missing_from_source(
+        self,
+        shard_keys: pd.DataFrame,
+        result: pd.DataFrame,
+        get_rows_from_source: Callable[[pd.DataFrame], pd.DataFrame],
+        lookup: str,
+    ) -> pd.DataFrame:
+        # All local cache misses of the batch that are not memoized are resolved with a single source lookup
+        missing = result.isna().all(axis=1).to_numpy()
+        if not missing.any():
+            return result
+        positions = np.flatnonzero(missing)
+        memo_keys = [self._get_memo_key(lookup, key) for key in shard_keys.iloc[positions].to_dict(orient="records")]
+        for position, memo_key in zip(positions, memo_keys, strict=True):
+            memoized, row = self._get_memo(memo_key)
+            if memoized:
+                missing[position] = False
+                if row is not None:
+                    result.iloc[position] = row[result.columns].to_numpy()
+        if not missing.any():
+            return result
+        source_result = get_rows_from_source(shard_keys[missing])
+        self._source_fallback_count += 1
+        source_memo_keys = [key for key, position in zip(memo_keys, positions, strict=True) if missing[position]]
+        for memo_key, (_, row) in zip(source_memo_keys, source_result.iterrows(), strict=True):
+            self._set_memo(memo_key, None if row.isna().all() else row)
+        found = source_result.dropna(how="all")
+        if not found.empty:
+            self._put_local(found)
+            result.loc[found.index] = found
+        return result
+
+    def _get_memo_key(self, lookup: str, key: Dict[str, Any]) -> tuple:
+        # e.g. ("Date", ("Date", datetime.date(2024, 7, 8)), ("Login", 1001))
+        return (lookup,) + tuple(sorted(key.items()))
+
+    def _get_memo(self, memo_key: tuple) -> Tuple[bool, Optional[pd.Series]]:
+        entry = self._fallback_memo.get(memo_key, None)
+        if entry is None:
+            return False, None
+        expires_at, row = entry
+        if expires_at < datetime.datetime.now():
+            del self._fallback_memo[memo_key]
+            return False, None
+        self._fallback_memo.move_to_end(memo_key)
+        self._fallback_memo_hit_count += 1
+        return True, None if row is None else row.copy()
 
-    def _eager_load(self, shard_key_values: tuple[Any] = None) -> pd.DataFrame:
-        df = self.source_datastore.eager_load(shard_key_values)
-        self.cache.reload_data(df)
-        self._last_load_time = datetime.datetime.now()
-        return df
+    def _set_memo(self, memo_key: tuple, row: Optional[pd.Series]) -> None:
+        if self.fallback_memo_size <= 0:
+            return
+        self._fallback_memo[memo_key] = (
+            datetime.datetime.now() + datetime.timedelta(seconds=self.fallback_memo_ttl),
+            row,
+        )
+        self._fallback_memo.move_to_end(memo_key)
+        while len(self._fallback_memo) > self.fallback_memo_size:
+            self._fallback_memo.popitem(last=False)
+
+    def _iter_shard_keys(self, shard_keys: pd.DataFrame) -> Iterator[Dict[str, Any]]:
+        if not self.cache.sharding_columns or (self.load_mode == "eager" and not self.cache.evicted_shard_key_values):
+            return
+        unique_shard_keys = shard_keys[self.cache.sharding_columns].drop_duplicates()
+        yield from unique_shard_keys.to_dict(orient="records")
+
+    def _load_shards(
+        self,
+        shard_keys: Iterable[Dict[str, Any]],
+        timestamp: Union[datetime.date, datetime.datetime],
+    ) -> None:
+        # New and evicted shards are fetched whole from the source with a single query,
+        # expired shards only fetch their rows newer than the shard watermark with another one
+        shard_keys_to_load = [shard_key for shard_key in shard_keys if self._need_shard_load(shard_key, timestamp)]
+        if not shard_keys_to_load:
+            return
+        shard_keys_to_refresh, shard_keys_to_reload = [], []
+        for shard_key in shard_keys_to_load:
+            (shard_keys_to_refresh if self._can_refresh_shard(shard_key) else shard_keys_to_reload).append(shard_key)
+        # A failed load keeps the current rows of its shards,
+        # they are not marked loaded so the next lookup retries them
+        loaded_shard_keys = []
+        if shard_keys_to_reload:
+            df = self.source_datastore.eager_load_shards(self._get_source_shard_keys(shard_keys_to_reload))
+            if df is None:
+                shard_count = len(shard_keys_to_reload)
+                print(f"Error loading {shard_count} shards of {self.metric.__name__}, keeping cached rows")
+            else:
+                self.cache.reload_shards(shard_keys_to_reload, df)
+                self._set_shard_watermarks(shard_keys_to_reload, self._get_watermark(df))
+                for shard_key in shard_keys_to_reload:
+                    self._shard_full_load_times[self._get_shard_key_values(shard_key)] = datetime.datetime.now()
+                loaded_shard_keys += shard_keys_to_reload
+        if shard_keys_to_refresh:
+            from_time = min(self._shard_watermarks[self._get_shard_key_values(key)] for key in shard_keys_to_refresh)
+            df = self.source_datastore.eager_load_shards(
+                self._get_source_shard_keys(shard_keys_to_refresh),
+                from_time=from_time,
+            )
+            if df is None:
+                shard_count = len(shard_keys_to_refresh)
+                print(f"Error refreshing {shard_count} shards of {self.metric.__name__}, keeping cached rows")
+            else:
+                self.cache.merge(df)
+                self._set_shard_watermarks(shard_keys_to_refresh, self._get_watermark(df, from_time))
+                loaded_shard_keys += shard_keys_to_refresh
+        load_time = datetime.datetime.now()
+        for shard_key in loaded_shard_keys:
+            self._shard_load_times[self._get_shard_key_values(shard_key)] = load_time
+        self._shard_load_count += len(loaded_shard_keys)
+        self._drop_shard_memos(loaded_shard_keys)
+
+    def _drop_shard_memos(self, shard_keys: List[Dict[str, Any]]) -> None:
+        # The source may now have rows for the keys it had none for, or newer ones
+        if not self._fallback_memo:
+            return
+        shard_key_values = {self._get_shard_key_values(shard_key) for shard_key in shard_keys}
+        for memo_key in list(self._fallback_memo):
+            key = dict(memo_key[1:])
+            if tuple(key.get(col) for col in self.cache.sharding_columns) in shard_key_values:
+                del self._fallback_memo[memo_key]
+
+    def _can_refresh_shard(self, shard_key: Dict[str, Any]) -> bool:
+        shard_key_values = self._get_shard_key_values(shard_key)
+        return (
+            self.incremental_refresh
+            and self._shard_watermarks.get(shard_key_values, None) is not None
+            and not self.cache.is_evicted(shard_key)
+            and not self._is_full_reload_due(self._shard_full_load_times.get(shard_key_values, None))
+        )
+
+    def _is_full_reload_due(self, last_full_load_time: Optional[datetime.datetime]) -> bool:
+        if last_full_load_time is None:
+            return True
+        return (
+            self.full_reload_interval is not None
+            and (datetime.datetime.now() - last_full_load_time).total_seconds() > self.full_reload_interval
+        )
+
+    def _set_shard_watermarks(self, shard_keys: List[Dict[str, Any]], watermark: Optional[int]) -> None:
+        for shard_key in shard_keys:
+            self._shard_watermarks[self._get_shard_key_values(shard_key)] = watermark
+
+    def _get_source_shard_keys(self, shard_keys: List[Dict[str, Any]]) -> pd.DataFrame:
+        return pd.DataFrame([{col: shard_key[col] for col in self.sharding_columns} for shard_key in shard_keys])
+
+    def _get_watermark(self, df: pd.DataFrame, watermark: Optional[int] = None) -> Optional[int]:
+        # Latest timestamp_server loaded, rows at the watermark itself are fetched again on refresh
+        # as they may be incomplete
+        if df is None or df.empty or "timestamp_server" not in df.columns:
+            return watermark
+        latest = int(df["timestamp_server"].max())
+        return latest if watermark is None else max(watermark, latest)
+
+    def _need_shard_load(self, shard_key: Dict[str, Any], timestamp: Union[datetime.date, datetime.datetime]) -> bool:
+        if self.cache.evicted_shard_key_values and self.cache.is_evicted(shard_key):
+            return True
+        if self.load_mode != "lazy":
+            return False
+        load_time = self._shard_load_times.get(self._get_shard_key_values(shard_key), None)
+        return load_time is None or self._is_expired(timestamp, load_time)
+
+    def _get_shard_key_values(self, shard_key: Dict[str, Any]) -> tuple:
+        return tuple(shard_key[col] for col in self.cache.sharding_columns)
+
+    def _refresh_if_needed(self, timestamp: Union[datetime.date, datetime.datetime]) -> None:
+        self._swap_refreshed_cache()
+        if not self._need_reload(timestamp):
+            return
+        if not self.background_refresh or not self._is_loaded():
+            self._eager_load()
+            return
+        self._start_background_refresh()
+        if self.max_staleness is not None and self._is_expired(
+            timestamp,
+            self._last_load_time,
+            self.reload_interval + self.max_staleness,
+        ):
+            self._wait_for_refresh()
+
+    def _is_loaded(self) -> bool:
+        return self._last_load_time > datetime.datetime.fromtimestamp(MIN_TIME)
+
+    def _start_background_refresh(self) -> None:
+        with self._refresh_lock:
+            if self._refresh_thread is not None:
+                return
+            self._refresh_puts = []
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_in_background, name=f"{self.metric.__name__}CacheRefresh", daemon=True
+            )
+            self._refresh_thread.start()
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self._refresh_result = self._fetch_next_generation()
+        except Exception as e:
+            # The current generation stays in use, the refresh is retried by the next lookup
+            print(f"Error refreshing {self.metric.__name__} cache in background: {e}")
+            self._refresh_result = None
+
+    def _wait_for_refresh(self) -> None:
+        refresh_thread = self._refresh_thread
+        if refresh_thread is not None:
+            refresh_thread.join()
+        self._swap_refreshed_cache()
+
+    def _swap_refreshed_cache(self) -> None:
+        with self._refresh_lock:
+            if self._refresh_thread is None or self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = None
+            result, self._refresh_result = self._refresh_result, None
+            puts, self._refresh_puts = self._refresh_puts, None
+        if result is None:
+            return
+        self._apply_next_generation(*result)
+        if puts:
+            self.cache.merge(pd.concat(puts, ignore_index=True))
+
+    def _eager_load(self, shard_key_values: tuple[Any] = None) -> None:
+        self._apply_next_generation(*self._fetch_next_generation(shard_key_values))
+
+    def _fetch_next_generation(
+        self, shard_key_values: tuple[Any] = None
+    ) -> Tuple[Optional[LocalDatastore], Optional[pd.DataFrame], Optional[int], datetime.datetime]:
+        """
+        Downloads the rows of the next cache generation, the slow part of a reload that can run off the lookup path.
+        Returns (new LocalDatastore, None, ...) for a full reload, (None, delta, ...) for a delta
+        to merge into the current cache, with the new watermark and the load time.
+        """
+        load_time = datetime.datetime.now()
+        full_reload_due = self._is_full_reload_due(self._last_full_load_time)
+        if self.incremental_refresh and self._load_watermark is not None and not full_reload_due:
+            df = self.source_datastore.eager_load(shard_key_values, from_time=self._load_watermark)
+            return None, df, self._get_watermark(df, self._load_watermark), load_time
+        next_cache = LocalDatastore(
+            self.metric,
+            self.sharding_columns,
+            max_rows_per_shard=self.cache.max_rows_per_shard,
+            max_total_rows=self.cache.max_total_rows,
+            max_total_bytes=self.cache.max_total_bytes,
+            columns=self.columns,
+        )
+        # Each block is put as it arrives, the whole table is never held as a single DataFrame
+        watermark = None
+        for block in self.source_datastore.eager_load_stream(shard_key_values, block_size=self.load_block_size):
+            next_cache.put(block)
+            watermark = self._get_watermark(block, watermark)
+        return next_cache, None, watermark, load_time
+
+    def _apply_next_generation(
+        self,
+        next_cache: Optional[LocalDatastore],
+        df: Optional[pd.DataFrame],
+        watermark: Optional[int],
+        load_time: datetime.datetime,
+    ) -> None:
+        self._fallback_memo.clear()
+        if next_cache is None:
+            self.cache.merge(df)
+        else:
+            self.cache = next_cache
+            self._last_full_load_time = load_time
+            self._shard_load_times = {}
+            self._shard_watermarks = {}
+            self._shard_full_load_times = {}
+        self._load_watermark = watermark
+        self._last_load_time = load_time
 
     def _need_reload(self, timestamp: Union[datetime.date, datetime.datetime]) -> bool:
-        if self.cache is None:
+        if self.cache is None or self.load_mode == "lazy":
             return False
+        return self._is_expired(timestamp, self._last_load_time)
+
+    def _is_expired(
+        self,
+        timestamp: Union[datetime.date, datetime.datetime],
+        last_load_time: datetime.datetime,
+        interval: int = None,
+    ) -> bool:
         if isinstance(timestamp, int) or isinstance(timestamp, np.int64):
             timestamp = datetime.datetime.fromtimestamp(timestamp)
         elif isinstance(timestamp, datetime.date):
             timestamp = datetime.datetime.combine(timestamp, datetime.time.max)
-        time_diff = timestamp - self._last_load_time
-        return time_diff.total_seconds() > self.reload_interval
+        time_diff = timestamp - last_load_time
+        return time_diff.total_seconds() > (self.reload_interval if interval is None else interval)
@@ -1,30 +1,105 @@
+import concurrent.futures
 import datetime
-from typing import Dict, Type, Union, Any, List
+import queue
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Literal
+from typing import Optional
+from typing import Tuple
+from typing import Type
+from typing import Union
+
 import numpy as np
 import pandas as pd
 from pydantic.alias_generators import to_snake
 
-from metric_coordinator.datastore.local_datastore import LocalDatastore
-from metric_coordinator.model import BaseDatastore, MetricData
 from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
+from metric_coordinator.api_client.query_builder import get_equals_condition
+from metric_coordinator.api_client.query_builder import get_equals_parameters
+from metric_coordinator.api_client.query_builder import get_in_condition
+from metric_coordinator.api_client.query_builder import get_in_parameter
+from metric_coordinator.api_client.query_builder import get_parameter_types
 from metric_coordinator.configs import MIN_TIME
+from metric_coordinator.datastore.metric_schema import align_metric_rows
+from metric_coordinator.datastore.metric_schema import coerce_metric_keys
+from metric_coordinator.datastore.metric_schema import get_metric_key_columns
+from metric_coordinator.datastore.metric_schema import get_metric_projection
+from metric_coordinator.datastore.metric_schema import get_metric_sharding_columns
+from metric_coordinator.model import BaseDatastore
+from metric_coordinator.model import MetricData
 
 
 class ClickhouseDatastore(BaseDatastore):
     DEFAULT_SHARD_KEY_VALUES = ("ALL",)
+    LOAD_PARTITION_BY = ("key", "timestamp_server")
+    LATEST_ROWS_STRATEGIES = ("limit_by", "argmax")
+    # Distinct keys per batched latest-row statement, keeps the IN list well under max_query_size
+    LATEST_ROWS_BATCH_SIZE = 5000
+    # Blocks waiting to be consumed per partition when eager_load_stream runs partitions in parallel
+    PARTITION_QUEUE_BLOCKS = 2
 
-    def __init__(self, metric: MetricData, client: ClickhouseClient, table_name: str = None, sharding_columns: tuple[str] = None) -> None:
+    def __init__(
+        self,
+        metric: MetricData,
+        client: ClickhouseClient,
+        table_name: str = None,
+        sharding_columns: tuple[str] = None,
+        load_partitions: int = 1,
+        load_partition_by: Literal["key", "timestamp_server"] = "key",
+        latest_rows_strategy: Literal["limit_by", "argmax"] = "limit_by",
+        columns: Optional[List[str]] = None,
+        latest_state_view: bool = False,
+        load_latest_state: bool = False,
+    ) -> None:
         self.metric = metric
         self.client = client
         self.table_name = table_name
         self.sharding_columns = sharding_columns
+        # eager_load splits the table into load_partitions queries run in parallel, by hash of the sharding
+        # (or metric key) columns or by timestamp_server range. One pooled connection is left to the lookups,
+        # so a load never starves them.
+        if load_partition_by not in self.LOAD_PARTITION_BY:
+            partition_by = self.LOAD_PARTITION_BY
+            raise ValueError(f"Unsupported load partitioning {load_partition_by}, expected one of {partition_by}")
+        self.load_partitions = max(load_partitions, 1)
+        if client.pool_size > 0 and self.load_partitions >= client.pool_size:
+            self.load_partitions = max(client.pool_size - 1, 1)
+            print(f"load_partitions {load_partitions} capped to {self.load_partitions} (pool size {client.pool_size})")
+        self.load_partition_by = load_partition_by
+        # Batched latest-row lookups use ORDER BY timestamp_server DESC LIMIT 1 BY <keys>,
+        # or GROUP BY <keys> with argMax(column, timestamp_server) which avoids sorting the matched rows
+        if latest_rows_strategy not in self.LATEST_ROWS_STRATEGIES:
+            strategies = self.LATEST_ROWS_STRATEGIES
+            raise ValueError(f"Unsupported latest rows strategy {latest_rows_strategy}, expected one of {strategies}")
+        self.latest_rows_strategy = latest_rows_strategy
+        # With latest_state_view, latest-row lookups by the metric sharding columns read the {table}_latest table
+        # maintained by ClickhouseEmitter instead of the full history. With load_latest_state, loads also read it,
+        # so a warm-up downloads one row per sharding key and older rows are only found by lookups in the source.
+        self.latest_state_columns = get_metric_sharding_columns(metric) if latest_state_view else None
+        if latest_state_view and not self.latest_state_columns:
+            raise ValueError(f"Latest state view requires {metric.__name__} to declare sharding columns")
+        if load_latest_state and not latest_state_view:
+            raise ValueError("load_latest_state requires latest_state_view")
+        self.load_latest_state = load_latest_state
+        # Column projection pushed into every SELECT, rows only hold these columns (all metric fields by default)
+        self.columns = get_metric_projection(
+            metric,
+            columns,
+            list(sharding_columns or []) + list(self.latest_state_columns or []),
+        )
+        self._statements: Dict[Tuple[str, Tuple[str, ...]], str] = {}
         self._last_load_time = datetime.datetime.fromtimestamp(MIN_TIME)
 
     def put(self, value: Union[pd.Series, pd.DataFrame]) -> None:
         if self.metric is None:
             raise ValueError("Datastore is not initialized or deactivated")
         if isinstance(value, pd.Series):
-            value = value.to_frame()
+            value = value.to_frame().T
         self.client.insert_df(self.get_metric_table_name(), value)
 
     def get_metric(self) -> Type[MetricData]:
@@ -33,13 +108,11 @@ class ClickhouseDatastore(BaseDatastore):
     def get_latest_row(self, shard_key: Dict[str, int]) -> pd.Series:
         if self.metric is None:
             raise ValueError("Datastore is not initialized or deactivated")
-        query = f"""
-        SELECT * FROM {self.get_metric_table_name()} FINAL WHERE {self._get_metric_fields(shard_key)}
-        ORDER BY timestamp_server DESC
-        LIMIT 1
-        """
-        result = self.client.query_df(query)
-        if result is None or result.empty:
+        columns = tuple(shard_key.keys())
+        query = self._get_statement("latest_row", columns, lambda: self._build_latest_row_query(columns))
+        # Lookup errors are raised, a None result means the key has no row (see CacheDatastore fallback memo)
+        result = self.client.query_df(query, get_equals_parameters(shard_key), raise_errors=True)
+        if result.empty:
             return None
         return result.iloc[0]
 
@@ -48,54 +121,302 @@ class ClickhouseDatastore(BaseDatastore):
     ) -> pd.Series:
         if self.metric is None:
             raise ValueError("Datastore is not initialized or deactivated")
-        query = f"""
-        SELECT * FROM {self.get_metric_table_name()} FINAL WHERE {self._get_metric_fields(shard_key)} AND {timestamp_column} = {self._get_value_field(timestamp)}
-        ORDER BY timestamp_server DESC
-        LIMIT 1
-        """
-        result = self.client.query_df(query)
-        if result is None or result.empty:
+        filters = {**shard_key, timestamp_column: timestamp}
+        columns = tuple(filters.keys())
+        query = self._get_statement("row_by_timestamp", columns, lambda: self._build_row_by_timestamp_query(columns))
+        result = self.client.query_df(query, get_equals_parameters(filters), raise_errors=True)
+        if result.empty:
             return None
         return result.iloc[0]
 
+    def get_latest_rows(self, shard_keys: pd.DataFrame) -> pd.DataFrame:
+        if self.metric is None:
+            raise ValueError("Datastore is not initialized or deactivated")
+        return self._get_latest_rows_by_keys(shard_keys)
+
+    def get_rows_by_timestamp(self, shard_keys: pd.DataFrame, timestamp_column: str) -> pd.DataFrame:
+        if self.metric is None:
+            raise ValueError("Datastore is not initialized or deactivated")
+        assert timestamp_column in shard_keys.columns, f"Column {timestamp_column} not found in shard_keys"
+        return self._get_latest_rows_by_keys(shard_keys)
+
+    def get_latest_rows_by_shard_key(self, shard_keys: pd.DataFrame) -> pd.DataFrame:
+        """
+        Latest row of every distinct key of shard_keys, indexed by the key columns. Keys without a row are left out.
+        e.g. Login = [1001, 1002, 1001] -> DataFrame indexed by Login with the latest rows of 1001 and 1002
+        """
+        if self.metric is None:
+            raise ValueError("Datastore is not initialized or deactivated")
+        key_columns = list(shard_keys.columns)
+        rows = self._query_latest_rows(shard_keys)
+        if rows is None:
+            rows = pd.DataFrame(columns=self.columns)
+        return rows.set_index(key_columns)
+
     def close(self) -> None:
-        self.client.drop_tables([self.get_metric_table_name()])
+        tables = [self.get_metric_table_name()]
+        if self.latest_state_columns is not None:
+            latest_table = self.client.get_latest_state_table_name(self.get_metric_table_name())
+            tables = [f"{latest_table}_mv", latest_table] + tables
+        self.client.drop_tables(tables)
         self.table_name = None
         self.metric = None
 
-    def eager_load(self, shard_key_values: tuple[Any] = None, from_time: int = MIN_TIME, to_time: int = datetime.datetime.now()) -> pd.DataFrame:
-        # TODO: support eager load from timestamp (not reload_data but concat data)
+    def eager_load(
+        self,
+        shard_key_values: tuple[Any] = None,
+        from_time: int = MIN_TIME,
+        to_time: int = None,
+    ) -> pd.DataFrame:
+        """
+        Loads all rows of the table, or of a single shard, with timestamp_server in [from_time, to_time]
+        """
         # TODO: migrate all query to clickhouse datastore
-        # TODO: check if we want to parallelize this
-        if self.sharding_columns is None:
-            df = self.client.query_df(f"SELECT * FROM {self.get_metric_table_name()} FINAL")
-        else:
+        where_clauses, parameters = self._get_eager_load_where_clauses(shard_key_values, from_time, to_time)
+        if len(where_clauses) == 1:
+            return self._query_rows(where_clauses[0], parameters)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(where_clauses)) as executor:
+            partitions = list(executor.map(lambda where: self._query_rows(where, parameters), where_clauses))
+        if any(partition is None for partition in partitions):
+            return None
+        return pd.concat(partitions, ignore_index=True)
+
+    def eager_load_stream(
+        self,
+        shard_key_values: tuple[Any] = None,
+        from_time: int = MIN_TIME,
+        to_time: int = None,
+        block_size: int = None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Same rows as eager_load, streamed as blocks of at most block_size rows so they never all sit in memory at once.
+        With several load partitions, blocks of the partitions are yielded in the order they arrive.
+        """
+        where_clauses, parameters = self._get_eager_load_where_clauses(shard_key_values, from_time, to_time)
+        if len(where_clauses) == 1:
+            return self._query_rows_stream(where_clauses[0], block_size, parameters)
+        return self._stream_partitions(where_clauses, block_size, parameters)
+
+    def eager_load_shards(self, shard_keys: pd.DataFrame, from_time: int = MIN_TIME) -> pd.DataFrame:
+        if shard_keys.empty:
+            return pd.DataFrame(columns=self.columns)
+        conditions = [self._get_keys_in_condition(tuple(shard_keys.columns))] + self._get_time_range_conditions(
+            from_time,
+            None,
+        )
+        return self._query_rows(
+            self._generate_where_clause(conditions),
+            {"keys": self._get_keys_parameter(shard_keys)},
+        )
+
+    def _query_rows(self, where: str, parameters: Dict[str, Any] = None) -> pd.DataFrame:
+        # One row per metric key (per sharding key from the latest state table),
+        # deduplicated with the read strategy of the client
+        return self.client.query_deduplicated_df(
+            self._get_load_table_name(),
+            self._get_load_key_columns(),
+            where,
+            columns=self.columns,
+            parameters=parameters,
+        )
+
+    def _query_rows_stream(
+        self,
+        where: str,
+        block_size: int,
+        parameters: Dict[str, Any] = None,
+    ) -> Iterator[pd.DataFrame]:
+        return self.client.query_deduplicated_df_stream(
+            self._get_load_table_name(),
+            self._get_load_key_columns(),
+            where,
+            columns=self.columns,
+            block_size=block_size,
+            parameters=parameters,
+        )
+
+    def _get_eager_load_where_clauses(
+        self,
+        shard_key_values: tuple[Any],
+        from_time: int,
+        to_time: int,
+    ) -> Tuple[List[str], Dict[str, Any]]:
+        """
+        WHERE clause of each load partition, and the parameters they are bound with (the shard key values)
+        """
+        conditions, parameters = [], None
+        if self.sharding_columns is not None and shard_key_values is not None:
             assert len(shard_key_values) == len(self.sharding_columns)
-            # TODO: validate that shard_key_values is in the correct type
-            df = self.client.query_df(
-                f"SELECT * FROM {self.get_metric_table_name()} FINAL {self._generate_sharding_clause(shard_key_values)}"
-            )
-        return df
-    
-    def _get_metric_fields(self, shard_key: Dict[str, Any]) -> str:
-        if len(shard_key) == 0:
-            return ""
-        elif len(shard_key) == 1:
-            key, value = next(iter(shard_key.items()))
-            return f"{key} = {self._get_value_field(value)}"
-        else:
-            return " AND ".join([f"{k} = {self._get_value_field(v)}" for k, v in shard_key.items()])
-
-    def _get_value_field(self, value: Any) -> str:
-        if isinstance(value, datetime.date) or isinstance(value, str):
-            return f"'{value}'"
-        return str(value)
-
- 
+            shard_key = dict(zip(self.sharding_columns, shard_key_values, strict=True))
+            conditions.append(self._get_equals_condition(tuple(shard_key)))
+            parameters = get_equals_parameters(shard_key)
+        conditions.extend(self._get_time_range_conditions(from_time, to_time))
+        partitions = self._get_partition_conditions(conditions, parameters)
+        return [self._generate_where_clause(conditions + partition) for partition in partitions], parameters
+
+    def _get_partition_conditions(self, conditions: List[str], parameters: Dict[str, Any] = None) -> List[List[str]]:
+        """
+        e.g. 2 partitions by key -> [["cityHash64(Login) % 2 = 0"], ["cityHash64(Login) % 2 = 1"]]
+        Every version of a key is in the same partition, and FINAL is applied before the WHERE on timestamp_server,
+        so both partitionings return the same rows as a single query. Without FINAL the versions of a key could be
+        split across timestamp_server ranges, so the other read strategies always partition by key.
+        """
+        if self.load_partitions == 1:
+            return [[]]
+        partition_columns = self.sharding_columns or self._get_load_key_columns()
+        if (self.load_partition_by == "key" or self.client.read_strategy != "final") and partition_columns:
+            hash_expression = f"cityHash64({', '.join(partition_columns)})"
+            return [[f"{hash_expression} % {self.load_partitions} = {i}"] for i in range(self.load_partitions)]
+
+        time_range = self.client.query_df(
+            f"SELECT min(timestamp_server) AS min_time, max(timestamp_server) AS max_time "
+            f"FROM {self._get_load_table_name()} {self._generate_where_clause(conditions)}",
+            parameters,
+        )
+        if time_range is None or time_range.empty or pd.isna(time_range["min_time"].iloc[0]):
+            return [[]]
+        min_time, max_time = int(time_range["min_time"].iloc[0]), int(time_range["max_time"].iloc[0])
+        bounds = np.unique(np.linspace(min_time, max_time + 1, self.load_partitions + 1).astype(np.int64))
+        ranges = zip(bounds[:-1], bounds[1:], strict=True)
+        return [[f"timestamp_server >= {start}", f"timestamp_server < {end}"] for start, end in ranges]
+
+    def _stream_partitions(
+        self,
+        where_clauses: List[str],
+        block_size: int,
+        parameters: Dict[str, Any] = None,
+    ) -> Iterator[pd.DataFrame]:
+        # Partitions are streamed concurrently into a bounded queue,
+        # so memory stays bounded by a few blocks per partition
+        blocks = queue.Queue(maxsize=self.PARTITION_QUEUE_BLOCKS * len(where_clauses))
+        stop = threading.Event()
+
+        def load_partition(where: str) -> None:
+            stream = self._query_rows_stream(where, block_size, parameters)
+            try:
+                for block in stream:
+                    while not stop.is_set():
+                        try:
+                            blocks.put(block, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+            finally:
+                stream.close()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(where_clauses)) as executor:
+            futures = [executor.submit(load_partition, where) for where in where_clauses]
+            try:
+                while True:
+                    try:
+                        yield blocks.get(timeout=0.1)
+                    except queue.Empty as e:
+                        failed = [future for future in futures if future.done() and future.exception() is not None]
+                        if failed:
+                            raise failed[0].exception() from e
+                        if all(future.done() for future in futures) and blocks.empty():
+                            return
+            finally:
+                stop.set()
+
+    def _get_latest_rows_by_keys(self, keys: pd.DataFrame) -> pd.DataFrame:
+        if keys.empty:
+            return align_metric_rows(self.metric, keys, None, self.columns)
+        return align_metric_rows(self.metric, keys, self._query_latest_rows(keys), self.columns)
+
+    def _query_latest_rows(self, keys: pd.DataFrame) -> pd.DataFrame:
+        # One statement per LATEST_ROWS_BATCH_SIZE distinct keys, one latest row per key
+        unique_keys = coerce_metric_keys(self.metric, keys).drop_duplicates()
+        if unique_keys.empty:
+            return None
+        results = []
+        columns = tuple(unique_keys.columns)
+        query = self._get_statement("latest_rows", columns, lambda: self._build_latest_rows_query(columns))
+        for start in range(0, len(unique_keys), self.LATEST_ROWS_BATCH_SIZE):
+            batch = unique_keys.iloc[start : start + self.LATEST_ROWS_BATCH_SIZE]
+            result = self.client.query_df(query, {"keys": get_in_parameter(batch)}, raise_errors=True)
+            if self.latest_rows_strategy == "argmax":
+                result.columns = self.columns
+            results.append(result)
+        return results[0] if len(results) == 1 else pd.concat(results, ignore_index=True)
+
+    def _get_statement(self, name: str, columns: Tuple[str, ...], build: Callable[[], str]) -> str:
+        # Statements only depend on the lookup and its columns, the values are bound as parameters
+        key = (name, columns)
+        if key not in self._statements:
+            self._statements[key] = build()
+        return self._statements[key]
+
+    def _get_lookup_table(self, key_columns: Iterable[str]) -> str:
+        if self._is_latest_state_key(key_columns):
+            # A single row per sharding key, the latest version of which is picked without FINAL
+            return self.client.get_latest_state_table_name(self.get_metric_table_name())
+        return f"{self.get_metric_table_name()} {self.client.get_final_clause()}"
+
+    def _build_latest_row_query(self, columns: Tuple[str, ...]) -> str:
+        return f"""
+        SELECT {self._get_select_list()} FROM {self._get_lookup_table(columns)}
+        WHERE {self._get_equals_condition(columns)}
+        ORDER BY timestamp_server DESC
+        LIMIT 1
+        """
+
+    def _build_row_by_timestamp_query(self, columns: Tuple[str, ...]) -> str:
+        return f"""
+        SELECT {self._get_select_list()} FROM {self.get_metric_table_name()} {self.client.get_final_clause()}
+        WHERE {self._get_equals_condition(columns)}
+        ORDER BY timestamp_server DESC
+        LIMIT 1
+        """
+
+    def _build_latest_rows_query(self, key_columns: Tuple[str, ...]) -> str:
+        table = self._get_lookup_table(key_columns)
+        if self.latest_rows_strategy == "limit_by":
+            return f"""
+            SELECT {self._get_select_list()} FROM {table} WHERE {self._get_keys_in_condition(key_columns)}
+            ORDER BY timestamp_server DESC
+            LIMIT 1 BY {', '.join(key_columns)}
+            """
+        # Aliases must not shadow the columns used inside argMax, the result columns are renamed back by position
+        latest = {c: f"argMax({c}, timestamp_server) AS latest_{c}" for c in self.columns if c not in key_columns}
+        select = ", ".join(latest.get(c, c) for c in self.columns)
+        return f"""
+        SELECT {select} FROM {table} WHERE {self._get_keys_in_condition(key_columns)}
+        GROUP BY {', '.join(key_columns)}
+        """
+
+    def _get_equals_condition(self, columns: Tuple[str, ...]) -> str:
+        return get_equals_condition(columns, get_parameter_types(self.metric, columns))
+
+    def _get_keys_in_condition(self, columns: Tuple[str, ...]) -> str:
+        """
+        e.g. ("login", "date") -> (login, date) IN {keys:Array(Tuple(Int64, Date32))}, bound to _get_keys_parameter
+        """
+        return get_in_condition(columns, get_parameter_types(self.metric, columns))
+
+    def _get_keys_parameter(self, keys: pd.DataFrame) -> List[Any]:
+        return get_in_parameter(coerce_metric_keys(self.metric, keys))
+
+    def _is_latest_state_key(self, key_columns: Iterable[str]) -> bool:
+        return self.latest_state_columns is not None and set(key_columns) == set(self.latest_state_columns)
+
+    def _get_load_table_name(self) -> str:
+        if self.load_latest_state:
+            return self.client.get_latest_state_table_name(self.get_metric_table_name())
+        return self.get_metric_table_name()
+
+    def _get_load_key_columns(self) -> List[str]:
+        return list(self.latest_state_columns) if self.load_latest_state else get_metric_key_columns(self.metric)
+
+    def _get_select_list(self) -> str:
+        return ", ".join(self.columns)
+
     def get_metric_table_name(self) -> str:
         metric_name = to_snake(self.metric.__name__) if not self.table_name else self.table_name
         return metric_name
-    
+
     def _validate_sharding_columns(self, sharding_columns: tuple[str]) -> None:
         for column in sharding_columns:
             if column not in self.client.get_table_columns(self.get_metric_table_name()) or column not in self.metric.model_fields:
@@ -104,10 +425,18 @@ class ClickhouseDatastore(BaseDatastore):
                                  self.get_metric_table_name()}"
                 )
 
-    def _generate_sharding_clause(self, shard_key_values: tuple[Any]) -> str:
-        return f"WHERE {self._get_metric_fields(dict(zip(self.sharding_columns, shard_key_values)))}" if self.sharding_columns else ""
+    def _get_time_range_conditions(self, from_time: int, to_time: int = None) -> List[str]:
+        conditions = []
+        if from_time is not None and from_time > MIN_TIME:
+            conditions.append(f"timestamp_server >= {from_time}")
+        if to_time is not None:
+            conditions.append(f"timestamp_server <= {to_time}")
+        return conditions
+
+    def _generate_where_clause(self, conditions: List[str]) -> str:
+        return f"WHERE {' AND '.join(conditions)}" if conditions else ""
 
     def _extract_shard_key_values(self, shard_key: Dict[str, Any]) -> tuple[Any]:
         if self.sharding_columns is None:
             return self.DEFAULT_SHARD_KEY_VALUES
-        return tuple(shard_key[col] for col in self.sharding_columns)
\ No newline at end of file
+        return tuple(shard_key[col] for col in self.sharding_columns)
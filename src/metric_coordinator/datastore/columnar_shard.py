@@ -0,0 +1,234 @@
+import bisect
+import sys
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Type
+
+import numpy as np
+import pandas as pd
+
+from metric_coordinator.datastore.metric_schema import get_metric_dtypes
+from metric_coordinator.model import MetricData
+
+
+class ColumnarShard:
+    """
+    Rows of a single shard stored as one growable NumPy array per metric column.
+    Appends are amortized O(1): the arrays double their capacity when full, and the
+    DataFrame view is only built (and cached) when it is asked for.
+    """
+
+    INITIAL_CAPACITY = 16
+    GROWTH_FACTOR = 2
+
+    def __init__(self, dtypes: Dict[str, np.dtype], capacity: int = INITIAL_CAPACITY) -> None:
+        self.dtypes = dict(dtypes)
+        self._size = 0
+        self._capacity = max(capacity, 1)
+        self._columns = {col: np.empty(self._capacity, dtype=dtype) for col, dtype in self.dtypes.items()}
+        self._frame = None
+        self._time_indexes: Dict[Tuple[str, Tuple[str, ...]], TimeIndex] = {}
+        self._key_indexes: Dict[Tuple[str, ...], Dict[tuple, int]] = {}
+        self._object_row_nbytes = None
+
+    @classmethod
+    def from_metric(
+        cls, metric: Type[MetricData], capacity: int = INITIAL_CAPACITY, columns: Optional[List[str]] = None
+    ) -> "ColumnarShard":
+        return cls(get_metric_dtypes(metric, columns), capacity)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns.keys())
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Estimated memory used by the shard: the allocated arrays plus the Python objects held by object columns,
+        sized from the first appended row.
+        """
+        array_nbytes = sum(array.nbytes for array in self._columns.values())
+        return array_nbytes + self._size * (self._object_row_nbytes or 0)
+
+    def append(self, data: Dict[str, Any]) -> None:
+        """
+        Appends a block of rows given as column name -> array-like, all of the same length.
+        """
+        lengths = {len(values) for values in data.values()}
+        if len(lengths) != 1:
+            raise ValueError(f"Columns must have the same length, got {lengths}")
+        count = lengths.pop()
+        if count == 0:
+            return
+        missing_columns = [col for col in self._columns if col not in data]
+        if missing_columns:
+            raise ValueError(f"Missing columns in data: {', '.join(missing_columns)}")
+
+        if self._object_row_nbytes is None:
+            object_columns = [col for col, dtype in self.dtypes.items() if dtype == np.dtype(object)]
+            self._object_row_nbytes = sum(sys.getsizeof(data[col][0]) for col in object_columns)
+        self._reserve(self._size + count)
+        for col, array in self._columns.items():
+            array[self._size : self._size + count] = data[col]
+        self._size += count
+        self._frame = None
+        for time_index in self._time_indexes.values():
+            time_index.extend(self, self._size - count, self._size)
+        for key_columns, key_index in self._key_indexes.items():
+            self._extend_key_index(key_index, key_columns, self._size - count, self._size)
+
+    def keep(self, positions: np.ndarray) -> None:
+        """
+        Keeps only the rows at positions (in insertion order) and releases the memory of the others.
+        """
+        positions = np.sort(np.asarray(positions, dtype=np.int64))
+        self._capacity = max(len(positions), self.INITIAL_CAPACITY)
+        for col, array in self._columns.items():
+            kept = np.empty(self._capacity, dtype=array.dtype)
+            kept[: len(positions)] = array[positions]
+            self._columns[col] = kept
+        self._size = len(positions)
+        self._frame = None
+        self._time_indexes = {}
+        self._key_indexes = {}
+
+    def column(self, name: str) -> np.ndarray:
+        return self._columns[name][: self._size]
+
+    def row(self, position: int) -> pd.Series:
+        if position < 0:
+            position += self._size
+        if not 0 <= position < self._size:
+            raise IndexError(f"Row {position} out of range for shard of size {self._size}")
+        return pd.Series({col: array[position] for col, array in self._columns.items()}, name=position)
+
+    def find_last(self, timestamp_column: str, timestamp: Any, filters: Dict[str, Any] = None) -> Optional[int]:
+        """
+        Returns the position of the last inserted row whose timestamp_column equals timestamp
+        and that matches all filters, or None if there is no such row.
+        """
+        filters = filters or {}
+        key_columns = tuple(sorted(col for col in filters if col != timestamp_column))
+        time_index = self._get_time_index(timestamp_column, key_columns)
+        return time_index.find_last(tuple(filters[col] for col in key_columns), timestamp)
+
+    def find_latest(self, timestamp_column: str, filters: Dict[str, Any] = None) -> Optional[int]:
+        """
+        Returns the position of the row matching all filters with the greatest timestamp_column,
+        ties going to the last inserted row, or None if there is no such row.
+        """
+        filters = filters or {}
+        key_columns = tuple(sorted(col for col in filters if col != timestamp_column))
+        time_index = self._get_time_index(timestamp_column, key_columns)
+        return time_index.find_latest(tuple(filters[col] for col in key_columns))
+
+    def find_key_positions(self, key_columns: Tuple[str, ...], keys: List[tuple]) -> np.ndarray:
+        """
+        Returns for each key (values of key_columns) the position of the last row with that key, or -1
+        """
+        key_index = self._key_indexes.get(key_columns, None)
+        if key_index is None:
+            key_index = {}
+            self._extend_key_index(key_index, key_columns, 0, self._size)
+            self._key_indexes[key_columns] = key_index
+        return np.array([key_index.get(key, -1) for key in keys], dtype=np.int64)
+
+    def to_frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            self._frame = pd.DataFrame({col: array[: self._size] for col, array in self._columns.items()})
+        return self._frame
+
+    def _get_time_index(self, timestamp_column: str, key_columns: Tuple[str, ...]) -> "TimeIndex":
+        time_index = self._time_indexes.get((timestamp_column, key_columns), None)
+        if time_index is None:
+            time_index = TimeIndex(timestamp_column, key_columns)
+            time_index.extend(self, 0, self._size)
+            self._time_indexes[(timestamp_column, key_columns)] = time_index
+        return time_index
+
+    def _extend_key_index(
+        self,
+        key_index: Dict[tuple, int],
+        key_columns: Tuple[str, ...],
+        start: int,
+        stop: int,
+    ) -> None:
+        keys = zip(*(self.column(col)[start:stop].tolist() for col in key_columns), strict=True)
+        key_index.update(zip(keys, range(start, stop), strict=True))
+
+    def _reserve(self, capacity: int) -> None:
+        if capacity <= self._capacity:
+            return
+        new_capacity = self._capacity
+        while new_capacity < capacity:
+            new_capacity *= self.GROWTH_FACTOR
+        for col, array in self._columns.items():
+            grown = np.empty(new_capacity, dtype=array.dtype)
+            grown[: self._size] = array[: self._size]
+            self._columns[col] = grown
+        self._capacity = new_capacity
+
+
+class TimeIndex:
+    """
+    Sorted index on a timestamp column of a ColumnarShard, grouped by the values of key_columns.
+    Each group keeps its timestamps sorted with the matching row positions, so a lookup is a binary search.
+    Rows with equal timestamps stay in insertion order, and out-of-order rows are inserted at their sorted place.
+    """
+
+    def __init__(self, timestamp_column: str, key_columns: Tuple[str, ...] = ()) -> None:
+        self.timestamp_column = timestamp_column
+        self.key_columns = key_columns
+        self._groups: Dict[tuple, Tuple[List[Any], List[int]]] = {}
+
+    def extend(self, shard: ColumnarShard, start: int, stop: int) -> None:
+        if start >= stop:
+            return
+        timestamps = shard.column(self.timestamp_column)[start:stop]
+        if self.key_columns:
+            keys = pd.DataFrame({col: shard.column(col)[start:stop] for col in self.key_columns})
+            groups = keys.groupby(list(self.key_columns), sort=False, dropna=False).indices
+            groups = {key if isinstance(key, tuple) else (key,): positions for key, positions in groups.items()}
+        else:
+            groups = {(): np.arange(stop - start)}
+
+        for key, positions in groups.items():
+            order = np.argsort(timestamps[positions], kind="stable")
+            new_timestamps = timestamps[positions][order].tolist()
+            new_positions = (positions[order] + start).tolist()
+            group_timestamps, group_positions = self._groups.setdefault(key, ([], []))
+            if not group_timestamps or not new_timestamps[0] < group_timestamps[-1]:
+                # In-order block, the common case
+                group_timestamps.extend(new_timestamps)
+                group_positions.extend(new_positions)
+                continue
+            for timestamp, position in zip(new_timestamps, new_positions, strict=True):
+                i = bisect.bisect_right(group_timestamps, timestamp)
+                group_timestamps.insert(i, timestamp)
+                group_positions.insert(i, position)
+
+    def find_last(self, key: tuple, timestamp: Any) -> Optional[int]:
+        group = self._groups.get(key, None)
+        if group is None:
+            return None
+        group_timestamps, group_positions = group
+        try:
+            i = bisect.bisect_right(group_timestamps, timestamp) - 1
+        except TypeError:
+            # Not comparable with the stored timestamps (e.g. a datetime against dates) so it can not match
+            return None
+        if i < 0 or group_timestamps[i] != timestamp:
+            return None
+        return group_positions[i]
+
+    def find_latest(self, key: tuple) -> Optional[int]:
+        group = self._groups.get(key, None)
+        if group is None or not group[1]:
+            return None
+        return group[1][-1]
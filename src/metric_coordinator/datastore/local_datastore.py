@@ -1,131 +1,332 @@
+import collections
 import datetime
-from typing import Dict, Type, Union, Any, List
-import pandas as pd
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Type
+from typing import Union
+
 import numpy as np
+import pandas as pd
 
-from metric_coordinator.model import BaseDatastore, MetricData
+from metric_coordinator.datastore.columnar_shard import ColumnarShard
+from metric_coordinator.datastore.metric_schema import coerce_metric_dataframe
+from metric_coordinator.datastore.metric_schema import coerce_metric_keys
+from metric_coordinator.datastore.metric_schema import get_metric_key_columns
+from metric_coordinator.datastore.metric_schema import get_metric_projection
+from metric_coordinator.model import BaseDatastore
+from metric_coordinator.model import MetricData
 
 
 class LocalDatastore(BaseDatastore):
     DEFAULT_SHARD_KEY_VALUES = ("ALL",)
-    MINIMUM_VALUE_PUT_IN_BATCH = 1000
-    BATCH_PROCESSING = False
+    LATEST_ROW_ORDER_COLUMN = "timestamp_server"
 
-    def __init__(self, metric: MetricData, sharding_columns: tuple[str] = None, batch_size: int = 64) -> None:
+    def __init__(
+        self,
+        metric: MetricData,
+        sharding_columns: tuple[str] = None,
+        max_rows_per_shard: int = None,
+        max_total_rows: int = None,
+        max_total_bytes: int = None,
+        columns: Optional[List[str]] = None,
+    ) -> None:
         self.metric = metric
         self.sharding_columns = sorted(sharding_columns) if sharding_columns else []
-        self._batch_size = batch_size
-        self.shard_key_values_to_dataframe = {}
+        # Only the projected columns are stored, the other columns of the rows put are dropped
+        self.columns = get_metric_projection(metric, columns, self.sharding_columns)
+        self.max_rows_per_shard = max_rows_per_shard
+        self.max_total_rows = max_total_rows
+        self.max_total_bytes = max_total_bytes
+        # Least recently used shards first
+        self.shard_key_values_to_shard: collections.OrderedDict[tuple, ColumnarShard] = collections.OrderedDict()
+        self.evicted_shard_key_values: set[tuple] = set()
+        self._total_rows = 0
+        self._total_bytes = 0
+        self._eviction_count = 0
+        self._trimmed_row_count = 0
 
     def put(self, value: Union[pd.Series, pd.DataFrame]) -> None:
         if self.metric is None:
             raise ValueError("Datastore is not initialized or deactivated")
         if isinstance(value, pd.Series):
-            value = value.to_frame()
-        # TODO: implement batch writing.
-        # if value.shape[0] >= self.MINIMUM_VALUE_PUT_IN_BATCH and self.BATCH_PROCESSING:
-        #     self._put_in_batch(value)
-
-        self._put_row_by_row(value)
-
-    def _put_row_by_row(self, value):
-        for _, row in value.iterrows():
-            key_values = row[self.metric.Meta.key_columns].to_dict()
-            shard_key_values = self._extract_shard_key_values(key_values)
-            pydantic_row = self.metric(**row.to_dict()).model_dump()
-
-            if shard_key_values not in self.shard_key_values_to_dataframe:
-                    # Initialize empty DataFrame with metric model columns
-                empty_df = pd.DataFrame(columns=list(self.metric.model_fields.keys()))
-                self.shard_key_values_to_dataframe[shard_key_values] = empty_df
-                # TODO: implement dataframe limit
-            self.shard_key_values_to_dataframe[shard_key_values] = pd.concat(
-                    [self.shard_key_values_to_dataframe[shard_key_values], pd.DataFrame([pydantic_row])], ignore_index=True
-                )
+            value = value.to_frame().T
+        if value.empty:
+            return
+
+        self._put_columns(coerce_metric_dataframe(self.metric, value, self.columns))
+
+    def merge(self, value: pd.DataFrame) -> None:
+        """
+        Upserts rows like a ReplacingMergeTree: a row replaces any stored row with the same key columns.
+        Rows of evicted shards are dropped, those shards are reloaded whole from the source when used again.
+        """
+        if self.metric is None:
+            raise ValueError("Datastore is not initialized or deactivated")
+        if value is None or value.empty:
+            return
+        key_columns = get_metric_key_columns(self.metric)
+        columns = coerce_metric_dataframe(self.metric, value, self.columns)
+        if key_columns:
+            # Within the batch the last row of a key wins
+            latest = ~pd.DataFrame({col: columns[col] for col in key_columns}).duplicated(keep="last").to_numpy()
+            columns = {col: array[latest] for col, array in columns.items()}
+        self._put_columns(columns, replace_key_columns=tuple(key_columns) or None, skip_evicted=True)
+
+    def _put_columns(
+        self,
+        columns: Dict[str, np.ndarray],
+        replace_key_columns: tuple[str] = None,
+        skip_evicted: bool = False,
+    ) -> None:
+        for shard_key_values, positions in self._group_by_shard(columns).items():
+            if skip_evicted and shard_key_values in self.evicted_shard_key_values:
+                continue
+            shard = self._get_or_create_shard(shard_key_values)
+            rows_before, bytes_before = len(shard), shard.nbytes
+            if replace_key_columns and len(shard) > 0:
+                keys = list(zip(*(columns[col][positions].tolist() for col in replace_key_columns), strict=True))
+                replaced = shard.find_key_positions(replace_key_columns, keys)
+                replaced = replaced[replaced >= 0]
+                if len(replaced) > 0:
+                    shard.keep(np.setdiff1d(np.arange(len(shard)), replaced))
+            shard.append({col: array[positions] for col, array in columns.items()})
+            self._trim_shard(shard)
+            self._total_rows += len(shard) - rows_before
+            self._total_bytes += shard.nbytes - bytes_before
+            self._evict_shards()
 
     def get_metric(self) -> Type[MetricData]:
         return self.metric
 
-    def get_latest_row(self, shard_key: Dict[str, Any]) -> pd.Series:
+    def get_latest_row(self, shard_key: Dict[str, Any], use_default_value: bool = True) -> pd.Series:
         if self.metric is None:
             raise ValueError("Datastore is not initialized or deactivated")
-        result_df = self.shard_key_values_to_dataframe.get(self._extract_shard_key_values(shard_key), None)
-        if result_df is None:
-            return pd.Series(self.metric(**shard_key).model_dump())
-        return result_df.iloc[-1]
+        shard = self._get_shard(self._extract_shard_key_values(shard_key))
+        position = self._find_latest_position(shard, shard_key)
+        if position is None:
+            if not use_default_value:
+                return None
+            return pd.Series(self.metric(**shard_key).model_dump(include=set(self.columns)))
+        return shard.row(position)
 
     def get_row_by_timestamp(
         self, shard_key: Dict[str, Any], timestamp: datetime.date, timestamp_column: str, use_default_value: bool = False
     ) -> pd.Series:
         if self.metric is None:
             raise ValueError("Datastore is not initialized or deactivated")
-        result_df = self.shard_key_values_to_dataframe.get(self._extract_shard_key_values(shard_key), None)
+        shard = self._get_shard(self._extract_shard_key_values(shard_key))
 
-        # TODO: make this cleaner
-        if timestamp_column not in shard_key:
-            shard_key[timestamp_column] = timestamp
+        filters = dict(shard_key)
+        if timestamp_column not in filters:
+            filters[timestamp_column] = timestamp
         else:
-            assert (
-                shard_key[timestamp_column] == timestamp
-            ), f"Timestamp {
-                shard_key[timestamp_column]} != {timestamp}"
+            assert filters[timestamp_column] == timestamp, f"Timestamp {filters[timestamp_column]} != {timestamp}"
 
-        # TODO: optimize for subset of shard_key extraction
-        final_result_df = self._subset_df(result_df, shard_key)
+        position = shard.find_last(timestamp_column, timestamp, filters) if shard is not None else None
 
-        if final_result_df.empty:
+        if position is None:
             if use_default_value:
                 # TODO: make sure this will never hang.
-                return pd.Series(self.metric(**shard_key).model_dump())
+                return pd.Series(self.metric(**filters).model_dump(include=set(self.columns)))
             else:
                 return None
-        return final_result_df.iloc[-1]
+        return shard.row(position)
+
+    def get_latest_rows(self, shard_keys: pd.DataFrame, use_default_value: bool = True) -> pd.DataFrame:
+        if self.metric is None:
+            raise ValueError("Datastore is not initialized or deactivated")
+        positions = []
+        for key in self._iter_keys(shard_keys):
+            shard = self._get_shard(self._extract_shard_key_values(key))
+            positions.append((shard, self._find_latest_position(shard, key)))
+        return self._gather_rows(shard_keys, positions, use_default_value)
+
+    def get_rows_by_timestamp(
+        self,
+        shard_keys: pd.DataFrame,
+        timestamp_column: str,
+        use_default_value: bool = False,
+    ) -> pd.DataFrame:
+        if self.metric is None:
+            raise ValueError("Datastore is not initialized or deactivated")
+        positions = []
+        for key in self._iter_keys(shard_keys):
+            shard = self._get_shard(self._extract_shard_key_values(key))
+            position = shard.find_last(timestamp_column, key[timestamp_column], key) if shard is not None else None
+            positions.append((shard, position))
+        return self._gather_rows(shard_keys, positions, use_default_value)
+
+    def get_dataframe(self, shard_key: Dict[str, Any]) -> pd.DataFrame:
+        shard = self._get_shard(self._extract_shard_key_values(shard_key))
+        if shard is None:
+            return pd.DataFrame(columns=self.columns)
+        return shard.to_frame()
+
+    def is_evicted(self, shard_key: Dict[str, Any]) -> bool:
+        return self._extract_shard_key_values(shard_key) in self.evicted_shard_key_values
+
+    def reload_shards(self, shard_keys: List[Dict[str, Any]], df: pd.DataFrame) -> None:
+        """
+        Replaces the content of the given shards with the rows of df, e.g. to bring back evicted shards
+        from the source. The rows put into an evicted shard since its eviction may not be in the source yet,
+        they are merged back over df.
+        """
+        put_since_eviction = []
+        for shard_key in shard_keys:
+            shard_key_values = self._extract_shard_key_values(shard_key)
+            shard = self.shard_key_values_to_shard.get(shard_key_values, None)
+            if shard_key_values in self.evicted_shard_key_values and shard is not None and len(shard) > 0:
+                put_since_eviction.append(shard.to_frame())
+            self._remove_shard(shard_key_values)
+            self.evicted_shard_key_values.discard(shard_key_values)
+        if df is not None:
+            self.put(df)
+        if put_since_eviction:
+            self.merge(pd.concat(put_since_eviction, ignore_index=True))
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "shards": len(self.shard_key_values_to_shard),
+            "rows": self._total_rows,
+            "bytes": self._total_bytes,
+            "evicted_shards": len(self.evicted_shard_key_values),
+            "evictions": self._eviction_count,
+            "trimmed_rows": self._trimmed_row_count,
+        }
 
     def close(self) -> None:
         self.table_name = None
         self.metric = None
         self._clean_data()
 
-    def _subset_df(self, df: pd.DataFrame, filters: dict) -> pd.DataFrame:
-        mask = pd.Series(True, index=df.index)
-        for col, val in filters.items():
-            mask &= df[col] == val
-        return df[mask]
-
     def reload_data(self, df: pd.DataFrame) -> None:
         self._clean_data()
         self.put(df)
 
-    def _put_in_batch(self, value):
-        batch: Dict[tuple[Any], List[pd.DataFrame]] = {}
-        for _, row in value.iterrows():
-            key_values = row[self.metric.Meta.sharding_columns].to_dict()
-            batch[self._extract_shard_key_values(key_values)].append(row)
-            # flush batch if it is full
-            if len(batch[self._extract_shard_key_values(key_values)]) == self._batch_size:
-                self.shard_key_values_to_dataframe[self._extract_shard_key_values(key_values)] = pd.concat(
-                    batch[self._extract_shard_key_values(key_values)], ignore_index=True
-                )
-                batch[self._extract_shard_key_values(key_values)] = []
-        # flush remaining batch
-        for key, rows in batch.items():
-            self.shard_key_values_to_dataframe[key] = pd.concat(rows, ignore_index=True)
+    def _find_latest_position(self, shard: ColumnarShard, shard_key: Dict[str, Any]) -> Optional[int]:
+        if shard is None or len(shard) == 0:
+            return None
+        if self.LATEST_ROW_ORDER_COLUMN not in self.columns:
+            return len(shard) - 1
+        # Rows put back from the source can arrive out of order, so pick the latest by timestamp
+        return shard.find_latest(self.LATEST_ROW_ORDER_COLUMN, shard_key)
+
+    def _iter_keys(self, shard_keys: pd.DataFrame):
+        columns = list(shard_keys.columns)
+        shard_keys = coerce_metric_keys(self.metric, shard_keys)
+        for values in zip(*(shard_keys[col].to_numpy(dtype=object) for col in columns), strict=True):
+            yield dict(zip(columns, values, strict=True))
+
+    def _gather_rows(self, shard_keys: pd.DataFrame, positions: list, use_default_value: bool) -> pd.DataFrame:
+        """
+        Builds the result of a batch lookup from one (shard, position) per key, position None meaning not found.
+        Each column is gathered once over all the shards, rows are put back in key order with a single take.
+        """
+        columns = self.columns
+        rows_by_shard: Dict[int, tuple] = {}
+        for i, (shard, position) in enumerate(positions):
+            if position is not None:
+                rows_by_shard.setdefault(id(shard), (shard, [], []))
+                rows_by_shard[id(shard)][1].append(i)
+                rows_by_shard[id(shard)][2].append(position)
+        key_positions = [np.asarray(keys, dtype=np.int64) for _, keys, _ in rows_by_shard.values()]
+        parts = {col: [shard.column(col)[rows] for shard, _, rows in rows_by_shard.values()] for col in columns}
+
+        missing = [i for i, (_, position) in enumerate(positions) if position is None]
+        if missing and use_default_value:
+            missing_keys = shard_keys.iloc[missing].reset_index(drop=True)
+            defaults = coerce_metric_dataframe(self.metric, missing_keys, self.columns)
+            key_positions.append(np.asarray(missing, dtype=np.int64))
+            for col in columns:
+                parts[col].append(defaults[col])
+
+        if not key_positions:
+            return pd.DataFrame(index=shard_keys.index, columns=columns)
+        order = np.concatenate(key_positions)
+        if len(order) == len(shard_keys):
+            # Every key has a row, order[j] is the key of gathered row j
+            take = np.empty(len(order), dtype=np.int64)
+            take[order] = np.arange(len(order))
+            gathered = {col: np.concatenate(parts[col]).take(take) for col in columns}
+            return pd.DataFrame(gathered, index=shard_keys.index)
+        result = pd.DataFrame({col: np.concatenate(parts[col]) for col in columns}, index=order)
+        result = result.reindex(range(len(shard_keys)))
+        result.index = shard_keys.index
+        return result
+
+    def _group_by_shard(self, columns: Dict[str, np.ndarray]) -> Dict[tuple, np.ndarray]:
+        """
+        Splits the rows into shards with a single groupby over the sharding columns
+        e.g. {(1001,): array([0, 2]), (1002,): array([1])}
+        """
+        row_count = len(next(iter(columns.values())))
+        if not self.sharding_columns:
+            return {self.DEFAULT_SHARD_KEY_VALUES: np.arange(row_count)}
+        keys = pd.DataFrame({col: columns[col] for col in self.sharding_columns})
+        groups = keys.groupby(self.sharding_columns, sort=False, dropna=False).indices
+        return {key if isinstance(key, tuple) else (key,): positions for key, positions in groups.items()}
+
+    def _get_shard(self, shard_key_values: tuple) -> Optional[ColumnarShard]:
+        shard = self.shard_key_values_to_shard.get(shard_key_values, None)
+        if shard is not None:
+            self.shard_key_values_to_shard.move_to_end(shard_key_values)
+        return shard
+
+    def _get_or_create_shard(self, shard_key_values: tuple) -> ColumnarShard:
+        shard = self._get_shard(shard_key_values)
+        if shard is None:
+            shard = ColumnarShard.from_metric(self.metric, columns=self.columns)
+            self.shard_key_values_to_shard[shard_key_values] = shard
+            self._total_bytes += shard.nbytes
+        return shard
+
+    def _remove_shard(self, shard_key_values: tuple) -> None:
+        shard = self.shard_key_values_to_shard.pop(shard_key_values, None)
+        if shard is not None:
+            self._total_rows -= len(shard)
+            self._total_bytes -= shard.nbytes
+
+    def _trim_shard(self, shard: ColumnarShard) -> None:
+        # Keep the most recent rows of the shard, older ones can still be found in the source
+        if self.max_rows_per_shard is None or len(shard) <= self.max_rows_per_shard:
+            return
+        if self.LATEST_ROW_ORDER_COLUMN in self.columns:
+            order = np.argsort(shard.column(self.LATEST_ROW_ORDER_COLUMN), kind="stable")
+        else:
+            order = np.arange(len(shard))
+        self._trimmed_row_count += len(shard) - self.max_rows_per_shard
+        shard.keep(order[-self.max_rows_per_shard :])
+
+    def _is_over_limit(self) -> bool:
+        return (self.max_total_rows is not None and self._total_rows > self.max_total_rows) or (
+            self.max_total_bytes is not None and self._total_bytes > self.max_total_bytes
+        )
+
+    def _evict_shards(self) -> None:
+        # The most recently used shard is never evicted, so the rows just put are always available
+        while self._is_over_limit() and len(self.shard_key_values_to_shard) > 1:
+            shard_key_values = next(iter(self.shard_key_values_to_shard))
+            self._remove_shard(shard_key_values)
+            self.evicted_shard_key_values.add(shard_key_values)
+            self._eviction_count += 1
 
     def _clean_data(self) -> None:
-        self.shard_key_values_to_dataframe = {}
+        self.shard_key_values_to_shard = collections.OrderedDict()
+        self.evicted_shard_key_values = set()
+        self._total_rows = 0
+        self._total_bytes = 0
 
     def _extract_shard_key_values(self, shard_key: Dict[str, Any]) -> tuple:
         """
         Extracts the values of the shard key based on the sharding columns as a tuple
         e.g. {'login': 1001, 'date': datetime.date(2021, 1, 1)} -> (1001, datetime.date(2021, 1, 1))
         """
-        if not shard_key or self.sharding_columns is None:
+        if not shard_key or not self.sharding_columns:
             return self.DEFAULT_SHARD_KEY_VALUES
         missing_columns = [col for col in self.sharding_columns if col not in shard_key]
         if missing_columns:
-            raise ValueError(
-                f"Missing columns in shard_key: {
-                             ', '.join(missing_columns)}"
-            )
+            raise ValueError(f"Missing columns in shard_key: {', '.join(missing_columns)}")
 
         return tuple(shard_key[col] for col in self.sharding_columns)
@@ -0,0 +1,157 @@
+import datetime
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Type
+
+import numpy as np
+import pandas as pd
+
+from metric_coordinator.configs import numpy_type_map
+from metric_coordinator.model import MetricData
+
+
+def get_metric_dtypes(metric: Type[MetricData], columns: Optional[List[str]] = None) -> Dict[str, np.dtype]:
+    """
+    Maps each metric field (or each projected column) to the NumPy dtype used to store it,
+    e.g. int -> int64, str/date -> object
+    """
+    fields = _get_metric_fields(metric, columns)
+    return {k: np.dtype(numpy_type_map.get(v.annotation.__name__, object)) for k, v in fields.items()}
+
+
+def get_metric_key_columns(metric: Type[MetricData]) -> List[str]:
+    """
+    Columns annotated as key, the ORDER BY of the ReplacingMergeTree tables the metric is emitted to
+    """
+    return [k for k, v in metric.model_fields.items() if "key" in v.metadata]
+
+
+def get_metric_sharding_columns(metric: Type[MetricData]) -> Optional[List[str]]:
+    """
+    Sharding columns declared on the metric Meta (e.g. ["login"]), None when the metric declares none
+    """
+    return getattr(getattr(metric, "Meta", None), "sharding_columns", None)
+
+
+def get_metric_projection(
+    metric: Type[MetricData], columns: Optional[List[str]] = None, required_columns: Optional[Sequence[str]] = None
+) -> List[str]:
+    """
+    Columns to read for a projection, in the metric field order. The key columns, timestamp_server and required_columns
+    (e.g. sharding columns) are always part of it, no projection means every metric field.
+    e.g. ["Balance"] -> ["Login", "Date", "Balance", "timestamp_server"]
+    """
+    if columns is None:
+        return list(metric.model_fields.keys())
+    unknown = [col for col in columns if col not in metric.model_fields]
+    if unknown:
+        raise ValueError(f"Unknown columns {', '.join(unknown)} for {metric.__name__}")
+    projected = set(columns) | set(get_metric_key_columns(metric)) | set(required_columns or ()) | {"timestamp_server"}
+    return [col for col in metric.model_fields if col in projected]
+
+
+def coerce_metric_dataframe(
+    metric: Type[MetricData],
+    df: pd.DataFrame,
+    columns: Optional[List[str]] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Validates and coerces a whole DataFrame against the metric schema (or a projection of it) column by column.
+    Missing columns are filled with the field default, extra columns are dropped.
+    Returns column name -> array in the metric field order, with the dtypes of get_metric_dtypes.
+    """
+    dtypes = get_metric_dtypes(metric, columns)
+    result = {}
+    for field_name, field in _get_metric_fields(metric, columns).items():
+        if field_name not in df.columns:
+            if field.is_required():
+                raise ValueError(f"Missing required column {field_name} for {metric.__name__}")
+            default = field.get_default(call_default_factory=True)
+            array = np.empty(len(df), dtype=dtypes[field_name])
+            array[:] = [default] * len(df) if dtypes[field_name] == np.dtype(object) else default
+            result[field_name] = array
+            continue
+        try:
+            result[field_name] = _coerce_column(df[field_name], field.annotation)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid value in column {field_name} for {metric.__name__}: {e}") from e
+    return result
+
+
+def coerce_metric_keys(metric: Type[MetricData], keys: pd.DataFrame) -> pd.DataFrame:
+    """
+    Coerces only the columns present in keys (e.g. shard keys and a timestamp) to their metric types
+    """
+    columns = {col: _coerce_column(keys[col], metric.model_fields[col].annotation) for col in keys.columns}
+    return pd.DataFrame(columns, index=keys.index)
+
+
+def align_metric_rows(
+    metric: Type[MetricData], keys: pd.DataFrame, rows: pd.DataFrame, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """
+    Matches rows to keys on the key columns and returns one metric row per key, aligned with the index of keys.
+    When several rows match a key the first one wins, keys without a match get an all-NA row.
+    """
+    key_columns = list(keys.columns)
+    columns = list(_get_metric_fields(metric, columns).keys())
+    coerced_keys = coerce_metric_keys(metric, keys).reset_index(drop=True)
+    if rows is None or rows.empty:
+        result = pd.DataFrame(index=coerced_keys.index, columns=columns)
+    else:
+        found = pd.DataFrame(coerce_metric_dataframe(metric, rows, columns)).drop_duplicates(
+            subset=key_columns,
+            keep="first",
+        )
+        result = coerced_keys.merge(found, on=key_columns, how="left", indicator=True)
+        missing = result.pop("_merge") == "left_only"
+        result = result[columns]
+        result.loc[missing, key_columns] = None
+    result.index = keys.index
+    return result
+
+
+def _get_metric_fields(metric: Type[MetricData], columns: Optional[List[str]] = None) -> Dict[str, Any]:
+    if columns is None:
+        return metric.model_fields
+    return {k: v for k, v in metric.model_fields.items() if k in columns}
+
+
+def _coerce_column(series: pd.Series, annotation: type) -> np.ndarray:
+    if series.isna().any() and annotation is not float:
+        raise ValueError("null values are not allowed")
+
+    if annotation is int:
+        if pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            return series.to_numpy(dtype=np.int64)
+        numeric = pd.to_numeric(series)
+        if pd.api.types.is_float_dtype(numeric.dtype) and not (numeric == np.floor(numeric)).all():
+            raise ValueError("fractional values are not valid integers")
+        return numeric.to_numpy(dtype=np.int64)
+    if annotation is float:
+        return pd.to_numeric(series).to_numpy(dtype=np.float64)
+    if annotation is str:
+        if pd.api.types.infer_dtype(series, skipna=False) == "string":
+            return series.to_numpy(dtype=object)
+        return np.array([_to_str(v) for v in series.to_numpy(dtype=object)], dtype=object)
+    if annotation is datetime.date:
+        if pd.api.types.infer_dtype(series, skipna=False) == "date":
+            return series.to_numpy(dtype=object)
+        return pd.to_datetime(series).dt.date.to_numpy(dtype=object)
+    if annotation is datetime.datetime:
+        is_datetime64 = pd.api.types.is_datetime64_any_dtype(series.dtype)
+        if pd.api.types.infer_dtype(series, skipna=False) == "datetime" and not is_datetime64:
+            return series.to_numpy(dtype=object)
+        return np.array(pd.to_datetime(series).dt.to_pydatetime(), dtype=object)
+    return series.to_numpy(dtype=object)
+
+
+def _to_str(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError(f"{type(value).__name__} is not a valid string")
@@ -0,0 +1,118 @@
+import collections
+import time
+from typing import Callable
+from typing import Deque
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import pandas as pd
+
+from metric_coordinator.background_writer import BackgroundWriter
+
+
+class WriteBehindBuffer(BackgroundWriter):
+    """
+    Coalesces the rows written to a datastore table and writes them in batches from a background thread, in put order.
+    A batch is written once it holds max_batch_rows rows or its oldest row waited max_delay seconds,
+    and put blocks while max_pending_rows rows are waiting to be written.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[pd.DataFrame], None],
+        name: str,
+        max_batch_rows: int = 10000,
+        max_delay: float = 1.0,
+        max_pending_rows: int = 100000,
+        max_retries: int = 5,
+        dead_letter_dir: str = None,
+        close_timeout: float = 30.0,
+    ) -> None:
+        if max_pending_rows < max_batch_rows:
+            raise ValueError(f"max_pending_rows ({max_pending_rows}) must be >= max_batch_rows ({max_batch_rows})")
+        self.write = write
+        self.max_batch_rows = max_batch_rows
+        self.max_delay = max_delay
+        self.max_pending_rows = max_pending_rows
+        # (put time, rows) in put order, a failed batch is put back at the front
+        self._pending: Deque[Tuple[float, pd.DataFrame]] = collections.deque()
+        self._pending_rows = 0
+        self._written_batch_count = 0
+        super().__init__(
+            name,
+            f"{name}WriteBehind",
+            max_retries=max_retries,
+            dead_letter_dir=dead_letter_dir,
+            close_timeout=close_timeout,
+        )
+
+    def put(self, value: Union[pd.Series, pd.DataFrame]) -> None:
+        df = value.to_frame().T if isinstance(value, pd.Series) else value
+        if df.empty:
+            return
+        with self._condition:
+            if self._closed:
+                raise ValueError(f"Write-behind buffer {self.name} is closed")
+            while self._pending_rows >= self.max_pending_rows:
+                self._condition.wait()
+            self._pending.append((time.monotonic(), df))
+            self._pending_rows += len(df)
+            self._condition.notify_all()
+
+    def get_stats(self) -> dict:
+        with self._condition:
+            return {
+                "pending_rows": self._pending_rows,
+                "written_batches": self._written_batch_count,
+                "dead_letter_batches": self._dead_letter_count,
+            }
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def _is_batch_ready(self) -> bool:
+        if not self._pending:
+            return False
+        if self._closed:
+            return True
+        if time.monotonic() < self._retry_time:
+            return False
+        if self._flush_requests > 0 or self._pending_rows >= self.max_batch_rows:
+            return True
+        return time.monotonic() - self._pending[0][0] >= self.max_delay
+
+    def _get_wait_time(self) -> Optional[float]:
+        if not self._pending:
+            return None
+        now = time.monotonic()
+        if now < self._retry_time:
+            return self._retry_time - now
+        return max(self._pending[0][0] + self.max_delay - now, 0.0)
+
+    def _take_batch(self) -> List[Tuple[float, pd.DataFrame]]:
+        batch, batch_rows = [], 0
+        while self._pending and (not batch or batch_rows + len(self._pending[0][1]) <= self.max_batch_rows):
+            put_time, df = self._pending.popleft()
+            batch.append((put_time, df))
+            batch_rows += len(df)
+        self._pending_rows -= batch_rows
+        self._condition.notify_all()
+        return batch
+
+    def _load_batch(self, batch: List[Tuple[float, pd.DataFrame]]) -> pd.DataFrame:
+        return pd.concat([df for _, df in batch], ignore_index=True)
+
+    def _write_batch(self, data: pd.DataFrame) -> None:
+        self.write(data)
+
+    def _on_batch_written(self, batch: List[Tuple[float, pd.DataFrame]], data: pd.DataFrame, seconds: float) -> None:
+        self._written_batch_count += 1
+
+    def _on_batch_failed(self, batch: List[Tuple[float, pd.DataFrame]]) -> None:
+        self._pending.extendleft(reversed(batch))
+        self._pending_rows += sum(len(df) for _, df in batch)
+
+    def _on_batch_dropped(self, batch: List[Tuple[float, pd.DataFrame]]) -> None:
+        pass
@@ -1,14 +1,23 @@
-import pandas as pd
-from datetime import datetime
 import warnings
-from typing import List, Type, Dict
+from datetime import datetime
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Type
 
-from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
+import pandas as pd
 from account_metrics import METRIC_CALCULATORS
-from metric_coordinator.datastore.clickhouse_datastore import ClickhouseDatastore
-from metric_coordinator.datastore.cache_datastore import CacheDatastore
-from metric_coordinator.model import BaseDataEmitter, BaseDatastore, MetricData, BaseMetricRunner
+
+from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
 from metric_coordinator.configs import Settings
+from metric_coordinator.data_emiter.emit_queue import EmitQueue
+from metric_coordinator.datastore.cache_datastore import CacheDatastore
+from metric_coordinator.datastore.clickhouse_datastore import ClickhouseDatastore
+from metric_coordinator.datastore.metric_schema import get_metric_sharding_columns
+from metric_coordinator.model import BaseDataEmitter
+from metric_coordinator.model import BaseDatastore
+from metric_coordinator.model import BaseMetricRunner
+from metric_coordinator.model import MetricData
 
 warnings.filterwarnings("ignore")
 
@@ -22,6 +31,8 @@ class MetricRunner(BaseMetricRunner):
         self.input_class = input_class
         self.datastore_metric_table_names = None
         self.clickhouse_client = None
+        # Emit queue of each emitter, by id of the emitter
+        self._emit_queues: Dict[int, EmitQueue] = {}
 
     def build(self, metrics: List[Type[MetricData]], emits: List[BaseDataEmitter]):
         for metric in metrics:
@@ -34,6 +45,7 @@ class MetricRunner(BaseMetricRunner):
         self.get_datastore(metric).put(result)
 
     def process_metrics(self, input_data: pd.DataFrame) -> Dict[Type[MetricData], pd.DataFrame]:
+        self.prefetch_datastores(input_data)
         results = {}
         for metric in self._metrics:
             calculator = METRIC_CALCULATORS[metric]
@@ -42,10 +54,74 @@ class MetricRunner(BaseMetricRunner):
         self.update_metric(metric, results[metric])
         return results
 
-    def emit_metrics(self) -> None:
-        # TODO: add logic retry
-        for emiter in self._emiters:
-            emiter.emit_metrics(self._metrics)
+    def prefetch_datastores(self, input_data: pd.DataFrame) -> None:
+        # Load the shards of all the logins of the batch at once instead of one cache miss per deal
+        for datastore in self._datastores.values():
+            if not isinstance(datastore, CacheDatastore) or not datastore.sharding_columns:
+                continue
+            if all(col in input_data.columns for col in datastore.sharding_columns):
+                datastore.prefetch(input_data[list(datastore.sharding_columns)])
+
+    def emit_metrics(self, results: Dict[Type[MetricData], pd.DataFrame]) -> None:
+        # With EMIT_ASYNC every emitter has its own queue and background thread, so a slow emitter only delays itself
+        # while the next batch is computed. A full queue applies EMIT_QUEUE_OVERFLOW (block, drop_oldest or spill).
+        # The rows still queued are not in ClickHouse yet, so a full cache reload in the meantime does not see them.
+        if not self.settings.EMIT_ASYNC:
+            for emiter in self._emiters:
+                emiter.emit(results)
+            return
+        for emit_queue in self._get_emit_queues():
+            emit_queue.put(results)
+
+    def flush_emits(self) -> None:
+        for emit_queue in self._emit_queues.values():
+            emit_queue.flush()
+
+    def get_emit_stats(self) -> Dict[str, dict]:
+        """
+        Lag and throughput counters of the emit queue of each emitter, by queue name
+        """
+        return {emit_queue.name: emit_queue.get_stats() for emit_queue in self._emit_queues.values()}
+
+    def close(self) -> None:
+        """
+        Drains the emit queues, every batch computed so far is emitted before the emitters are closed,
+        then writes the rows the datastores still buffer (write-behind) to their source
+        and closes the pooled ClickHouse connections.
+        Everything is closed even if some of it fails, the failures are raised together at the end.
+        """
+        errors = []
+        closers = [(emit_queue.name, emit_queue.close) for emit_queue in self._emit_queues.values()]
+        closers += [(type(emiter).__name__, emiter.close) for emiter in self._emiters]
+        for metric, datastore in self._datastores.items():
+            if isinstance(datastore, CacheDatastore):
+                closers.append((metric.__name__, datastore.close))
+        if self.clickhouse_client:
+            closers.append((type(self.clickhouse_client).__name__, self.clickhouse_client.close))
+        for name, close in closers:
+            try:
+                close()
+            except Exception as e:
+                print(f"Error closing {name}: {e}")
+                errors.append(f"{name} ({e})")
+        self._emit_queues = {}
+        if errors:
+            raise ValueError(f"Failed to close {', '.join(errors)}")
+
+    def _get_emit_queues(self) -> List[EmitQueue]:
+        for i, emiter in enumerate(self._emiters):
+            if id(emiter) not in self._emit_queues:
+                self._emit_queues[id(emiter)] = EmitQueue(
+                    emiter.emit,
+                    f"{type(emiter).__name__}{i}",
+                    max_batches=self.settings.EMIT_QUEUE_MAX_BATCHES,
+                    overflow_policy=self.settings.EMIT_QUEUE_OVERFLOW,
+                    spill_dir=self.settings.EMIT_SPILL_DIR,
+                    max_retries=self.settings.EMIT_MAX_RETRIES,
+                    dead_letter_dir=self.settings.EMIT_DEAD_LETTER_DIR,
+                    close_timeout=self.settings.EMIT_CLOSE_TIMEOUT,
+                )
+        return [self._emit_queues[id(emiter)] for emiter in self._emiters]
 
     def validate(self) -> None:
         # TODO: add logic to validate and detect schema changes
@@ -59,6 +135,11 @@ class MetricRunner(BaseMetricRunner):
                 host=self.settings.CLICKHOUSE_HOST,
                 http_port=self.settings.CLICKHOUSE_HTTP_PORT,
                 database=self.settings.CLICKHOUSE_DATABASE,
+                pool_size=self.settings.CLICKHOUSE_POOL_SIZE,
+                pool_idle_timeout=self.settings.CLICKHOUSE_POOL_IDLE_TIMEOUT,
+                pool_health_check_interval=self.settings.CLICKHOUSE_POOL_HEALTH_CHECK_INTERVAL,
+                transport=self.settings.CLICKHOUSE_TRANSPORT,
+                read_strategy=self.settings.CLICKHOUSE_READ_STRATEGY,
             )
 
     def setup_datastore(self, metric_class: Type[MetricData]) -> BaseDatastore:
@@ -70,7 +151,71 @@ class MetricRunner(BaseMetricRunner):
             if self.datastore_metric_table_names is None or metric_class not in self.datastore_metric_table_names
             else self.datastore_metric_table_names.get(metric_class)
         )
-        return CacheDatastore(metric_class, ClickhouseDatastore(metric_class, self.clickhouse_client, table_name=table_name))
+        # Lazy loading and the cache limits need the cache to be sharded, by the sharding columns declared on the metric
+        cache_limits = (
+            self.settings.CACHE_MAX_ROWS_PER_SHARD,
+            self.settings.CACHE_MAX_TOTAL_ROWS,
+            self.settings.CACHE_MAX_TOTAL_BYTES,
+        )
+        sharded = self.settings.CACHE_LOAD_MODE == "lazy" or any(limit is not None for limit in cache_limits)
+        sharding_columns = get_metric_sharding_columns(metric_class) if sharded else None
+        # The latest state views are created by ClickhouseEmitter for the metrics it emits that declare sharding columns,
+        # the metrics only read as additional data (e.g. MT5Deal, MT5DealDaily) have no {table}_latest to read
+        latest_state_view = (
+            self.settings.CLICKHOUSE_LATEST_STATE_VIEWS
+            and metric_class in self._metrics
+            and get_metric_sharding_columns(metric_class) is not None
+        )
+        return CacheDatastore(
+            metric_class,
+            ClickhouseDatastore(
+                metric_class,
+                self.clickhouse_client,
+                table_name=table_name,
+                sharding_columns=sharding_columns,
+                load_partitions=self.settings.CLICKHOUSE_LOAD_PARTITIONS,
+                load_partition_by=self.settings.CLICKHOUSE_LOAD_PARTITION_BY,
+                latest_rows_strategy=self.settings.CLICKHOUSE_LATEST_ROWS_STRATEGY,
+                columns=self.get_metric_columns(metric_class),
+                latest_state_view=latest_state_view,
+                load_latest_state=latest_state_view and self.settings.CACHE_LOAD_LATEST_STATE,
+            ),
+            max_rows_per_shard=self.settings.CACHE_MAX_ROWS_PER_SHARD,
+            max_total_rows=self.settings.CACHE_MAX_TOTAL_ROWS,
+            max_total_bytes=self.settings.CACHE_MAX_TOTAL_BYTES,
+            load_mode=self.settings.CACHE_LOAD_MODE,
+            incremental_refresh=self.settings.CACHE_INCREMENTAL_REFRESH,
+            full_reload_interval=self.settings.CACHE_FULL_RELOAD_INTERVAL,
+            background_refresh=self.settings.CACHE_BACKGROUND_REFRESH,
+            max_staleness=self.settings.CACHE_MAX_STALENESS,
+            fallback_memo_size=self.settings.CACHE_FALLBACK_MEMO_SIZE,
+            fallback_memo_ttl=self.settings.CACHE_FALLBACK_MEMO_TTL,
+            write_behind=self.settings.CACHE_WRITE_BEHIND,
+            write_batch_rows=self.settings.CACHE_WRITE_BATCH_ROWS,
+            write_max_delay=self.settings.CACHE_WRITE_MAX_DELAY,
+            write_max_pending_rows=self.settings.CACHE_WRITE_MAX_PENDING_ROWS,
+            write_max_retries=self.settings.CACHE_WRITE_MAX_RETRIES,
+            write_dead_letter_dir=self.settings.CACHE_WRITE_DEAD_LETTER_DIR,
+            load_block_size=self.settings.CACHE_LOAD_BLOCK_SIZE,
+        )
+
+    def get_metric_columns(self, metric_class: Type[MetricData]) -> Optional[List[str]]:
+        """
+        Columns the datastore of metric_class reads: METRIC_COLUMNS of the settings, otherwise the union
+        of the columns declared by the calculators using it (additional_data_columns).
+        None (every column) if any of them declares none.
+        """
+        if metric_class.__name__ in self.settings.METRIC_COLUMNS:
+            return self.settings.METRIC_COLUMNS[metric_class.__name__]
+        columns = set()
+        for calculator in METRIC_CALCULATORS.values():
+            if not calculator or metric_class not in calculator.additional_data:
+                continue
+            declared = getattr(calculator, "additional_data_columns", {}).get(metric_class)
+            if declared is None:
+                return None
+            columns.update(declared)
+        return sorted(columns) if columns else None
 
     def setup_datasore_metric_table_names(self, metric_table_names: Dict[Type[MetricData], str]) -> None:
         self.datastore_metric_table_names = metric_table_names
@@ -1,8 +1,14 @@
 import abc
 import datetime
-from typing import Annotated, Any, Dict, Type, Literal, List
-import pandas as pd
+from typing import Annotated
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Literal
+from typing import Type
 
+import pandas as pd
 from account_metrics.metric_model import MetricData
 
 from metric_coordinator.configs import MIN_TIME
@@ -21,16 +27,32 @@ class BaseDatastore(object):
     @abc.abstractmethod
     def get_latest_row(self, shard_key: Dict[str, int]) -> pd.Series:
         raise NotImplementedError()
-    
+
     # # TODO: support get key columns
     # @abc.abstractmethod
     # def get_key_columns(self) -> List[str]:
     #     raise NotImplementedError()
-    
+
     @abc.abstractmethod
     def get_row_by_timestamp(self, shard_key: Dict[str, int], timestamp: datetime.date, timestamp_column: str) -> pd.Series:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def get_latest_rows(self, shard_keys: pd.DataFrame) -> pd.DataFrame:
+        """
+        Batch variant of get_latest_row: one shard key per row of shard_keys,
+        returns a DataFrame of metric rows aligned with the index of shard_keys.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get_rows_by_timestamp(self, shard_keys: pd.DataFrame, timestamp_column: str) -> pd.DataFrame:
+        """
+        Batch variant of get_row_by_timestamp: shard_keys holds the shard key columns and timestamp_column,
+        returns a DataFrame of metric rows aligned with the index of shard_keys (all NA where no row is found).
+        """
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def close(self) -> None:
         raise NotImplementedError()
@@ -38,9 +60,35 @@ class BaseDatastore(object):
     @abc.abstractmethod
     def drop(self) -> None:
         raise NotImplementedError()
-    
-class SourceDatastore():
-    def eager_load(self, shard_key_values: tuple[Any] = None, from_time: int = MIN_TIME, to_time: int = datetime.datetime.now()) -> pd.DataFrame:
+
+
+class SourceDatastore:
+    def eager_load(
+        self, shard_key_values: tuple[Any] = None, from_time: int = MIN_TIME, to_time: int = datetime.datetime.now()
+    ) -> pd.DataFrame:
+        raise NotImplementedError()
+
+    def eager_load_stream(
+        self,
+        shard_key_values: tuple[Any] = None,
+        from_time: int = MIN_TIME,
+        to_time: int = None,
+        block_size: int = None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Streaming variant of eager_load yielding blocks of at most block_size rows,
+        sources that cannot stream yield the whole eager_load result as a single block
+        """
+        if to_time is None:
+            yield self.eager_load(shard_key_values, from_time)
+        else:
+            yield self.eager_load(shard_key_values, from_time, to_time)
+
+    def eager_load_shards(self, shard_keys: pd.DataFrame, from_time: int = MIN_TIME) -> pd.DataFrame:
+        """
+        Loads every row of several shards at once, one shard key per row of shard_keys,
+        optionally only the rows with timestamp_server >= from_time
+        """
         raise NotImplementedError()
 
 
@@ -57,6 +105,11 @@ class BaseDataEmitter(abc.ABC):
     def initialize_metric(self, metric: Type[MetricData]) -> Literal[True]:
         raise NotImplementedError()
 
+    def close(self) -> None:  # noqa: B027
+        """
+        Releases what the emitter holds (threads, connections), intentionally a no-op for emitters holding nothing
+        """
+
 
 class BaseMetricRunner(abc.ABC):
 
@@ -0,0 +1,163 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+from account_metrics import MT5DealDaily
+from pandas.testing import assert_frame_equal
+
+from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
+from metric_coordinator.api_client.query_builder import get_in_condition
+from metric_coordinator.configs import type_map
+from metric_coordinator.datastore.clickhouse_datastore import ClickhouseDatastore
+from tests.conftest import get_test_settings
+from tests.conftest import insert_data_into_clickhouse
+from tests.conftest import join_metric_name_test_name
+from tests.conftest import load_csv
+
+
+def get_test_client(pool_size: int = 4, transport: str = "pandas", read_strategy: str = "final") -> ClickhouseClient:
+    settings = get_test_settings()
+    return ClickhouseClient(
+        username=settings.CLICKHOUSE_USERNAME,
+        password=settings.CLICKHOUSE_PASSWORD,
+        host=settings.CLICKHOUSE_HOST,
+        http_port=settings.CLICKHOUSE_HTTP_PORT,
+        database=settings.CLICKHOUSE_DATABASE,
+        pool_size=pool_size,
+        transport=transport,
+        read_strategy=read_strategy,
+    )
+
+
+def get_metric_fields(metric) -> str:
+    return ", ".join([f"{k} {type_map.get(v.annotation.__name__)}" for k, v in metric.model_fields.items()])
+
+
+def measure_query_time(client: ClickhouseClient, num_queries: int = 50) -> float:
+    start = time.perf_counter()
+    for _ in range(num_queries):
+        assert client.query_df("SELECT 1 AS one")["one"].iloc[0] == 1
+    return (time.perf_counter() - start) / num_queries
+
+
+class TestClickhouseClient:
+    @staticmethod
+    def test_clickhouse_client_pool_reuses_connections():
+        client = get_test_client(pool_size=2)
+        client.query_df("SELECT 1")
+        ch_client = client._idle_clients[-1][0]
+        client.query_dml("SELECT 1")
+        assert len(client._idle_clients) == 1
+        assert client._idle_clients[-1][0] is ch_client
+
+        # Concurrent callers never hold more than pool_size connections
+        threads = [threading.Thread(target=client.query_df, args=("SELECT sleep(0.1)",)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(client._idle_clients) <= 2
+        client.close()
+        assert len(client._idle_clients) == 0
+
+    @staticmethod
+    def test_clickhouse_client_pool_benchmark():
+        unpooled_time = measure_query_time(get_test_client(pool_size=0))
+        pooled_client = get_test_client(pool_size=4)
+        pooled_client.query_df("SELECT 1")
+        pooled_time = measure_query_time(pooled_client)
+        pooled_client.close()
+        # Only reported, timings are too noisy on a shared host to be asserted
+        print(f"Per query time: {unpooled_time * 1000:.2f}ms without pool, {pooled_time * 1000:.2f}ms with pool")
+
+    @staticmethod
+    def test_clickhouse_client_arrow_transport(get_test_name):
+        pytest.importorskip("pyarrow")
+        client = get_test_client(transport="arrow")
+        ch_datastore = ClickhouseDatastore(
+            MT5DealDaily,
+            client,
+            table_name=join_metric_name_test_name(MT5DealDaily, get_test_name),
+        )
+        metric_fields = get_metric_fields(MT5DealDaily)
+        keys = ", ".join([k for k, v in MT5DealDaily.model_fields.items() if "key" in v.metadata])
+        assert client.create_metric_if_not_exist(ch_datastore.get_metric_table_name(), metric_fields, keys)
+        expected_df = load_csv(MT5DealDaily)
+        insert_data_into_clickhouse(ch_datastore, MT5DealDaily, get_test_name)
+
+        # Results keep the Arrow types, they are only converted when compared
+        retrieved_df = ch_datastore.eager_load()
+        assert all(isinstance(dtype, pd.ArrowDtype) for dtype in retrieved_df.dtypes)
+        retrieved_df = retrieved_df.sort_values(["Login", "Date"]).reset_index(drop=True)
+        expected_df = expected_df.sort_values(["Login", "Date"]).reset_index(drop=True)
+        assert_frame_equal(retrieved_df.astype(object), expected_df.astype(object), check_dtype=False)
+        ch_datastore.close()
+
+    @staticmethod
+    def test_clickhouse_client_read_strategies_benchmark(get_test_name):
+        client = get_test_client()
+        table_name = join_metric_name_test_name(MT5DealDaily, get_test_name)
+        metric_fields = get_metric_fields(MT5DealDaily)
+        key_columns = [k for k, v in MT5DealDaily.model_fields.items() if "key" in v.metadata]
+        assert client.create_metric_if_not_exist(table_name, metric_fields, ", ".join(key_columns))
+        # Insert every row twice, the second version with a newer timestamp_server and balance
+        expected_df = load_csv(MT5DealDaily)
+        client.insert_df(table_name, expected_df)
+        new_version_df = expected_df.assign(
+            timestamp_server=expected_df["timestamp_server"] + 1,
+            Balance=expected_df["Balance"] + 1,
+        )
+        client.insert_df(table_name, new_version_df)
+
+        results = {}
+        for read_strategy in ClickhouseClient.READ_STRATEGIES:
+            strategy_client = get_test_client(read_strategy=read_strategy)
+            start = time.perf_counter()
+            df = strategy_client.query_deduplicated_df(
+                table_name,
+                key_columns,
+                columns=list(MT5DealDaily.model_fields.keys()),
+            )
+            print(f"Read strategy {read_strategy}: {(time.perf_counter() - start) * 1000:.2f}ms for {len(df)} rows")
+            results[read_strategy] = df.sort_values(key_columns, ignore_index=True)
+            blocks = list(
+                strategy_client.query_deduplicated_df_stream(
+                    table_name, key_columns, columns=list(MT5DealDaily.model_fields.keys()), block_size=10
+                )
+            )
+            assert sum(len(block) for block in blocks) == len(expected_df)
+
+        for df in results.values():
+            assert len(df) == len(expected_df)
+            assert list(df["Balance"]) == list(results["final"]["Balance"])
+            expected_versions = new_version_df.sort_values(key_columns)["timestamp_server"].to_numpy()
+            assert (df["timestamp_server"].to_numpy() == expected_versions).all()
+        client.drop_tables([table_name])
+
+    @staticmethod
+    def test_clickhouse_client_parameterized_queries(get_test_name):
+        condition = get_in_condition(("Login", "Date"), ("Int64", "Date32"))
+        assert condition == "(Login, Date) IN {keys:Array(Tuple(Int64, Date32))}"
+        assert get_in_condition(("Login",), ("Int64",)) is get_in_condition(("Login",), ("Int64",))
+
+        client = get_test_client()
+        ch_datastore = ClickhouseDatastore(
+            MT5DealDaily,
+            client,
+            table_name=join_metric_name_test_name(MT5DealDaily, get_test_name),
+        )
+        metric_fields = get_metric_fields(MT5DealDaily)
+        keys = ", ".join([k for k, v in MT5DealDaily.model_fields.items() if "key" in v.metadata])
+        assert client.create_metric_if_not_exist(ch_datastore.get_metric_table_name(), metric_fields, keys)
+        expected_df = load_csv(MT5DealDaily)
+        insert_data_into_clickhouse(ch_datastore, MT5DealDaily, get_test_name)
+
+        # A large login set is bound as one array parameter, the statement is built once and reused
+        logins = list(expected_df["Login"].unique()) + list(range(10**6, 10**6 + 20000))
+        retrieved_df = ch_datastore.get_latest_rows(pd.DataFrame({"Login": logins}))
+        assert retrieved_df["Login"].notna().sum() == expected_df["Login"].nunique()
+        for login in expected_df["Login"].unique()[:3]:
+            assert ch_datastore.get_latest_row({"Login": login})["Login"] == login
+        assert len(ch_datastore._statements) == 2
+        ch_datastore.close()
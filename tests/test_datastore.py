@@ -1,20 +1,25 @@
 import datetime
-import pytest
+import time
+
 import pandas as pd
+import pytest
+from account_metrics import AccountMetricDaily
+from account_metrics import MetricData
+from account_metrics import MT5DealDaily
+from pandas.testing import assert_frame_equal
 from pandas.testing import assert_series_equal
 
+from metric_coordinator.configs import type_map
 from metric_coordinator.data_retriever.clickhouse_data_retriever import ClickhouseClient
-from account_metrics import AccountMetricDaily, MT5DealDaily, MetricData
+from metric_coordinator.datastore.cache_datastore import CacheDatastore
 from metric_coordinator.datastore.clickhouse_datastore import ClickhouseDatastore
-from tests.conftest import (
-    METRICS,
-    join_metric_name_test_name,
-    get_test_settings,
-    insert_data_into_clickhouse,
-    load_csv,
-)
-from metric_coordinator.configs import type_map
 from metric_coordinator.datastore.local_datastore import LocalDatastore
+from metric_coordinator.datastore.write_behind_buffer import WriteBehindBuffer
+from tests.conftest import get_test_settings
+from tests.conftest import insert_data_into_clickhouse
+from tests.conftest import join_metric_name_test_name
+from tests.conftest import load_csv
+from tests.conftest import METRICS
 
 
 @pytest.fixture
@@ -74,6 +79,7 @@ def setup_and_teardown_local_datastore_sharded(request):
     for metric in METRICS:
         datastores[metric].close()
 
+
 def sample_dataframe_of_metric(metric: MetricData, num_rows: int = 1000):
     pass
 
@@ -90,6 +96,7 @@ def convert_date_column(row: pd.Series, metric: MetricData):
         row["Date"] = row["Date"].date()
     return row
 
+
 class TestClickhouseDatastore:
     @staticmethod
     def test_clickhouse_datastore_get_latest_row(setup_and_teardown_clickhouse_datastore):
@@ -116,12 +123,12 @@ class TestClickhouseDatastore:
             expected_df = load_csv(metric)
 
             expected_last_row = expected_df.iloc[-1]
-            login_key = 'login' if 'login' in expected_last_row else 'Login'
+            login_key = "login" if "login" in expected_last_row else "Login"
 
             retrieved_last_row = ch_datastores[metric].get_row_by_timestamp(
-                shard_key={login_key: expected_last_row[login_key]}, 
-                timestamp=expected_last_row["timestamp_utc"], 
-                timestamp_column="timestamp_utc"
+                shard_key={login_key: expected_last_row[login_key]},
+                timestamp=expected_last_row["timestamp_utc"],
+                timestamp_column="timestamp_utc",
             )
 
             retrieved_last_row = convert_date_column(retrieved_last_row, metric)
@@ -162,6 +169,102 @@ class TestClickhouseDatastore:
             retrieved_last_row = convert_date_column(retrieved_last_row, metric)
             assert_series_equal(retrieved_last_row, expected_last_row, check_index=False, check_names=False)
 
+    @staticmethod
+    def test_clickhouse_datastore_eager_load_stream(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        expected_df = load_csv(MT5DealDaily)
+
+        blocks = list(ch_datastores[MT5DealDaily].eager_load_stream(block_size=10))
+        assert all(len(block) <= 10 for block in blocks)
+        assert sum(len(block) for block in blocks) == len(expected_df)
+        # The blocks hold the same rows as a single eager_load
+        streamed_df = pd.concat(blocks, ignore_index=True).sort_values(["Login", "Date"], ignore_index=True)
+        loaded_df = ch_datastores[MT5DealDaily].eager_load().sort_values(["Login", "Date"], ignore_index=True)
+        assert_frame_equal(streamed_df, loaded_df)
+
+    @staticmethod
+    def test_clickhouse_datastore_eager_load_partitions(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        expected_df = load_csv(MT5DealDaily)
+        single_query_df = ch_datastores[MT5DealDaily].eager_load().sort_values(["Login", "Date"], ignore_index=True)
+        assert len(single_query_df) == len(expected_df)
+
+        # The partitions hold the same rows as the single query load, each of them exactly once
+        for load_partition_by in ["key", "timestamp_server"]:
+            ch_datastore = ClickhouseDatastore(
+                MT5DealDaily,
+                ch_datastores[MT5DealDaily].client,
+                table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+                load_partitions=3,
+                load_partition_by=load_partition_by,
+            )
+            partitioned_df = ch_datastore.eager_load()
+            assert_frame_equal(partitioned_df.sort_values(["Login", "Date"], ignore_index=True), single_query_df)
+            streamed_df = pd.concat(ch_datastore.eager_load_stream(block_size=10), ignore_index=True)
+            assert_frame_equal(streamed_df.sort_values(["Login", "Date"], ignore_index=True), single_query_df)
+
+    @staticmethod
+    def test_clickhouse_datastore_load_partitions_leave_a_connection(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        client = ch_datastores[MT5DealDaily].client
+
+        # Loads never hold every pooled connection, one is left to the lookups
+        for pool_size, expected_partitions in [(4, 3), (2, 1), (1, 1), (0, 8)]:
+            pooled_client = ClickhouseClient(
+                client.username, client.password, client.host, client.http_port, client.database, pool_size=pool_size
+            )
+            ch_datastore = ClickhouseDatastore(
+                MT5DealDaily,
+                pooled_client,
+                table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+                load_partitions=8,
+            )
+            assert ch_datastore.load_partitions == expected_partitions
+
+    @staticmethod
+    def test_clickhouse_datastore_get_latest_rows_by_shard_key(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        expected_df = load_csv(MT5DealDaily)
+        expected_latest_df = expected_df.sort_values("timestamp_server").groupby("Login").tail(1).set_index("Login")
+
+        for latest_rows_strategy in ["limit_by", "argmax"]:
+            ch_datastore = ClickhouseDatastore(
+                MT5DealDaily,
+                ch_datastores[MT5DealDaily].client,
+                table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+                latest_rows_strategy=latest_rows_strategy,
+            )
+            shard_keys = pd.DataFrame({"Login": list(expected_df["Login"]) + [1999]})
+            retrieved_df = ch_datastore.get_latest_rows_by_shard_key(shard_keys)
+            assert sorted(retrieved_df.index) == sorted(expected_latest_df.index)
+            for login, expected_row in expected_latest_df.iterrows():
+                assert retrieved_df.loc[login, "timestamp_server"] == expected_row["timestamp_server"]
+
+    @staticmethod
+    def test_clickhouse_datastore_column_projection(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        expected_df = load_csv(MT5DealDaily)
+
+        ch_datastore = ClickhouseDatastore(
+            MT5DealDaily,
+            ch_datastores[MT5DealDaily].client,
+            table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+            columns=["Balance"],
+        )
+        # The key columns and timestamp_server are always read
+        assert "Balance" in ch_datastore.columns and "timestamp_server" in ch_datastore.columns
+        assert "Group" not in ch_datastore.columns
+        retrieved_df = ch_datastore.eager_load()
+        assert list(retrieved_df.columns) == ch_datastore.columns
+        assert len(retrieved_df) == len(expected_df)
+        login = expected_df["Login"].iloc[0]
+        assert list(ch_datastore.get_latest_row({"Login": login}).index) == ch_datastore.columns
+        assert list(ch_datastore.get_latest_rows(pd.DataFrame({"Login": [login]})).columns) == ch_datastore.columns
+
 
 class TestLocalDatastore:
     # @staticmethod
@@ -172,33 +275,485 @@ class TestLocalDatastore:
     #         insert_data_into_local_datastore(local_datastores[metric], expected_df)
     #         expected_last_row = expected_df.iloc[-1]
     #         retrieved_last_row = local_datastores[metric].get_latest_row(shard_key={})
-            
+
     #         assert_series_equal(retrieved_last_row, expected_last_row, check_index=False, check_names=False)
-        
-    
+
     @staticmethod
     def test_local_datastore_put_2(setup_and_teardown_local_datastore_sharded):
         local_datastores, _ = setup_and_teardown_local_datastore_sharded
         metric = AccountMetricDaily
         expected_df = load_csv(metric)
         insert_data_into_local_datastore(local_datastores[metric], expected_df)
-        
+
         expected_last_row = expected_df.iloc[-1]
-            
-        shard_key =  {'date': datetime.date(2024, 7, 9), 'login': 500390, 'server': 'demo'}
+
+        shard_key = {"date": datetime.date(2024, 7, 9), "login": 500390, "server": "demo"}
         retrieved_last_row = local_datastores[metric].get_latest_row(shard_key=shard_key)
         assert_series_equal(retrieved_last_row, expected_last_row, check_index=False, check_names=False)
-        
-        shard_key2 =  {'date': datetime.date(2024, 8, 19), 'login': 500387, 'server': 'demo'}
+
+        shard_key2 = {"date": datetime.date(2024, 8, 19), "login": 500387, "server": "demo"}
         retrieved_last_row2 = local_datastores[metric].get_latest_row(shard_key=shard_key2)
         expected_last_row2 = expected_df.iloc[-2]
         assert_series_equal(retrieved_last_row2, expected_last_row2, check_index=False, check_names=False)
 
+    @staticmethod
+    def test_local_datastore_reload_data():
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"])
+        expected_df = load_csv(MT5DealDaily)
+        local_datastore.reload_data(expected_df)
+
+        for login, expected_login_df in expected_df.groupby("Login"):
+            retrieved_df = local_datastore.get_dataframe({"Login": login})
+            assert len(retrieved_df) == len(expected_login_df)
+            retrieved_last_row = local_datastore.get_latest_row({"Login": login})
+            assert_series_equal(retrieved_last_row, expected_login_df.iloc[-1], check_index=False, check_names=False)
+
+        # Reloading replaces the previous content of every shard
+        first_login = expected_df["Login"].iloc[0]
+        local_datastore.reload_data(expected_df[expected_df["Login"] == first_login])
+        other_login = expected_df[expected_df["Login"] != first_login]["Login"].iloc[0]
+        assert local_datastore.get_dataframe({"Login": other_login}).empty
+        local_datastore.close()
+
+    @staticmethod
+    def test_local_datastore_put_coerces_schema():
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"])
+        df = pd.DataFrame({"Login": [1999.0, 1999.0], "Balance": ["10.5", 20], "Date": ["2024-07-08", "2024-07-09"]})
+        local_datastore.put(df)
+
+        retrieved_last_row = local_datastore.get_latest_row({"Login": 1999})
+        last_row = MT5DealDaily(Login=1999, Balance=20.0, Date=datetime.date(2024, 7, 9))
+        expected_last_row = pd.Series(last_row.model_dump())
+        assert_series_equal(
+            retrieved_last_row,
+            expected_last_row,
+            check_index=False,
+            check_names=False,
+            check_dtype=False,
+        )
+
+        with pytest.raises(ValueError):
+            local_datastore.put(pd.DataFrame({"Login": [1999.5]}))
+        local_datastore.close()
+
+    @staticmethod
+    def test_local_datastore_get_row_by_timestamp_out_of_order():
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"])
+        expected_df = load_csv(MT5DealDaily)
+        login = expected_df["Login"].iloc[0]
+        expected_login_df = expected_df[expected_df["Login"] == login]
+
+        # Put the newest rows first, then the older ones as a source fallback would
+        local_datastore.put(expected_login_df.iloc[len(expected_login_df) // 2 :])
+        for i in reversed(range(len(expected_login_df) // 2)):
+            local_datastore.put(expected_login_df.iloc[i])
+
+        for _, expected_row in expected_login_df.iterrows():
+            retrieved_row = local_datastore.get_row_by_timestamp({"Login": login}, expected_row["Date"], "Date")
+            assert_series_equal(retrieved_row, expected_row, check_index=False, check_names=False)
+        retrieved_last_row = local_datastore.get_latest_row({"Login": login})
+        assert_series_equal(retrieved_last_row, expected_login_df.iloc[-1], check_index=False, check_names=False)
+        assert local_datastore.get_row_by_timestamp({"Login": login}, datetime.date(1960, 1, 1), "Date") is None
+        local_datastore.close()
+
+    @staticmethod
+    def test_local_datastore_get_rows_by_timestamp_batch():
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"])
+        expected_df = load_csv(MT5DealDaily)
+        local_datastore.put(expected_df)
+
+        shard_keys = expected_df[["Login", "Date"]].iloc[::-1]
+        shard_keys.loc[-1] = [expected_df["Login"].iloc[0], datetime.date(1960, 1, 1)]
+        retrieved_df = local_datastore.get_rows_by_timestamp(shard_keys, "Date")
+
+        assert list(retrieved_df.index) == list(shard_keys.index)
+        assert retrieved_df.loc[-1].isna().all()
+        for i, expected_row in expected_df.iterrows():
+            assert_series_equal(
+                retrieved_df.loc[i],
+                expected_row,
+                check_index=False,
+                check_names=False,
+                check_dtype=False,
+            )
+
+        shard_keys = pd.DataFrame({"Login": [expected_df["Login"].iloc[-1], 1999]})
+        retrieved_latest_df = local_datastore.get_latest_rows(shard_keys)
+        assert_series_equal(
+            retrieved_latest_df.iloc[0],
+            expected_df.iloc[-1],
+            check_index=False,
+            check_names=False,
+            check_dtype=False,
+        )
+        assert retrieved_latest_df.iloc[1]["Login"] == 1999
+        local_datastore.close()
+
+    @staticmethod
+    def test_local_datastore_limits():
+        expected_df = load_csv(MT5DealDaily)
+        logins = expected_df["Login"].unique()
+        assert len(logins) >= 2
+
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"], max_rows_per_shard=3)
+        local_datastore.put(expected_df)
+        for login in logins:
+            login_df = expected_df[expected_df["Login"] == login]
+            assert len(local_datastore.get_dataframe({"Login": login})) == 3
+            assert_series_equal(
+                local_datastore.get_latest_row({"Login": login}),
+                login_df.iloc[-1],
+                check_index=False,
+                check_names=False,
+            )
+        assert local_datastore.get_stats()["rows"] == 3 * len(logins)
+
+        # Only the most recently used shard fits, the others are evicted
+        local_datastore = LocalDatastore(
+            metric=MT5DealDaily,
+            sharding_columns=["Login"],
+            max_total_rows=len(expected_df) - 1,
+        )
+        local_datastore.put(expected_df)
+        stats = local_datastore.get_stats()
+        assert stats["shards"] < len(logins)
+        assert stats["rows"] <= len(expected_df) - 1
+        assert stats["evictions"] == stats["evicted_shards"] == len(logins) - stats["shards"]
+        evicted_login = next(login for login in logins if local_datastore.is_evicted({"Login": login}))
+
+        local_datastore.reload_shards([{"Login": evicted_login}], expected_df[expected_df["Login"] == evicted_login])
+        assert not local_datastore.is_evicted({"Login": evicted_login})
+        evicted_df = local_datastore.get_dataframe({"Login": evicted_login})
+        assert len(evicted_df) == (expected_df["Login"] == evicted_login).sum()
+
+        # A row put into an evicted shard is kept when the shard is reloaded from a source that does not have it yet
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"], max_total_rows=1)
+        local_datastore.put(expected_df)
+        evicted_login = next(login for login in logins if local_datastore.is_evicted({"Login": login}))
+        login_df = expected_df[expected_df["Login"] == evicted_login]
+        put_row = login_df.iloc[-1].copy()
+        put_row["timestamp_server"] = expected_df["timestamp_server"].max() + 1
+        put_row["Balance"] = put_row["Balance"] + 1
+        local_datastore.put(put_row)
+        assert local_datastore.is_evicted({"Login": evicted_login})
+
+        local_datastore.reload_shards([{"Login": evicted_login}], login_df)
+        assert local_datastore.get_latest_row({"Login": evicted_login})["Balance"] == put_row["Balance"]
+
+    @staticmethod
+    def test_local_datastore_merge():
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"])
+        expected_df = load_csv(MT5DealDaily)
+        local_datastore.put(expected_df)
+        login = expected_df["Login"].iloc[0]
+        expected_login_df = expected_df[expected_df["Login"] == login]
+
+        # A delta re-sends the latest row of the login with a new value, it replaces the stored row with the same key
+        updated_row = expected_login_df.iloc[-1].copy()
+        updated_row["Balance"] = updated_row["Balance"] + 1
+        local_datastore.merge(updated_row.to_frame().T)
+
+        assert len(local_datastore.get_dataframe({"Login": login})) == len(expected_login_df)
+        retrieved_row = local_datastore.get_row_by_timestamp({"Login": login}, updated_row["Date"], "Date")
+        assert retrieved_row["Balance"] == updated_row["Balance"]
+        local_datastore.close()
+
+    @staticmethod
+    def test_local_datastore_column_projection():
+        local_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"], columns=["Balance"])
+        full_datastore = LocalDatastore(metric=MT5DealDaily, sharding_columns=["Login"])
+        expected_df = load_csv(MT5DealDaily)
+        local_datastore.put(expected_df)
+        full_datastore.put(expected_df)
+        login = expected_df["Login"].iloc[0]
+
+        assert "Group" not in local_datastore.columns and "Balance" in local_datastore.columns
+        assert list(local_datastore.get_dataframe({"Login": login}).columns) == local_datastore.columns
+        expected_balance = full_datastore.get_latest_row({"Login": login})["Balance"]
+        assert local_datastore.get_latest_row({"Login": login})["Balance"] == expected_balance
+        latest_rows = local_datastore.get_latest_rows(pd.DataFrame({"Login": [login, 1999]}))
+        assert list(latest_rows.columns) == local_datastore.columns
+        assert local_datastore.get_stats()["bytes"] < full_datastore.get_stats()["bytes"]
+        with pytest.raises(ValueError):
+            LocalDatastore(metric=MT5DealDaily, columns=["Unknown"])
+
     # TODO: add more test cases (with cluster columns = logins also)
     def test_local_datastore_get(setup_and_teardown_local_datastore):
         pass
 
+
 class TestCacheDatastore:
     @staticmethod
     def test_cache_datastore_get_row_by_timestamp():
         pass
+
+    @staticmethod
+    def test_cache_datastore_lazy_load(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        source_datastore = ClickhouseDatastore(
+            MT5DealDaily,
+            ch_datastores[MT5DealDaily].client,
+            table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+            sharding_columns=["Login"],
+        )
+        cache_datastore = CacheDatastore(MT5DealDaily, source_datastore, load_mode="lazy")
+        expected_df = load_csv(MT5DealDaily)
+
+        # All the logins of the batch are loaded at once, and only once
+        cache_datastore.prefetch(expected_df[["Login"]])
+        assert cache_datastore.get_stats()["shard_loads"] == expected_df["Login"].nunique()
+        assert cache_datastore.get_stats()["rows"] == len(expected_df)
+
+        expected_last_row = expected_df.iloc[-1]
+        retrieved_last_row = cache_datastore.get_row_by_timestamp(
+            {"Login": expected_last_row["Login"]},
+            expected_last_row["Date"],
+            "Date",
+        )
+        assert_series_equal(retrieved_last_row, expected_last_row, check_index=False, check_names=False)
+        assert cache_datastore.get_stats()["shard_loads"] == expected_df["Login"].nunique()
+
+    @staticmethod
+    def test_cache_datastore_lazy_load_failure(setup_and_teardown_clickhouse_datastore, monkeypatch):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        source_datastore = ClickhouseDatastore(
+            MT5DealDaily,
+            ch_datastores[MT5DealDaily].client,
+            table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+            sharding_columns=["Login"],
+        )
+        cache_datastore = CacheDatastore(
+            MT5DealDaily,
+            source_datastore,
+            load_mode="lazy",
+            load_interval=0,
+            incremental_refresh=False,
+        )
+        expected_last_row = load_csv(MT5DealDaily).iloc[-1]
+        shard_key = {"Login": expected_last_row["Login"]}
+        assert cache_datastore.get_latest_row(shard_key)["Balance"] == expected_last_row["Balance"]
+
+        # A failed reload keeps the cached rows of the shard and is retried by the next lookup
+        monkeypatch.setattr(source_datastore, "eager_load_shards", lambda shard_keys, from_time=None: None)
+        assert cache_datastore.get_latest_row(shard_key)["Balance"] == expected_last_row["Balance"]
+        assert cache_datastore.get_stats()["shard_loads"] == 1
+        monkeypatch.undo()
+        assert cache_datastore.get_latest_row(shard_key)["Balance"] == expected_last_row["Balance"]
+        assert cache_datastore.get_stats()["shard_loads"] == 2
+
+    @staticmethod
+    def test_cache_datastore_eager_limits(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        # Without sharding columns every row is in a single shard, the limits would drop the rows of unrelated logins
+        with pytest.raises(ValueError, match="sharding columns"):
+            CacheDatastore(MT5DealDaily, ch_datastores[MT5DealDaily], max_total_rows=5)
+
+        source_datastore = ClickhouseDatastore(
+            MT5DealDaily,
+            ch_datastores[MT5DealDaily].client,
+            table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+            sharding_columns=["Login"],
+        )
+        cache_datastore = CacheDatastore(MT5DealDaily, source_datastore, max_rows_per_shard=1, max_total_rows=1)
+        expected_df = load_csv(MT5DealDaily)
+
+        # Evicted logins are reloaded and trimmed rows are read from the source, never replaced by default rows
+        for login, login_df in expected_df.groupby("Login"):
+            assert cache_datastore.get_latest_row({"Login": login})["Balance"] == login_df.iloc[-1]["Balance"]
+            first_row = login_df.iloc[0]
+            retrieved_row = cache_datastore.get_row_by_timestamp({"Login": login}, first_row["Date"], "Date")
+            assert retrieved_row["Balance"] == first_row["Balance"]
+        assert cache_datastore.get_stats()["rows"] == 1
+        assert cache_datastore.get_stats()["evictions"] > 0
+
+    @staticmethod
+    def test_cache_datastore_background_refresh(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        cache_datastore = CacheDatastore(
+            MT5DealDaily,
+            ch_datastores[MT5DealDaily],
+            load_interval=0,
+            background_refresh=True,
+        )
+        expected_df = load_csv(MT5DealDaily)
+        expected_last_row = expected_df.iloc[-1]
+        shard_key = {"Login": expected_last_row["Login"]}
+
+        # The first load blocks, later ones run in the background while lookups keep reading the current cache
+        assert_series_equal(
+            cache_datastore.get_latest_row(shard_key),
+            expected_last_row,
+            check_index=False,
+            check_names=False,
+        )
+        new_row = expected_last_row.copy()
+        new_row["Balance"] = new_row["Balance"] + 1
+        new_row["timestamp_server"] = new_row["timestamp_server"] + 1
+        ch_datastores[MT5DealDaily].put(new_row.to_frame().T)
+
+        # Lookups keep being served by the current cache until the refreshed one is swapped in by a later lookup
+        deadline = time.monotonic() + 30
+        while cache_datastore.get_latest_row(shard_key)["Balance"] != new_row["Balance"]:
+            assert time.monotonic() < deadline, "The background refresh was never swapped in"
+            time.sleep(0.05)
+
+    @staticmethod
+    def test_cache_datastore_full_reload(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        cache_datastore = CacheDatastore(
+            MT5DealDaily,
+            ch_datastores[MT5DealDaily],
+            load_interval=0,
+            full_reload_interval=0,
+        )
+        first_row = load_csv(MT5DealDaily).iloc[0]
+        shard_key = {"Login": first_row["Login"]}
+        retrieved_row = cache_datastore.get_row_by_timestamp(shard_key, first_row["Date"], "Date")
+        assert retrieved_row["Balance"] == first_row["Balance"]
+
+        # A late row is older than the watermark, only a full reload picks it up
+        late_row = first_row.copy()
+        late_row["Balance"] = late_row["Balance"] + 1
+        ch_datastores[MT5DealDaily].put(late_row.to_frame().T)
+        cache_datastore.get_latest_row(shard_key)
+        retrieved_row = cache_datastore.get_row_by_timestamp(shard_key, first_row["Date"], "Date")
+        assert retrieved_row["Balance"] == late_row["Balance"]
+
+    @staticmethod
+    def test_cache_datastore_fallback_memo(setup_and_teardown_clickhouse_datastore):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        cache_datastore = CacheDatastore(MT5DealDaily, ch_datastores[MT5DealDaily])
+        expected_last_row = load_csv(MT5DealDaily).iloc[-1]
+
+        # A key the source has no row for is only looked up once
+        for _ in range(3):
+            retrieved_row = cache_datastore.get_row_by_timestamp(
+                {"Login": expected_last_row["Login"]},
+                datetime.date(1960, 1, 1),
+                "Date",
+            )
+            assert retrieved_row is None
+        assert cache_datastore.get_stats()["source_fallbacks"] == 1
+        assert cache_datastore.get_stats()["fallback_memo_hits"] == 2
+
+        # The memo of a shard is dropped when the shard is reloaded,
+        # the source may have a newer version of the row by then
+        source_datastore = ClickhouseDatastore(
+            MT5DealDaily,
+            ch_datastores[MT5DealDaily].client,
+            table_name=join_metric_name_test_name(MT5DealDaily, test_name),
+            sharding_columns=["Login"],
+        )
+        # Only the latest row of each login is cached, older ones are looked up in the source
+        cache_datastore = CacheDatastore(
+            MT5DealDaily,
+            source_datastore,
+            load_mode="lazy",
+            load_interval=0,
+            max_rows_per_shard=1,
+        )
+        expected_df = load_csv(MT5DealDaily)
+        first_row = expected_df[expected_df["Login"] == expected_last_row["Login"]].iloc[0]
+        shard_key = {"Login": first_row["Login"]}
+        retrieved_row = cache_datastore.get_row_by_timestamp(shard_key, first_row["Date"], "Date")
+        assert retrieved_row["Balance"] == first_row["Balance"]
+        updated_row = first_row.copy()
+        updated_row["Balance"] = updated_row["Balance"] + 1
+        updated_row["timestamp_server"] = updated_row["timestamp_server"] + 1
+        source_datastore.put(updated_row.to_frame().T)
+
+        cache_datastore.get_latest_row(shard_key)
+        retrieved_row = cache_datastore.get_row_by_timestamp(shard_key, first_row["Date"], "Date")
+        assert retrieved_row["Balance"] == updated_row["Balance"]
+
+    @staticmethod
+    def test_cache_datastore_fallback_memo_source_error(setup_and_teardown_clickhouse_datastore, monkeypatch):
+        ch_datastores, test_name = setup_and_teardown_clickhouse_datastore
+        insert_data_into_clickhouse(ch_datastores[MT5DealDaily], MT5DealDaily, test_name)
+        cache_datastore = CacheDatastore(MT5DealDaily, ch_datastores[MT5DealDaily])
+        login = load_csv(MT5DealDaily).iloc[-1]["Login"]
+        cache_datastore.get_latest_row({"Login": login})
+
+        def connection_refused():
+            raise ConnectionError("ClickHouse is down")
+
+        client = ch_datastores[MT5DealDaily].client
+        monkeypatch.setattr(client, "_acquire_ch_client", connection_refused)
+        monkeypatch.setattr(client, "_create_ch_client", connection_refused)
+        # A failed source lookup is raised, not memoized as a key the source has no row for
+        missing_date = datetime.date(1960, 1, 1)
+        with pytest.raises(ConnectionError):
+            cache_datastore.get_rows_by_timestamp(pd.DataFrame({"Login": [login], "Date": [missing_date]}), "Date")
+        with pytest.raises(ConnectionError):
+            cache_datastore.get_row_by_timestamp({"Login": login}, missing_date, "Date")
+
+        monkeypatch.undo()
+        assert cache_datastore.get_row_by_timestamp({"Login": login}, missing_date, "Date") is None
+        assert cache_datastore.get_stats()["fallback_memo_hits"] == 0
+
+
+class TestWriteBehindBuffer:
+    @staticmethod
+    def test_write_behind_buffer_batches_in_order():
+        batches = []
+        write_buffer = WriteBehindBuffer(batches.append, "Test", max_batch_rows=5, max_delay=60, max_pending_rows=10)
+        expected_df = load_csv(MT5DealDaily)
+        for _, row in expected_df.iterrows():
+            write_buffer.put(row)
+        write_buffer.close()
+
+        assert all(len(batch) <= 5 for batch in batches)
+        assert list(pd.concat(batches)["timestamp_server"]) == list(expected_df["timestamp_server"])
+        with pytest.raises(ValueError):
+            write_buffer.put(expected_df)
+
+    @staticmethod
+    def test_write_behind_buffer_retries_and_dead_letters(monkeypatch, tmp_path):
+        monkeypatch.setattr(WriteBehindBuffer, "RETRY_DELAY", 0.01)
+        expected_df = load_csv(MT5DealDaily)
+        batches, failures = [], []
+
+        def flaky_write(df):
+            if len(failures) < 2:
+                failures.append(df)
+                raise ValueError("insert failed")
+            batches.append(df)
+
+        # A failed batch is put back and retried, no row is lost or reordered
+        write_buffer = WriteBehindBuffer(
+            flaky_write,
+            "Test",
+            max_batch_rows=5,
+            max_delay=60,
+            max_pending_rows=10,
+            max_retries=3,
+        )
+        for _, row in expected_df.iterrows():
+            write_buffer.put(row)
+        write_buffer.close()
+        assert list(pd.concat(batches)["timestamp_server"]) == list(expected_df["timestamp_server"])
+
+        def failing_write(df):
+            raise ValueError("insert failed")
+
+        # A batch still failing after max_retries attempts is dead-lettered,
+        # flush reports it and close still stops the thread
+        write_buffer = WriteBehindBuffer(
+            failing_write, "Test", max_batch_rows=5, max_delay=60, max_retries=2, dead_letter_dir=str(tmp_path)
+        )
+        write_buffer.put(expected_df.head(3))
+        with pytest.raises(ValueError, match="insert failed"):
+            write_buffer.flush()
+        assert write_buffer.get_stats() == {"pending_rows": 0, "written_batches": 0, "dead_letter_batches": 1}
+        assert len(pd.read_pickle(next(tmp_path.iterdir()))) == 3
+        write_buffer.put(expected_df.head(2))
+        with pytest.raises(ValueError):
+            write_buffer.close(timeout=0)
+        assert not write_buffer._thread.is_alive()
+        assert write_buffer.get_stats()["dead_letter_batches"] == 2
@@ -1,13 +1,27 @@
 import datetime
+import threading
+import time
+
 import pandas as pd
 import pytest
-
-from account_metrics import AccountMetricByDeal, AccountMetricDaily, AccountSymbolMetricByDeal, MT5Deal, MT5DealDaily, PositionMetricByDeal
+from account_metrics import AccountMetricByDeal
+from account_metrics import AccountMetricDaily
+from account_metrics import AccountSymbolMetricByDeal
+from account_metrics import MT5Deal
+from account_metrics import MT5DealDaily
+from account_metrics import PositionMetricByDeal
+from clickhouse_connect.datatypes.registry import get_from_name
 
 from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
-from metric_coordinator.data_emiter.clickhouse_data_emiter import ClickhouseEmitter
-from tests.conftest import METRICS, join_metric_name_test_name
+from metric_coordinator.configs import MIN_TIME
 from metric_coordinator.configs import settings
+from metric_coordinator.configs import TableLayout
+from metric_coordinator.configs import type_map
+from metric_coordinator.data_emiter.clickhouse_data_emiter import ClickhouseEmitter
+from metric_coordinator.data_emiter.emit_queue import EmitQueue
+from metric_coordinator.datastore.clickhouse_datastore import ClickhouseDatastore
+from tests.conftest import join_metric_name_test_name
+from tests.conftest import METRICS
 
 
 @pytest.fixture
@@ -67,8 +81,7 @@ def test_clickhouse_data_emitter_emit(setup_and_teardown_clickhouse_emitter):
     data = {MT5Deal: df_deal, MT5DealDaily: df_history}
     ch_emitter.emit(data)
 
-    # TODO: fix last emit timestamp
-    # assert ch_emitter.get_last_emit_timestamp(MT5Deal) > first_timestamp
+    assert ch_emitter.get_last_emit_timestamp(MT5Deal) >= first_timestamp
 
     mt5deal_metric_name = join_metric_name_test_name(MT5Deal, test_name)
     mt5dealdaily_metric_name = join_metric_name_test_name(MT5DealDaily, test_name)
@@ -89,3 +102,259 @@ def test_clickhouse_data_emitter_emit_duplicate_key(setup_and_teardown_clickhous
 
     mt5deal_metric_name = join_metric_name_test_name(MT5Deal, test_name)
     assert ch.client.query_df(f"SELECT * FROM {mt5deal_metric_name}").shape[0] == 1
+
+
+def test_clickhouse_data_emitter_emit_watermarks(setup_and_teardown_clickhouse_emitter):
+    ch, test_name = setup_and_teardown_clickhouse_emitter
+    df_deal = pd.DataFrame(
+        [
+            MT5Deal(login=1999, Deal=1502, server=settings.SERVER_NAME, timestamp_server=1720483199).model_dump(),
+            MT5Deal(login=1999, Deal=2708, server=settings.SERVER_NAME, timestamp_server=1720569599).model_dump(),
+            MT5Deal(login=2000, Deal=3001, server=settings.SERVER_NAME, timestamp_server=1720400000).model_dump(),
+        ],
+        columns=MT5Deal.model_fields.keys(),
+    )
+    ch.emit({MT5Deal: df_deal})
+
+    # Read from memory after the emit
+    assert ch.get_last_emit_timestamp(MT5Deal) == 1720569599
+    assert ch.get_last_emit_timestamp(MT5Deal, [1999]) == 1720569599
+    assert ch.get_last_emit_timestamp(MT5Deal, [2000]) == 1720400000
+    assert ch.get_last_emit_timestamp(MT5Deal, [2001]) == MIN_TIME
+
+    # A new emitter seeds the same watermarks from the table
+    seeded = ClickhouseEmitter(ch.client, server=settings.SERVER_NAME, metric_table_names=ch.metric_table_names)
+    seeded.initialize_metric(MT5Deal)
+    assert seeded._watermarks[MT5Deal] == ch._watermarks[MT5Deal]
+    assert seeded.get_last_emit_timestamp(MT5Deal) == 1720569599
+    assert seeded.last_retrieve_timestamp == 1720569599
+
+
+def test_clickhouse_data_emitter_watermarks_seed_failure(setup_and_teardown_clickhouse_emitter, monkeypatch):
+    ch, test_name = setup_and_teardown_clickhouse_emitter
+    df_deal = pd.DataFrame(
+        [MT5Deal(login=1999, Deal=1502, server=settings.SERVER_NAME, timestamp_server=1720483199).model_dump()],
+        columns=MT5Deal.model_fields.keys(),
+    )
+    ch.emit({MT5Deal: df_deal})
+
+    def connection_refused():
+        raise ConnectionError("ClickHouse is down")
+
+    # A failed seed stores no watermark, it is retried instead of being taken for an empty table
+    seeded = ClickhouseEmitter(ch.client, server=settings.SERVER_NAME, metric_table_names=ch.metric_table_names)
+    monkeypatch.setattr(ch.client, "_acquire_ch_client", connection_refused)
+    monkeypatch.setattr(ch.client, "_create_ch_client", connection_refused)
+    with pytest.raises(ConnectionError):
+        seeded.get_last_emit_timestamp(MT5Deal)
+    monkeypatch.undo()
+    assert seeded.get_last_emit_timestamp(MT5Deal, [1999]) == 1720483199
+
+
+def test_clickhouse_data_emitter_insert_plan(setup_and_teardown_clickhouse_emitter):
+    ch, test_name = setup_and_teardown_clickhouse_emitter
+    plan = ch._insert_plans[MT5DealDaily]
+    assert plan.table == join_metric_name_test_name(MT5DealDaily, test_name)
+    assert plan.column_names == list(MT5DealDaily.model_fields.keys())
+
+    # Columns out of order and a missing column are sent in the table order, the missing one with its default
+    df_history = pd.DataFrame(
+        [MT5DealDaily(Login=1999, Date=datetime.date(2024, 7, 9), timestamp_server=1720569599).model_dump()],
+        columns=MT5DealDaily.model_fields.keys(),
+    )
+    ch.emit({MT5DealDaily: df_history[df_history.columns[::-1]].drop(columns=["Balance"])})
+    ch.emit({MT5DealDaily: df_history.assign(Login=2000)})
+    retrieved_df = ch.client.query_df(f"SELECT * FROM {plan.table} ORDER BY Login")
+    assert list(retrieved_df["Login"]) == [1999, 2000]
+    assert list(retrieved_df["Date"]) == [datetime.date(2024, 7, 9)] * 2
+    assert retrieved_df["Balance"].iloc[0] == MT5DealDaily.model_fields["Balance"].get_default()
+
+    # Values are checked against the schema instead of truncated
+    with pytest.raises(ValueError, match="fractional"):
+        ch.emit({MT5DealDaily: df_history.assign(Login=1999.5)})
+
+
+def test_clickhouse_data_emitter_insert_plan_types():
+    # Insert plans parse the ClickHouse types of type_map client-side
+    assert [get_from_name(name).name for name in type_map.values()] == list(type_map.values())
+
+
+def test_clickhouse_data_emitter_latest_state_view(get_test_name):
+    table_name = join_metric_name_test_name(MT5DealDaily, get_test_name)
+    client = ClickhouseClient(
+        username=settings.CLICKHOUSE_USERNAME,
+        password=settings.CLICKHOUSE_PASSWORD,
+        host=settings.CLICKHOUSE_HOST,
+        http_port=settings.CLICKHOUSE_HTTP_PORT,
+        database=settings.CLICKHOUSE_DATABASE,
+    )
+    ch = ClickhouseEmitter(
+        client,
+        server=settings.SERVER_NAME,
+        metric_table_names={MT5DealDaily: table_name},
+        latest_state_views=True,
+    )
+    ch.initialize_metric(MT5DealDaily)
+
+    # Two days of the same login, the latest state table only keeps the most recent one
+    df_history = pd.DataFrame(
+        [
+            MT5DealDaily(Login=1999, Date=datetime.date(2024, 7, 8), timestamp_server=1720483199).model_dump(),
+            MT5DealDaily(Login=1999, Date=datetime.date(2024, 7, 9), timestamp_server=1720569599).model_dump(),
+        ],
+        columns=MT5DealDaily.model_fields.keys(),
+    )
+    ch.emit({MT5DealDaily: df_history})
+
+    ch_datastore = ClickhouseDatastore(
+        MT5DealDaily,
+        client,
+        table_name=table_name,
+        latest_state_view=True,
+        load_latest_state=True,
+    )
+    assert ch_datastore.get_latest_row({"Login": 1999})["timestamp_server"] == 1720569599
+    loaded_df = ch_datastore.eager_load()
+    assert len(loaded_df) == 1 and loaded_df["timestamp_server"].iloc[0] == 1720569599
+    ch.drop_metric(MT5DealDaily)
+
+
+def test_clickhouse_data_emitter_table_layout(get_test_name):
+    table_name = join_metric_name_test_name(MT5DealDaily, get_test_name)
+    client = ClickhouseClient(
+        username=settings.CLICKHOUSE_USERNAME,
+        password=settings.CLICKHOUSE_PASSWORD,
+        host=settings.CLICKHOUSE_HOST,
+        http_port=settings.CLICKHOUSE_HTTP_PORT,
+        database=settings.CLICKHOUSE_DATABASE,
+    )
+    layout = TableLayout(
+        partition_by="toYYYYMM(toDateTime(timestamp_server))",
+        version_column="timestamp_server",
+        codecs={"timestamp_server": "Delta, ZSTD", "Balance": "ZSTD"},
+        low_cardinality=["server", "Group"],
+    )
+    ch = ClickhouseEmitter(
+        client,
+        server=settings.SERVER_NAME,
+        metric_table_names={MT5DealDaily: table_name},
+        table_layouts={"MT5DealDaily": layout},
+    )
+    ch.initialize_metric(MT5DealDaily)
+
+    create_query = client.query_ddl(f"SHOW CREATE TABLE {table_name}").first_item["statement"]
+    assert "PARTITION BY toYYYYMM(toDateTime(timestamp_server))" in create_query
+    assert "ReplacingMergeTree(timestamp_server)" in create_query
+    assert "`server` LowCardinality(String)" in create_query
+    assert "CODEC(Delta(8), ZSTD(1))" in create_query
+    ch.drop_metric(MT5DealDaily)
+
+
+def test_emit_queue_backpressure_and_drain():
+    emitted, release = [], threading.Event()
+
+    def emit(data):
+        release.wait()
+        emitted.append(data["batch"])
+
+    emit_queue = EmitQueue(emit, "Test", max_batches=2)
+    emit_queue.put({"batch": 0})
+    emit_queue.put({"batch": 1})
+    # The queue is full while the first batch is being emitted, the next put waits for it
+    blocked_put = threading.Thread(target=emit_queue.put, args=({"batch": 2},))
+    blocked_put.start()
+    blocked_put.join(timeout=0.2)
+    assert blocked_put.is_alive()
+
+    release.set()
+    blocked_put.join()
+    emit_queue.close()
+    assert emitted == [0, 1, 2]
+    stats = emit_queue.get_stats()
+    assert stats["pending_batches"] == 0 and stats["emitted_batches"] == 3 and stats["emitted_rows"] == 0
+    with pytest.raises(ValueError):
+        emit_queue.put({"batch": 3})
+
+
+def test_clickhouse_data_emitter_emit_reports_failed_tables(setup_and_teardown_clickhouse_emitter):
+    ch_emitter, test_name = setup_and_teardown_clickhouse_emitter
+    df_deal = pd.DataFrame([MT5Deal(login=1999, Deal=1502).model_dump()], columns=MT5Deal.model_fields.keys())
+    df_history = pd.DataFrame([MT5DealDaily(Login=1999).model_dump()], columns=MT5DealDaily.model_fields.keys())
+    missing_table = join_metric_name_test_name(MT5DealDaily, test_name)
+    ch_emitter.drop_metric(MT5DealDaily)
+
+    # The tables are inserted concurrently, the failed one is reported and the others are still inserted
+    with pytest.raises(ValueError, match=missing_table):
+        ch_emitter.emit({MT5Deal: df_deal, MT5DealDaily: df_history})
+    mt5deal_metric_name = join_metric_name_test_name(MT5Deal, test_name)
+    assert ch_emitter.client.query_df(f"SELECT * FROM {mt5deal_metric_name}").shape[0] == 1
+    ch_emitter.close()
+
+
+@pytest.mark.parametrize("overflow_policy", ["drop_oldest", "spill"])
+def test_emit_queue_overflow_policies(overflow_policy, tmp_path):
+    emitted, started, release = [], threading.Event(), threading.Event()
+
+    def emit(data):
+        started.set()
+        release.wait()
+        emitted.append(data[MT5Deal]["Deal"].iloc[0])
+
+    emit_queue = EmitQueue(emit, "Test", max_batches=2, overflow_policy=overflow_policy, spill_dir=str(tmp_path))
+    # put never blocks: batch 0 is being emitted, the next ones overflow the queue
+    emit_queue.put({MT5Deal: pd.DataFrame({"Deal": [0]})})
+    started.wait()
+    for deal in range(1, 5):
+        emit_queue.put({MT5Deal: pd.DataFrame({"Deal": [deal]})})
+    release.set()
+    emit_queue.close()
+
+    stats = emit_queue.get_stats()
+    if overflow_policy == "drop_oldest":
+        assert emitted == [0, 4] and stats["dropped_batches"] == 3
+    else:
+        assert emitted == [0, 1, 2, 3, 4] and stats["spilled_batches"] == 3
+        assert list(tmp_path.iterdir()) == []
+    assert stats["put_batches"] == 5 and stats["emitted_rows"] == len(emitted)
+
+
+def test_emit_queue_dead_letters_poison_batch(monkeypatch, tmp_path):
+    monkeypatch.setattr(EmitQueue, "RETRY_DELAY", 0.01)
+    emitted = []
+
+    def emit(data):
+        if data["batch"] == 0:
+            raise ValueError("emit failed")
+        emitted.append(data["batch"])
+
+    # The poison batch is dead-lettered after max_retries attempts instead of blocking the batches behind it
+    emit_queue = EmitQueue(emit, "Test", max_batches=1, max_retries=3, dead_letter_dir=str(tmp_path))
+    for batch in range(3):
+        emit_queue.put({"batch": batch})
+    with pytest.raises(ValueError, match="emit failed"):
+        emit_queue.close()
+    assert emitted == [1, 2]
+    assert not emit_queue._thread.is_alive()
+    assert emit_queue.get_stats()["dead_letter_batches"] == 1
+    assert [pd.read_pickle(path) for path in tmp_path.iterdir()] == [{"batch": 0}]
+
+
+def test_emit_queue_close_times_out_on_hung_emit(tmp_path):
+    started, release = threading.Event(), threading.Event()
+
+    def emit(data):
+        started.set()
+        release.wait()
+
+    emit_queue = EmitQueue(emit, "Test", max_batches=2, dead_letter_dir=str(tmp_path))
+    emit_queue.put({"batch": 0})
+    started.wait()
+    emit_queue.put({"batch": 1})
+
+    # close gives up on the hung emit at the deadline, the batch behind it is dead-lettered
+    start = time.monotonic()
+    with pytest.raises(ValueError, match="1 batches moved.*a write is still running"):
+        emit_queue.close(timeout=0.2)
+    assert time.monotonic() - start < 5
+    assert [pd.read_pickle(path) for path in tmp_path.iterdir()] == [{"batch": 1}]
+    release.set()
@@ -1,26 +1,29 @@
 import os
 import time
+
 import pandas as pd
 import pytest
-
-from account_metrics import AccountMetricByDeal, AccountMetricDaily, AccountSymbolMetricByDeal, MT5Deal, MT5DealDaily, PositionMetricByDeal
+from account_metrics import AccountMetricByDeal
+from account_metrics import AccountMetricDaily
+from account_metrics import AccountSymbolMetricByDeal
 from account_metrics import METRIC_CALCULATORS
+from account_metrics import MT5Deal
+from account_metrics import MT5DealDaily
+from account_metrics import PositionMetricByDeal
 
+from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
 from metric_coordinator.configs import type_map
 from metric_coordinator.data_emiter.clickhouse_data_emiter import ClickhouseEmitter
+from metric_coordinator.data_emiter.emit_queue import EmitQueue
 from metric_coordinator.data_emiter.logging_data_emiter import LoggingEmitter
 from metric_coordinator.metric_runner import MetricRunner
 from metric_coordinator.model import BaseDatastore
-from metric_coordinator.api_client.clickhouse_client import ClickhouseClient
-
-from tests.conftest import (
-    METRICS,
-    join_metric_name_test_name,
-    get_test_settings,
-    insert_data_into_clickhouse,
-    load_csv,
-    process_string_column,
-)
+from tests.conftest import get_test_settings
+from tests.conftest import insert_data_into_clickhouse
+from tests.conftest import join_metric_name_test_name
+from tests.conftest import load_csv
+from tests.conftest import METRICS
+from tests.conftest import process_string_column
 
 
 @pytest.fixture
@@ -120,6 +123,7 @@ def test_metric_runner_process_metrics(setup_teardown_metric_runner):
     # Compare dataframes
     pd.testing.assert_frame_equal(calculated_df[expected_df.columns], expected_df, check_dtype=True)
 
+
 def test_metric_runner_process_metrics_perf(setup_teardown_metric_runner):
     metric_runner, test_name = setup_teardown_metric_runner
     metric_runner.setup_clickhouse_client()
@@ -141,12 +145,66 @@ def test_metric_runner_process_metrics_perf(setup_teardown_metric_runner):
 
     df_mt5_deal = load_csv(MT5Deal, os.path.abspath("tests/test_data/mt5_deal_large.csv"))
     df_mt5_deal_daily = load_csv(MT5DealDaily, os.path.abspath("tests/test_data/mt5_deal_daily_large.csv"))
-    
-    insert_data_into_clickhouse(metric_runner.get_datastore(MT5DealDaily).get_source_datastore(), MT5DealDaily, test_name, df_mt5_deal_daily)
 
-    start = time.time()    
+    insert_data_into_clickhouse(
+        metric_runner.get_datastore(MT5DealDaily).get_source_datastore(), MT5DealDaily, test_name, df_mt5_deal_daily
+    )
+
+    start = time.time()
     results = metric_runner.process_metrics(df_mt5_deal)
-    
+
     elapsed_time = time.time() - start
     print(f"Elapsed time: {elapsed_time}")
-    
\ No newline at end of file
+
+    # Every registered metric is calculated, the by-deal metrics have one row per deal
+    assert set(results) == {metric for metric in METRICS if metric not in [MT5Deal, MT5DealDaily]}
+    for metric in [AccountMetricByDeal, AccountSymbolMetricByDeal, PositionMetricByDeal]:
+        assert len(results[metric]) == len(df_mt5_deal)
+
+
+class FailingEmitter(LoggingEmitter):
+    def emit(self, data):
+        raise ValueError("emit failed")
+
+
+class ClosingEmitter(LoggingEmitter):
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_metric_runner_close_drains_every_emitter(monkeypatch, tmp_path):
+    monkeypatch.setattr(EmitQueue, "RETRY_DELAY", 0.01)
+    update = {"EMIT_ASYNC": True, "EMIT_MAX_RETRIES": 1, "EMIT_DEAD_LETTER_DIR": str(tmp_path)}
+    settings = get_test_settings().model_copy(update=update)
+    metric_runner = MetricRunner(settings, MT5Deal)
+    emitter = ClosingEmitter()
+    metric_runner.register_emitter(FailingEmitter())
+    metric_runner.register_emitter(emitter)
+    metric_runner.emit_metrics({MT5Deal: pd.DataFrame({"Deal": [1]})})
+
+    # The failing emitter does not keep the other one from being drained and closed
+    with pytest.raises(ValueError, match="FailingEmitter0"):
+        metric_runner.close()
+    assert MT5Deal in emitter.last_emit_timestamp
+    assert emitter.closed
+
+
+def test_metric_runner_close_closes_clickhouse_client(monkeypatch):
+    closed = []
+    monkeypatch.setattr(ClickhouseClient, "close", lambda self: closed.append(self))
+    metric_runner = MetricRunner(get_test_settings(), MT5Deal)
+    metric_runner.setup_clickhouse_client()
+
+    metric_runner.close()
+    assert closed == [metric_runner.get_clickhouse_client()]
+
+
+def test_metric_runner_latest_state_view_only_for_emitted_metrics():
+    settings = get_test_settings().model_copy(update={"CLICKHOUSE_LATEST_STATE_VIEWS": True})
+    metric_runner = MetricRunner(settings, MT5Deal)
+    metric_runner.setup_clickhouse_client()
+
+    # MT5DealDaily is only read, so no emitter creates its latest state table
+    assert metric_runner.setup_datastore(MT5DealDaily).get_source_datastore().latest_state_columns is None
+    metric_runner._metrics.append(MT5DealDaily)
+    assert metric_runner.setup_datastore(MT5DealDaily).get_source_datastore().latest_state_columns is not None